@@ -0,0 +1,166 @@
+# SmartPGP : JavaCard implementation of OpenPGP card v3 specification
+# https://github.com/ANSSI-FR/SmartPGP
+# Copyright (C) 2016 ANSSI
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""asyncio front end for CardConnectionContext.
+
+Each AsyncCardSession owns one reader and one worker thread: every card
+operation of the session runs on that thread, in submission order, so the
+event loop never blocks on a transmit and one loop can drive many readers
+at once:
+
+    sessions = [AsyncCardSession(i) for i in range(len(readers()))]
+    await asyncio.gather(*(s.command('switch-rsa2048') for s in sessions))
+
+A single APDU cannot be interrupted (on-card RSA key generation takes tens
+of seconds). When an awaited operation is cancelled or times out, the
+operation stops before its next APDU and the session stays usable.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from smartpgp.highlevel import CardConnectionContext
+from smartpgp.commands import send_apdu
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+class _GuardedConnection:
+    """Card connection that refuses new APDUs once the running operation
+    has been cancelled"""
+
+    def __init__(self, connection, session):
+        self._connection = connection
+        self._session = session
+
+    def transmit(self, apdu, *args, **kwargs):
+        if self._session._cancel_event.is_set():
+            raise OperationCancelled
+        return self._connection.transmit(apdu, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class AsyncCardSession:
+
+    def __init__(self, reader_index=0, ctx=None, timeout=None):
+        self.ctx = ctx if ctx is not None else CardConnectionContext()
+        self.ctx.reader_index = reader_index
+        # Default timeout in seconds of each operation (None: no timeout)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="smartpgp-reader-%d" % reader_index)
+        # Cancellation flag of the operation running on the worker thread
+        self._cancel_event = threading.Event()
+
+    @classmethod
+    def for_all_readers(cls, timeout=None):
+        """One session per PC/SC reader"""
+        from smartcard.System import readers
+        return [cls(i, timeout=timeout) for i in range(len(readers()))]
+
+    def _call(self, cancel_event, fun, args, kwargs):
+        # Runs on the worker thread
+        self._cancel_event = cancel_event
+        if cancel_event.is_set():
+            raise OperationCancelled
+        self._guard_connection()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            # connect and the reset commands open new connections
+            self._guard_connection()
+
+    def _guard_connection(self):
+        connection = self.ctx.connection
+        if connection is not None and not isinstance(connection, _GuardedConnection):
+            self.ctx.connection = _GuardedConnection(connection, self)
+
+    async def run(self, fun, *args, timeout=None, **kwargs):
+        """Run the blocking fun(*args, **kwargs) on the session's thread.
+
+        Raises asyncio.TimeoutError after timeout seconds (default: the
+        session timeout); the operation is then cancelled like on
+        CancelledError and raises OperationCancelled at its next APDU."""
+        if timeout is None:
+            timeout = self.timeout
+        cancel_event = threading.Event()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(
+            self._call, cancel_event, fun, args, kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            cancel_event.set()
+            raise
+
+    async def connect(self, **kwargs):
+        """Connect to the reader and select the OpenPGP applet"""
+        await self.run(self.ctx.connect, **kwargs)
+        return await self.run(self.ctx.card_serial, **kwargs)
+
+    async def verify_admin_pin(self, **kwargs):
+        await self.connect(**kwargs)
+        await self.run(self.ctx.verify_admin_pin, **kwargs)
+
+    async def verify_user_pin(self, **kwargs):
+        await self.connect(**kwargs)
+        await self.run(self.ctx.verify_user_pin, **kwargs)
+
+    async def transmit(self, apdu, **kwargs):
+        """Send a raw APDU, returns (data, sw1, sw2)"""
+        await self.connect(**kwargs)
+        return await self.run(lambda: send_apdu(self.ctx.connection, "APDU", list(apdu)), **kwargs)
+
+    async def command(self, name, timeout=None, **options):
+        """Run a smartpgp-cli command (e.g. 'switch-rsa2048', 'put-sign-certificate')
+        with the given context options (e.g. input='cert.der')"""
+        method = getattr(self.ctx, 'cmd_' + name.replace('-', '_'), None)
+        if method is None:
+            raise ValueError("Unknown command '%s'" % name)
+        def run():
+            for key, value in options.items():
+                setattr(self.ctx, key, value)
+            return method()
+        return await self.run(run, timeout=timeout)
+
+    async def close(self):
+        """Disconnect and stop the worker thread"""
+        def disconnect():
+            if self.ctx.connection is not None:
+                try:
+                    self.ctx.connection.disconnect()
+                except Exception:
+                    pass
+            self.ctx.connection = None
+            self.ctx.connected = False
+        try:
+            await self.run(disconnect, timeout=None)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
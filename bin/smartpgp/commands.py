@@ -16,14 +16,15 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
-from smartcard.Exceptions import NoCardException
-from smartcard.System import readers
-from smartcard.util import toHexString
-
 import struct
 import os
 import array
-import hashlib
+import contextlib
+import threading
+import time
+
+# pyscard, hashlib and concurrent.futures are imported where they are used,
+# to keep the start of the command line tool short
 
 
 SELECT = [0x00, 0xA4, 0x04, 0x00,
@@ -33,6 +34,23 @@ SELECT = [0x00, 0xA4, 0x04, 0x00,
 
 VERIFY_ADMIN = [0x00, 0x20, 0x00, 0x83]
 VERIFY_USER_82 = [0x00, 0x20, 0x00, 0x82]
+VERIFY_USER_81 = [0x00, 0x20, 0x00, 0x81]
+
+# PIN references (P2 of VERIFY / CHANGE REFERENCE DATA); the resetting
+# code has no reference of its own and uses 0xD3, its DO
+PW1 = 0x81
+PW3 = 0x83
+RESETTING_CODE = 0xD3
+
+KDF_NONE = 0x00
+KDF_ITERSALTED_S2K = 0x03
+KDF_SHA256 = 0x08
+KDF_SHA512 = 0x0A
+KDF_HASHES = {KDF_SHA256: 'sha256', KDF_SHA512: 'sha512'}
+# Iteration count (in bytes hashed) used by setup-kdf, GnuPG's largest S2K count
+KDF_DEFAULT_ITERATIONS = 65011712
+KDF_MIN_ITERATIONS = 65536
+KDF_BUFFER_SIZE = 1 << 20
 TERMINATE = [0x00, 0xe6, 0x00, 0x00]
 ACTIVATE = [0x00, 0x44, 0x00, 0x00]
 ACTIVATE_FULL = [0x00, 0x44, 0x00, 0x01]
@@ -86,7 +104,55 @@ class WrongKeyRole(Exception):
 class WrongAlgo(Exception):
     pass
 
+class CardOperationFailed(Exception):
+    pass
+
+def parse_tlv(data):
+    """BER-TLV data objects by tag, constructed ones included with their
+    content parsed too (the first occurrence of a tag wins)"""
+    data = list(data)
+    objects = {}
+    i = 0
+    while i < len(data):
+        if data[i] in (0x00, 0xFF):
+            # padding between objects
+            i += 1
+            continue
+        tag = data[i]
+        constructed = tag & 0x20
+        i += 1
+        if tag & 0x1F == 0x1F:
+            while True:
+                if i >= len(data):
+                    raise CardOperationFailed("Invalid TLV: truncated tag")
+                tag = (tag << 8) | data[i]
+                i += 1
+                if not data[i - 1] & 0x80:
+                    break
+        if i >= len(data):
+            raise CardOperationFailed("Invalid TLV: missing length of tag %02X" % tag)
+        l = data[i]
+        i += 1
+        if l & 0x80:
+            n = l & 0x7F
+            if n == 0 or n > 3 or i + n > len(data):
+                raise CardOperationFailed("Invalid TLV: bad length of tag %02X" % tag)
+            l = int.from_bytes(bytes(data[i:i + n]), 'big')
+            i += n
+        if i + l > len(data):
+            raise CardOperationFailed("Invalid TLV: truncated tag %02X" % tag)
+        value = data[i:i + l]
+        i += l
+        objects.setdefault(tag, value)
+        if constructed:
+            for inner_tag, inner_value in parse_tlv(value).items():
+                objects.setdefault(inner_tag, inner_value)
+    return objects
+
 def ascii_encode_pin(pin):
+    # PINs already derived with the KDF are sent as they are
+    if isinstance(pin, (bytes, bytearray, list)):
+        return list(pin)
     return [ord(c) for c in pin]
 
 def assemble_with_len(prefix,data):
@@ -118,25 +184,40 @@ def encode_len(data):
 
 
 def kdf_itersalted_s2k(salt, value, algo, count):
-    if algo == 0x08: #SHA256
-        f = hashlib.new('sha256')
-    elif algo == 0x0A: #SHA512
-        f = hashlib.new('sha512')
-    else:
-        print("invalid KDF")
-    salt = list(salt)#[ord(c) for c in salt]
-    value = list(value)#[ord(c) for c in value]
-    data = bytes(salt + value)
-    #data = array.array('B', data).tostring()
-    datalen = len(data)
-    while datalen <= count:
-        f.update(data)
-        count -= datalen
-    if 0 < count:
-        f.update(data[0:count])
+    """Iterated and salted S2K (RFC 4880 3.7.1.3) as used by the KDF-DO:
+    hash `count` bytes of salt || value repeated.
+
+    The repeated block is built once (up to KDF_BUFFER_SIZE bytes) and
+    hashed with a few large updates instead of one update per block."""
+    if algo not in KDF_HASHES:
+        raise ValueError("invalid KDF hash algorithm 0x%02X" % algo)
+    import hashlib
+    f = hashlib.new(KDF_HASHES[algo])
+    block = bytes(salt) + bytes(value)
+    if count <= 0 or len(block) == 0:
+        return f.digest()
+    # Whole blocks only, so that the buffer can be hashed back to back
+    reps = max(1, min(count, KDF_BUFFER_SIZE) // len(block))
+    buf = memoryview(block * reps)
+    full, rest = divmod(count, len(buf))
+    for _ in range(full):
+        f.update(buf)
+    if 0 < rest:
+        f.update(buf[:rest])
     return f.digest()
 
 
+def kdf_benchmark(algo=KDF_SHA256, target=0.1, sample=1 << 24):
+    """Measure the host's KDF_ITERSALTED_S2K throughput and return the
+    iteration count (bytes hashed) whose derivation takes about `target`
+    seconds, as (iterations, bytes per second)."""
+    start = time.perf_counter()
+    kdf_itersalted_s2k(bytes(8), b"123456", algo, sample)
+    rate = sample / max(time.perf_counter() - start, 1e-9)
+    iterations = int(rate * target)
+    return min(max(iterations, KDF_MIN_ITERATIONS), 0xFFFFFFFF), rate
+
+
 def _raw_send_apdu(connection, text, apdu):
     print("%s" % text)
     apdu = [int(c) for c in apdu]
@@ -146,20 +227,105 @@ def _raw_send_apdu(connection, text, apdu):
     print("%02X %02X" % (sw1, sw2))
     return (data,sw1,sw2)
 
+def send_apdu(connection, text, apdu):
+    """Send an APDU, collecting 61xx response data with GET RESPONSE"""
+    (data,sw1,sw2) = _raw_send_apdu(connection, text, apdu)
+    while sw1 == 0x61:
+        (ndata,sw1,sw2) = _raw_send_apdu(connection, "GET RESPONSE", [0x00, 0xC0, 0x00, 0x00, sw2])
+        data = data + ndata
+    return (data,sw1,sw2)
+
+# Names of the instructions in APDU traces
+INS_NAMES = {
+    0x20: 'VERIFY', 0x24: 'CHANGE REFERENCE DATA', 0x2A: 'PERFORM SECURITY OPERATION',
+    0x2C: 'RESET RETRY COUNTER', 0x44: 'ACTIVATE FILE', 0x47: 'GENERATE ASYMMETRIC KEY PAIR',
+    0x84: 'GET CHALLENGE', 0x88: 'INTERNAL AUTHENTICATE', 0xA4: 'SELECT', 0xA5: 'SELECT DATA',
+    0xC0: 'GET RESPONSE', 0xCA: 'GET DATA', 0xDA: 'PUT DATA', 0xDB: 'PUT DATA',
+    0xE6: 'TERMINATE DF',
+}
+
+# Lists the APDUs are recorded to, while trace_apdus() is active
+_apdu_traces = []
+_apdu_traces_lock = threading.Lock()
+
+@contextlib.contextmanager
+def trace_apdus():
+    """Record the APDUs sent on the connections opened while active (from
+    any thread). Yields the list of records: reader index, instruction name,
+    header, command data length, status word, response length and time in
+    seconds. The command data is not recorded (it holds PINs and keys)."""
+    trace = []
+    with _apdu_traces_lock:
+        _apdu_traces.append(trace)
+    try:
+        yield trace
+    finally:
+        with _apdu_traces_lock:
+            _apdu_traces.remove(trace)
+
+def _command_length(apdu):
+    """Length of the command data of an APDU (Lc, short or extended)"""
+    if len(apdu) <= 5:
+        return 0
+    if apdu[4] == 0 and len(apdu) >= 7:
+        return (apdu[5] << 8) | apdu[6]
+    return apdu[4]
+
+class _TracedConnection:
+    """Card connection recording its APDUs in the active traces"""
+
+    def __init__(self, connection, reader_index):
+        self._connection = connection
+        self._reader_index = reader_index
+
+    def transmit(self, apdu, *args, **kwargs):
+        start = time.perf_counter()
+        (data, sw1, sw2) = self._connection.transmit(apdu, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        record = {
+            'reader': self._reader_index,
+            'ins': INS_NAMES.get(apdu[1], '%02X' % apdu[1]),
+            'header': '%02X%02X%02X%02X' % tuple(apdu[:4]),
+            'length': _command_length(apdu),
+            'sw': '%02X%02X' % (sw1, sw2),
+            'response_length': len(data),
+            'time': round(elapsed, 6),
+        }
+        with _apdu_traces_lock:
+            for trace in _apdu_traces:
+                trace.append(record)
+        return (data, sw1, sw2)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
 def list_readers():
+    """Print the readers and the ATR of their card, returns them as a list
+    of {'reader', 'atr'} ('atr' is None without a card)"""
+    from smartcard.Exceptions import NoCardException
+    from smartcard.System import readers
+    from smartcard.util import toHexString
+    found = []
     for reader in readers():
         try:
             connection = reader.createConnection()
             connection.connect()
-            print(reader, toHexString(connection.getATR()))
+            atr = toHexString(connection.getATR())
+            print(reader, atr)
         except NoCardException:
+            atr = None
             print(reader, 'no card inserted')
+        found.append({'reader': str(reader), 'atr': atr})
+    return found
 
 def select_reader(reader_index):
+    from smartcard.System import readers
     reader_list = readers()
     r = reader_list[reader_index]
     conn = r.createConnection()
     conn.connect()
+    if _apdu_traces:
+        conn = _TracedConnection(conn, reader_index)
     return conn
 
 def select_applet(connection):
@@ -173,6 +339,14 @@ def verif_user_pin(connection, user_pin):
     verif_apdu = assemble_with_len(VERIFY_USER_82,ascii_encode_pin(user_pin))
     return _raw_send_apdu(connection,"Verify User PIN",verif_apdu)
 
+def verif_user_pin_81(connection, user_pin):
+    verif_apdu = assemble_with_len(VERIFY_USER_81,ascii_encode_pin(user_pin))
+    return _raw_send_apdu(connection,"Verify User PIN (signature)",verif_apdu)
+
+def get_application_id(connection):
+    apdu = [0x00, 0xCA, 0x00, 0x4F, 0x00]
+    return _raw_send_apdu(connection,"Get application identifier",apdu)
+
 def full_reset_card(connection):
     _raw_send_apdu(connection,"Terminate",TERMINATE)
     _raw_send_apdu(connection,"Activate",ACTIVATE_FULL)
@@ -199,7 +373,7 @@ def switch_crypto_rsa_2048(connection,key_role):
         raise WrongKeyRole
     prefix = [0x00, 0xDA, 0x00] + [role]
     apdu = assemble_with_len(prefix, data)
-    _raw_send_apdu(connection,"Switch to RSA2048 (%s)" % (key_role,),apdu)
+    return _raw_send_apdu(connection,"Switch to RSA2048 (%s)" % (key_role,),apdu)
 
 def switch_crypto_rsa_3072(connection,key_role):
     data = [
@@ -219,7 +393,7 @@ def switch_crypto_rsa_3072(connection,key_role):
         raise WrongKeyRole
     prefix = [0x00, 0xDA, 0x00] + [role]
     apdu = assemble_with_len(prefix, data)
-    _raw_send_apdu(connection,"Switch to RSA3072 (%s)" % (key_role,),apdu)
+    return _raw_send_apdu(connection,"Switch to RSA3072 (%s)" % (key_role,),apdu)
 
 def switch_crypto_rsa_4096(connection,key_role):
     data = [
@@ -239,7 +413,20 @@ def switch_crypto_rsa_4096(connection,key_role):
         raise WrongKeyRole
     prefix = [0x00, 0xDA, 0x00] + [role]
     apdu = assemble_with_len(prefix, data)
-    _raw_send_apdu(connection,"Switch to RSA4096 (%s)" % (key_role,),apdu)
+    return _raw_send_apdu(connection,"Switch to RSA4096 (%s)" % (key_role,),apdu)
+
+RSA_MODULUS_BITS = {'rsa': 2048, 'rsa2048': 2048, 'rsa3072': 3072, 'rsa4096': 4096}
+
+def algorithm_attributes(crypto, key_role):
+    """Algorithm attributes written by switch_crypto"""
+    bits = RSA_MODULUS_BITS.get(crypto.lower())
+    if bits is not None:
+        return [0x01, bits >> 8, bits & 0xff, 0x00, 0x11, 0x03]
+    try:
+        alg_name = ALGS_ALIASES[crypto]
+    except KeyError:
+        raise WrongAlgo
+    return [0x13 if key_role == 'sig' else 0x12] + OID_ALGS[alg_name] + [0xff]
 
 def switch_crypto(connection,crypto,key_role):
     alg_name = None
@@ -271,7 +458,7 @@ def switch_crypto(connection,crypto,key_role):
         raise WrongKeyRole
     prefix = [0x00, 0xDA, 0x00] + [role]
     apdu = assemble_with_len(prefix, [byte1] + data + [0xff])
-    _raw_send_apdu(connection,"Switch to %s (%s)" % (crypto,key_role),apdu)
+    return _raw_send_apdu(connection,"Switch to %s (%s)" % (crypto,key_role),apdu)
 
 def generate_sm_key(connection):
     apdu = assemble_with_len(GENERATE_ASYMETRIC_KEYPAIR, [0xA6, 0x00])
@@ -283,14 +470,47 @@ def get_sm_key(connection):
     apdu = apdu + [0x00]
     return _raw_send_apdu(connection,"Get SM key",apdu)
 
-def set_resetting_code(connection, resetting_code): 
+KEY_ROLE_CRTS = {'sig': 0xB6, 'dec': 0xB8, 'auth': 0xA4}
+
+def generate_key_pair(connection, key_role):
+    """Generate the key pair of a 'sig', 'dec' or 'auth' slot, returns
+    its public key (7F49 template)"""
+    try:
+        crt = KEY_ROLE_CRTS[key_role]
+    except KeyError:
+        raise WrongKeyRole
+    apdu = assemble_with_len(GENERATE_ASYMETRIC_KEYPAIR, [crt, 0x00])
+    apdu = apdu + [0x00]
+    return send_apdu(connection,"Generate %s key" % key_role,apdu)
+
+def get_public_key(connection, key_role):
+    """Public key of a 'sig', 'dec' or 'auth' slot (7F49 template),
+    SW 6A88 if the slot has no key"""
+    try:
+        crt = KEY_ROLE_CRTS[key_role]
+    except KeyError:
+        raise WrongKeyRole
+    apdu = assemble_with_len(GET_ASYMETRIC_KEYPAIR, [crt, 0x00])
+    apdu = apdu + [0x00]
+    return send_apdu(connection,"Get %s public key" % key_role,apdu)
+
+def get_data(connection, tag, text):
+    apdu = [0x00, 0xCA, (tag >> 8) & 0xff, tag & 0xff, 0x00]
+    return send_apdu(connection,text,apdu)
+
+def put_data(connection, tag, data, text):
+    prefix = [0x00, 0xDA, (tag >> 8) & 0xff, tag & 0xff]
+    apdu = assemble_with_len(prefix, list(data))
+    return _raw_send_apdu(connection,text,apdu)
+
+def set_resetting_code(connection, resetting_code):
     apdu = assemble_with_len([0x00, 0xDA, 0x00, 0xD3], ascii_encode_pin(resetting_code))
-    _raw_send_apdu(connection,"Define the resetting code (PUK)",apdu)
+    return _raw_send_apdu(connection,"Define the resetting code (PUK)",apdu)
 
 def unblock_pin(connection, resetting_code, new_user_pin):
     data = ascii_encode_pin(resetting_code)+ascii_encode_pin(new_user_pin)
     apdu = assemble_with_len([0x00, 0x2C, 0x00, 0x81], data)
-    _raw_send_apdu(connection,"Unblock user PIN with resetting code",apdu)
+    return _raw_send_apdu(connection,"Unblock user PIN with resetting code",apdu)
 
 def put_sm_key(connection, pubkey, privkey):
     ins_p1_p2 = [0xDB, 0x3F, 0xFF]
@@ -317,7 +537,7 @@ def put_sign_certificate(connection, cert):
     prefix = [0x00, 0xA5, 0x02, 0x04]
     data = [0x60, 0x04, 0x5C, 0x02, 0x7F, 0x21]
     apdu = assemble_with_len(prefix, data)
-    _raw_send_apdu(connection,"Selecting SIGN certificate",apdu)
+    result = _raw_send_apdu(connection,"Selecting SIGN certificate",apdu)
     ins_p1_p2 = [0xDA, 0x7F, 0x21]
     i = 0
     cl = 255
@@ -332,13 +552,14 @@ def put_sign_certificate(connection, cert):
             data = cert[i:i+cl]
             i = i + cl
         apdu = assemble_with_len([cla] + ins_p1_p2, data)
-        _raw_send_apdu(connection,"Sending SIGN certificate chunk",apdu)
+        result = _raw_send_apdu(connection,"Sending SIGN certificate chunk",apdu)
+    return result
 
 def put_auth_certificate(connection, cert):
     prefix = [0x00, 0xA5, 0x00, 0x04]
     data = [0x60, 0x04, 0x5C, 0x02, 0x7F, 0x21]
     apdu = assemble_with_len(prefix, data)
-    _raw_send_apdu(connection,"Selecting AUTH certificate",apdu)
+    result = _raw_send_apdu(connection,"Selecting AUTH certificate",apdu)
     ins_p1_p2 = [0xDA, 0x7F, 0x21]
     i = 0
     cl = 255
@@ -353,13 +574,14 @@ def put_auth_certificate(connection, cert):
             data = cert[i:i+cl]
             i = i + cl
         apdu = assemble_with_len([cla] + ins_p1_p2, data)
-        _raw_send_apdu(connection,"Sending AUTH certificate chunk",apdu)
+        result = _raw_send_apdu(connection,"Sending AUTH certificate chunk",apdu)
+    return result
 
 def put_sm_certificate(connection, cert):
     prefix = [0x00, 0xA5, 0x03, 0x04]
     data = [0x60, 0x04, 0x5C, 0x02, 0x7F, 0x21]
     apdu = assemble_with_len(prefix, data)
-    _raw_send_apdu(connection,"Selecting SM certificate",apdu)
+    result = _raw_send_apdu(connection,"Selecting SM certificate",apdu)
     ins_p1_p2 = [0xDA, 0x7F, 0x21]
     i = 0
     cl = 255
@@ -374,7 +596,17 @@ def put_sm_certificate(connection, cert):
             data = cert[i:i+cl]
             i = i + cl
         apdu = assemble_with_len([cla] + ins_p1_p2, data)
-        _raw_send_apdu(connection,"Sending SM certificate chunk",apdu)
+        result = _raw_send_apdu(connection,"Sending SM certificate chunk",apdu)
+    return result
+
+CERTIFICATE_OCCURRENCES = {'auth': 0x00, 'dec': 0x01, 'sig': 0x02, 'sm': 0x03}
+
+def get_certificate(connection, key_role):
+    prefix = [0x00, 0xA5, CERTIFICATE_OCCURRENCES[key_role], 0x04]
+    data = [0x60, 0x04, 0x5C, 0x02, 0x7F, 0x21]
+    apdu = assemble_with_len(prefix, data)
+    _raw_send_apdu(connection,"Selecting %s certificate" % key_role,apdu)
+    return get_data(connection, 0x7F21, "Receiving %s certificate" % key_role)
 
 def get_sm_certificate(connection):
     prefix = [0x00, 0xA5, 0x03, 0x04]
@@ -461,6 +693,87 @@ def decrypt_aes(connection, msg):
     return (res,sw1,sw2)
 
 
+# PSO:ENCIPHER/DECIPHER run in the card's 2 KiB internal buffer, which
+# holds both the input and the output of one operation
+AES_BLOCK_SIZE = 16
+AES_STREAM_CHUNK = 1008
+
+def _pso_aes_chunk(connection, ins_p1_p2, data):
+    """Send one PSO chunk with command chaining (no logging), returns the response"""
+    if not data:
+        raise ValueError("No data for PSO")
+    i = 0
+    cl = 255
+    l = len(data)
+    while i < l:
+        if (l - i) <= cl:
+            cla = 0x00
+            chunk = data[i:]
+            i = l
+        else:
+            cla = 0x10
+            chunk = data[i:i+cl]
+            i = i + cl
+        (res,sw1,sw2) = connection.transmit(assemble_with_len([cla] + ins_p1_p2, chunk))
+    while sw1 == 0x61:
+        (nres,sw1,sw2) = connection.transmit([0x00, 0xC0, 0x00, 0x00, sw2])
+        res = res + nres
+    if sw1 != 0x90 or sw2 != 0x00:
+        raise CardOperationFailed("PSO failed: %02X %02X" % (sw1, sw2))
+    return bytes(res)
+
+def _xor_block(a, b):
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(AES_BLOCK_SIZE, 'big')
+
+def _aes_stream(connection, fin, fout, encrypt, chunk_size):
+    if chunk_size % AES_BLOCK_SIZE != 0:
+        raise ValueError("Chunk size must be a multiple of %d" % AES_BLOCK_SIZE)
+    # Each PSO operation restarts CBC from a zero IV: chain the chunks on
+    # the host so the result matches a single operation over the whole input
+    prev = bytes(AES_BLOCK_SIZE)
+    total = 0
+    written = None
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as io:
+        # The worker reads the next chunk and writes the previous result
+        # while the card processes the current chunk
+        pending = io.submit(fin.read, chunk_size)
+        while True:
+            data = pending.result()
+            if not data:
+                break
+            if len(data) % AES_BLOCK_SIZE != 0:
+                raise ValueError("Input length must be a multiple of %d bytes" % AES_BLOCK_SIZE)
+            pending = io.submit(fin.read, chunk_size)
+            if encrypt:
+                msg = _xor_block(data[:AES_BLOCK_SIZE], prev) + data[AES_BLOCK_SIZE:]
+                # strip the padding indicator byte
+                res = _pso_aes_chunk(connection, [0x2A, 0x86, 0x80], list(msg))[1:]
+                prev = res[-AES_BLOCK_SIZE:]
+            else:
+                res = _pso_aes_chunk(connection, [0x2A, 0x80, 0x86], [0x02] + list(data))
+                res = _xor_block(res[:AES_BLOCK_SIZE], prev) + res[AES_BLOCK_SIZE:]
+                prev = data[-AES_BLOCK_SIZE:]
+            # Surface write errors (e.g. disk full) of the previous chunk
+            if written is not None:
+                written.result()
+            written = io.submit(fout.write, res)
+            total += len(data)
+        if written is not None:
+            written.result()
+    return total
+
+def encrypt_aes_stream(connection, fin, fout, chunk_size=AES_STREAM_CHUNK):
+    """Encrypt binary file fin to fout with the card AES key (CBC, zero IV, no padding),
+    one PSO:ENCIPHER per chunk. Returns the number of bytes processed."""
+    return _aes_stream(connection, fin, fout, True, chunk_size)
+
+def decrypt_aes_stream(connection, fin, fout, chunk_size=AES_STREAM_CHUNK):
+    """Decrypt binary file fin to fout with the card AES key, one PSO:DECIPHER
+    per chunk. Returns the number of bytes processed."""
+    return _aes_stream(connection, fin, fout, False, chunk_size)
+
+
 def put_kdf_do(connection, kdf_do):
     prefix = [0x00, 0xDA, 0x00, 0xF9]
     data = kdf_do
@@ -474,6 +787,51 @@ def get_kdf_do(connection):
     return (data,sw1,sw2)
 
 
+def parse_kdf_do(kdf_do):
+    """Parse the content of the KDF-DO (F9).
+
+    Returns None if no KDF is configured, else a dict with the hash 'algo',
+    the 'iterations' count and the 'salts' of PW1, PW3 and the resetting
+    code (missing salts default to the PW1 salt)."""
+    data = list(kdf_do)
+    if len(data) > 2 and data[0] == 0xF9:
+        # DO returned with its own tag and length
+        data = data[3:] if data[1] == 0x81 else data[2:]
+    fields = {}
+    i = 0
+    while i + 1 < len(data):
+        tag = data[i]
+        l = data[i + 1]
+        i += 2
+        if l == 0x81:
+            if i >= len(data):
+                raise CardOperationFailed("Invalid KDF-DO: truncated length of tag %02X" % tag)
+            l = data[i]
+            i += 1
+        if i + l > len(data):
+            raise CardOperationFailed("Invalid KDF-DO: truncated tag %02X" % tag)
+        fields[tag] = data[i:i + l]
+        i += l
+    if fields.get(0x81, [KDF_NONE]) != [KDF_ITERSALTED_S2K]:
+        return None
+    if len(fields.get(0x82, [])) != 1:
+        raise CardOperationFailed("Invalid KDF-DO: missing hash algorithm (tag 82)")
+    if len(fields.get(0x83, [])) != 4:
+        raise CardOperationFailed("Invalid KDF-DO: missing iteration count (tag 83)")
+    if not fields.get(0x84):
+        raise CardOperationFailed("Invalid KDF-DO: missing PW1 salt (tag 84)")
+    salt_pw1 = bytes(fields[0x84])
+    return {
+        'algo': fields[0x82][0],
+        'iterations': int.from_bytes(bytes(fields[0x83]), 'big'),
+        'salts': {
+            PW1: salt_pw1,
+            RESETTING_CODE: bytes(fields.get(0x85, [])) or salt_pw1,
+            PW3: bytes(fields.get(0x86, [])) or salt_pw1,
+        },
+    }
+
+
 def change_reference_data_pw1(connection, old, new):
     prefix = [0x00, 0x24, 0x00, 0x81]
     data = old + new
@@ -20,9 +20,7 @@
 from smartpgp.commands import *
 
 import binascii
-import pyasn1
-from pyasn1.type import univ
-from pyasn1.codec.der import encoder as der_encoder,decoder as der_decoder
+import os
 
 
 
@@ -41,6 +39,13 @@ class UserPINFailed(Exception):
 class InvalidPINType(Exception):
     pass
 
+def kdf_summary(kdf):
+    """JSON-friendly KDF-DO parameters (from parse_kdf_do): hash and
+    iteration count, or None"""
+    if kdf is None:
+        return None
+    return {'hash': KDF_HASHES.get(kdf['algo'], kdf['algo']), 'iterations': kdf['iterations']}
+
 class CardConnectionContext:
 
     def __init__(self):
@@ -48,11 +53,24 @@ class CardConnectionContext:
         self.resetting_code = None
         self.user_pin = "123456"
         self.admin_pin = "12345678"
+        self.new_pin = None
         self.connection = None
         self.read_pin = self._default_pin_read_function
         self.connected = False
+        # PW3 and PW1 (mode 82) verified on the current connection
         self.verified = False
+        self.user_verified = False
         self.input = None
+        self.serial = None
+        # KDF_ITERSALTED_S2K parameters for setup-kdf (kdf_time: benchmark a count instead)
+        self.kdf_algo = KDF_SHA256
+        self.kdf_iterations = KDF_DEFAULT_ITERATIONS
+        self.kdf_time = None
+        # KDF-DO parameters by card serial, and derived PINs, for the session
+        self._kdf_by_serial = {}
+        self._derived_pins = {}
+        # Structured result of the last command (smartpgp-cli --json)
+        self.result = None
 
     def _default_pin_read_function(self, pin_type):
         if pin_type == "Admin":
@@ -61,28 +79,77 @@ class CardConnectionContext:
             return self.user_pin
         if pin_type == "PUK":
             return self.resetting_code
+        if pin_type in ("new user", "new admin"):
+            return self.new_pin
         raise InvalidPINType
 
     def set_pin_read_function(self, fun):
         self.read_pin = fun
 
+    def card_serial(self):
+        """Card serial number from the application identifier, read once per connection"""
+        if self.serial is None:
+            (aid,sw1,sw2) = get_application_id(self.connection)
+            self.serial = bytes(aid[10:14]) if sw1==0x90 and sw2==0x00 and len(aid) >= 14 else b''
+        return self.serial
+
+    def kdf(self):
+        """KDF-DO parameters of the card (None if no KDF is set), read once per card"""
+        serial = self.card_serial()
+        if serial not in self._kdf_by_serial:
+            (kdf_do,sw1,sw2) = get_kdf_do(self.connection)
+            if sw1==0x90 and sw2==0x00:
+                self._kdf_by_serial[serial] = parse_kdf_do(kdf_do)
+            else:
+                self._kdf_by_serial[serial] = None
+        return self._kdf_by_serial[serial]
+
+    def encode_pin(self, pin, reference=PW1):
+        """PIN as sent to the card for reference PW1, PW3 or RESETTING_CODE:
+        its KDF_ITERSALTED_S2K hash when the card has a KDF-DO, else its ASCII
+        bytes. Derived values are memoized for the session, so high iteration
+        counts are paid once per PIN."""
+        kdf = self.kdf()
+        if kdf is None:
+            return ascii_encode_pin(pin)
+        if kdf['algo'] not in KDF_HASHES:
+            raise InvalidKDF
+        salt = kdf['salts'][reference]
+        key = (kdf['algo'], kdf['iterations'], salt, pin)
+        derived = self._derived_pins.get(key)
+        if derived is None:
+            derived = list(kdf_itersalted_s2k(salt, ascii_encode_pin(pin), kdf['algo'], kdf['iterations']))
+            self._derived_pins[key] = derived
+        return derived
+
+    def _forget_kdf(self):
+        self._kdf_by_serial.pop(self.card_serial(), None)
+
+    def _forget_session(self):
+        """After a card reset: PINs must be verified again and the KDF-DO
+        is gone"""
+        self.verified = False
+        self.user_verified = False
+        self._kdf_by_serial.clear()
+        self.serial = None
+
     def verify_admin_pin(self):
         if self.verified:
             return
         admin_pin = self.read_pin("Admin")
-        (_,sw1,sw2)=verif_admin_pin(self.connection, admin_pin)
+        (_,sw1,sw2)=verif_admin_pin(self.connection, self.encode_pin(admin_pin, PW3))
         if sw1==0x90 and sw2==0x00:
             self.verified = True
         else:
             raise AdminPINFailed
 
     def verify_user_pin(self):
-        if self.verified:
+        if self.user_verified:
             return
         user_pin = self.read_pin("User")
-        (_,sw1,sw2)=verif_user_pin(self.connection, user_pin)
+        (_,sw1,sw2)=verif_user_pin(self.connection, self.encode_pin(user_pin, PW1))
         if sw1==0x90 and sw2==0x00:
-            self.verified = True
+            self.user_verified = True
         else:
             raise UserPINFailed
         
@@ -90,6 +157,7 @@ class CardConnectionContext:
         if self.connected:
             return
         self.connection = select_reader(self.reader_index)
+        self.serial = None
         (_,sw1,sw2)=select_applet(self.connection)
         if sw1==0x90 and sw2==0x00:
             self.connected = True
@@ -97,7 +165,7 @@ class CardConnectionContext:
             raise ConnectionFailed
 
     def cmd_list_readers(self):
-        list_readers()
+        self.result = {'readers': list_readers()}
 
     def cmd_full_reset(self):
         # ignore errors
@@ -108,8 +176,8 @@ class CardConnectionContext:
         verif_admin_pin(self.connection, self.admin_pin)
         verif_admin_pin(self.connection, self.admin_pin)
         full_reset_card(self.connection)
-        # force re-entering admin PIN
-        self.verified = False
+        self._forget_session()
+        self.result = {'reader': self.reader_index, 'reset': 'full'}
 
     def cmd_reset(self):
         # ignore errors
@@ -120,13 +188,14 @@ class CardConnectionContext:
         verif_admin_pin(self.connection, self.admin_pin)
         verif_admin_pin(self.connection, self.admin_pin)
         reset_card(self.connection)
-        # force re-entering admin PIN
-        self.verified = False
+        self._forget_session()
+        self.result = {'reader': self.reader_index, 'reset': 'applet'}
 
     def cmd_switch_crypto(self,alg_name,key_role):
         self.connect()
         self.verify_admin_pin()
         switch_crypto(self.connection,alg_name,key_role)
+        self.result = {'algorithm': alg_name, 'roles': [key_role]}
 
     def cmd_switch_all_crypto(self,alg_name):
         self.connect()
@@ -134,6 +203,7 @@ class CardConnectionContext:
         switch_crypto(self.connection,alg_name,'sig')
         switch_crypto(self.connection,alg_name,'dec')
         switch_crypto(self.connection,alg_name,'auth')
+        self.result = {'algorithm': alg_name, 'roles': ['sig', 'dec', 'auth']}
 
     def cmd_switch_bp256(self):
         self.cmd_switch_all_crypto('brainpoolP256r1')
@@ -163,6 +233,8 @@ class CardConnectionContext:
         self.cmd_switch_all_crypto('rsa4096')
 
     def cmd_generate_sm_key(self):
+        from pyasn1.type import univ
+        from pyasn1.codec.der import encoder as der_encoder,decoder as der_decoder
         if not self.output:
             print("Missing output file name")
             return
@@ -204,8 +276,11 @@ class CardConnectionContext:
         with open(self.output,"wb") as f:
             f.write(pubkey_der)
             f.close()
+        self.result = {'public_key': bytes(pubkey_der).hex().upper(), 'output': self.output}
 
     def cmd_get_sm_key(self):
+        from pyasn1.type import univ
+        from pyasn1.codec.der import encoder as der_encoder,decoder as der_decoder
         if not self.output:
             print("Missing output file name")
             return
@@ -246,8 +321,10 @@ class CardConnectionContext:
         with open(self.output,"wb") as f:
             f.write(pubkey_der)
             f.close()
+        self.result = {'public_key': bytes(pubkey_der).hex().upper(), 'output': self.output}
 
     def cmd_put_sm_key(self):
+        from pyasn1.codec.der import encoder as der_encoder,decoder as der_decoder
         if self.input is None:
             print("No input key file")
             return
@@ -274,18 +351,54 @@ class CardConnectionContext:
         self.verify_admin_pin()
         switch_crypto(self.connection, curve, 'sm')
         put_sm_key(self.connection, pubkey, privkey)
+        self.result = {'curve': curve}
 
     def cmd_set_resetting_code(self):
         self.connect()
         self.verify_admin_pin()
         resetting_code = self.read_pin("PUK")
-        set_resetting_code(self.connection, resetting_code)
+        (_,sw1,sw2) = set_resetting_code(self.connection,
+                                         self.encode_pin(resetting_code, RESETTING_CODE))
+        self.result = {'resetting_code_set': sw1==0x90 and sw2==0x00}
 
     def cmd_unblock_pin(self):
         self.connect()
         resetting_code = self.read_pin("PUK")
         new_user_pin = self.read_pin("new user")
-        unblock_pin(self.connection, resetting_code, new_user_pin)
+        if new_user_pin is None:
+            print("No new PIN (use --new-pin or -I)")
+            return
+        (_,sw1,sw2) = unblock_pin(self.connection, self.encode_pin(resetting_code, RESETTING_CODE),
+                                  self.encode_pin(new_user_pin, PW1))
+        self.result = {'unblocked': sw1==0x90 and sw2==0x00}
+
+    def cmd_change_user_pin(self):
+        self.connect()
+        user_pin = self.read_pin("User")
+        new_user_pin = self.read_pin("new user")
+        if new_user_pin is None:
+            print("No new PIN (use --new-pin or -I)")
+            return
+        (sw1,sw2) = change_reference_data_pw1(self.connection, self.encode_pin(user_pin, PW1),
+                                              self.encode_pin(new_user_pin, PW1))
+        if sw1!=0x90 or sw2!=0x00:
+            raise UserPINFailed
+        self.user_pin = new_user_pin
+        self.result = {'changed': 'user'}
+
+    def cmd_change_admin_pin(self):
+        self.connect()
+        admin_pin = self.read_pin("Admin")
+        new_admin_pin = self.read_pin("new admin")
+        if new_admin_pin is None:
+            print("No new PIN (use --new-pin or -I)")
+            return
+        (sw1,sw2) = change_reference_data_pw3(self.connection, self.encode_pin(admin_pin, PW3),
+                                              self.encode_pin(new_admin_pin, PW3))
+        if sw1!=0x90 or sw2!=0x00:
+            raise AdminPINFailed
+        self.admin_pin = new_admin_pin
+        self.result = {'changed': 'admin'}
 
     def cmd_put_sign_certificate(self):
         if self.input is None:
@@ -298,6 +411,7 @@ class CardConnectionContext:
         self.connect()
         self.verify_admin_pin()
         put_sign_certificate(self.connection, cert)
+        self.result = {'certificate_length': len(cert)}
 
     def cmd_put_auth_certificate(self):
         if self.input is None:
@@ -310,6 +424,7 @@ class CardConnectionContext:
         self.connect()
         self.verify_admin_pin()
         put_auth_certificate(self.connection, cert)
+        self.result = {'certificate_length': len(cert)}
 
     def cmd_put_sm_certificate(self):
         if self.input is None:
@@ -322,6 +437,7 @@ class CardConnectionContext:
         self.connect()
         self.verify_admin_pin()
         put_sm_certificate(self.connection, cert)
+        self.result = {'certificate_length': len(cert)}
 
     def cmd_get_sm_certificate(self):
         if self.output is None:
@@ -329,6 +445,7 @@ class CardConnectionContext:
             return
         self.connect()
         (cert,_,_) = get_sm_certificate(self.connection)
+        self.result = {'certificate_length': len(cert), 'output': self.output}
         cert = "".join([chr(c) for c in cert])
         with open(self.output, 'w') as f:
             f.write(cert)
@@ -345,44 +462,32 @@ class CardConnectionContext:
         self.connect()
         self.verify_admin_pin()
         put_aes_key(self.connection, key)
+        self.result = {'key_length': len(key)}
 
-    def cmd_encrypt_aes(self):
+    def _run_aes_stream(self, stream_fun, what):
         if self.input is None:
             print("No input data file")
             return
         if self.output is None:
             print("No output data file")
             return
-        f = open(self.input, 'r')
-        data = f.read()
-        data = [ord(c) for c in data]
-        f.close()
         self.connect()
         self.verify_user_pin()
-        (data,_,_) = encrypt_aes(self.connection, data)
-        data = "".join([chr(c) for c in data])
-        with open(self.output, 'w') as f:
-            f.write(data)
-            f.close()
- 
-    def cmd_decrypt_aes(self):
-        if self.input is None:
-            print("No input data file")
+        try:
+            with open(self.input, 'rb') as fin, open(self.output, 'wb') as fout:
+                total = stream_fun(self.connection, fin, fout)
+        except (CardOperationFailed, ValueError) as e:
+            os.remove(self.output)
+            print("%s failed: %s" % (what, e))
             return
-        if self.output is None:
-            print("No output data file")
-            return
-        f = open(self.input, 'r')
-        data = f.read()
-        data = [ord(c) for c in data]
-        f.close()
-        self.connect()
-        self.verify_user_pin()
-        (data,_,_) = decrypt_aes(self.connection, data)
-        data = "".join([chr(c) for c in data])
-        with open(self.output, 'w') as f:
-            f.write(data)
-            f.close()
+        print("%s %d bytes" % (what, total))
+        self.result = {'bytes': total, 'output': self.output}
+
+    def cmd_encrypt_aes(self):
+        self._run_aes_stream(encrypt_aes_stream, "Encrypt AES")
+
+    def cmd_decrypt_aes(self):
+        self._run_aes_stream(decrypt_aes_stream, "Decrypt AES")
 
     def cmd_set_kdf(self):
         if self.input is None:
@@ -395,24 +500,38 @@ class CardConnectionContext:
         self.connect()
         self.verify_admin_pin()
         put_kdf_do(self.connection, kdf_do)
+        self._forget_kdf()
+        self.result = {'kdf': kdf_summary(self.kdf())}
 
     def cmd_get_kdf(self):
         if self.output is None:
             print("No output file")
             return
         self.connect()
-        (kdf_do,_,_) = get_kdf_do(self.connection)
+        (kdf_do,sw1,sw2) = get_kdf_do(self.connection)
+        kdf = parse_kdf_do(kdf_do) if sw1==0x90 and sw2==0x00 else None
+        self.result = {'kdf': kdf_summary(kdf), 'output': self.output}
         kdf_do = "".join([chr(c) for c in kdf_do])
         with open(self.output, 'w') as f:
             f.write(kdf_do)
             f.close()
 
 
+    def cmd_kdf_benchmark(self):
+        target = self.kdf_time if self.kdf_time is not None else 0.1
+        self.result = {'time': target, 'hashes': {}}
+        for algo in (KDF_SHA256, KDF_SHA512):
+            (nbiter,rate) = kdf_benchmark(algo, target)
+            print("%s: %.1f MB/s, %d iterations for %.3f s"
+                  % (KDF_HASHES[algo].upper(), rate / 1e6, nbiter, target))
+            self.result['hashes'][KDF_HASHES[algo]] = {'rate': round(rate), 'iterations': nbiter}
+
     def cmd_setup_kdf(self):
         self.connect()
         (kdf_do,_,_) = get_kdf_do(self.connection)
         if 5 < len(kdf_do):
             print("KDF already setup")
+            self.result = {'kdf': kdf_summary(self.kdf()), 'already_set': True}
             return
         ####### step 1
         pw1 = self.read_pin("User")
@@ -427,8 +546,13 @@ class CardConnectionContext:
         pw3 = pw3
         ####### step 2
         salt_size = 8
-        algo = 0x08 #SHA256
-        nbiter = 200000
+        algo = self.kdf_algo
+        nbiter = self.kdf_iterations
+        if self.kdf_time is not None:
+            (nbiter,_) = kdf_benchmark(algo, self.kdf_time)
+        if not (0 < nbiter <= 0xFFFFFFFF):
+            raise InvalidKDF
+        print("KDF %s with %d iterations" % (KDF_HASHES[algo].upper(), nbiter))
         ndata81 = [0x81, 0x01, 0x03] #KDF_ITERSALTED_S2K
         ndata82 = [0x82, 0x01, algo]
         ndata83 = [0x83, 0x04, nbiter >> 24, (nbiter >> 16) & 0xff, (nbiter >> 8) & 0xff, nbiter & 0xff] #NB ITERATIONS
@@ -460,21 +584,25 @@ class CardConnectionContext:
             self.verified = True
         else:
             raise AdminPINFailed
-        ####### step 3bis
-        if nresetting_code != None:
-            (_,sw1,sw2) = set_resetting_code(self.connection, nresetting_code)
-            if sw1!=0x90 or sw2!=0x00:
-                print("set_resetting_code failed")
-                return
         ####### step 4
         (sw1,sw2) = change_reference_data_pw1(self.connection, ascii_encode_pin(pw1), list(npw1))
         if sw1!=0x90 or sw2!=0x00:
             print("change_reference_data_pw1 failed")
             return
         ####### step 4bis
+        # Only once PW1 is derived: a derived resetting code without the
+        # KDF-DO could never be used
+        if nresetting_code != None:
+            (_,sw1,sw2) = set_resetting_code(self.connection, nresetting_code)
+            if sw1!=0x90 or sw2!=0x00:
+                print("set_resetting_code failed")
+                return
+        ####### step 4ter
         (sw1,sw2) = change_reference_data_pw3(self.connection, ascii_encode_pin(pw3), list(npw3))
         if sw1!=0x90 or sw2!=0x00:
             print("change_reference_data_pw3 failed")
             return
         ####### step 5
         put_kdf_do(self.connection, nkdf_do)
+        self._forget_kdf()
+        self.result = {'kdf': kdf_summary(self.kdf()), 'already_set': False}
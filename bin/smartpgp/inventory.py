@@ -0,0 +1,182 @@
+# SmartPGP : JavaCard implementation of OpenPGP card v3 specification
+# https://github.com/ANSSI-FR/SmartPGP
+# Copyright (C) 2016 ANSSI
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Read everything a card tells without a PIN, for auditing.
+
+One session per card reads the application related data (6E: AID,
+algorithm attributes, PIN status, fingerprints, generation dates), the
+cardholder data (65), the signature counter (7A), the URL (5F50), the KDF-DO,
+the certificates and the private DOs 0101-0104, and decodes them into a
+JSON-friendly dict. Values are stable from one run to the next (no
+timings, binary data as uppercase hex, certificates as SHA-256), so two
+inventories of a fleet can be compared with diff.
+
+Each reader runs on its own thread, so a rack takes as long as its slowest
+card.
+"""
+
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from smartpgp.highlevel import *
+
+
+KEY_ROLES = ('sig', 'dec', 'auth')
+ALGORITHM_IDS = {0x01: 'rsa', 0x12: 'ecdh', 0x13: 'ecdsa', 0x16: 'eddsa'}
+PRIVATE_DOS = (0x0101, 0x0102, 0x0103, 0x0104)
+SEX = {0x31: 'male', 0x32: 'female', 0x39: 'not applicable'}
+
+def _hex(data):
+    return bytes(data).hex().upper()
+
+def _text(data):
+    return bytes(data).decode('utf-8', 'replace')
+
+def _ok(result):
+    (_,sw1,sw2) = result
+    return sw1==0x90 and sw2==0x00
+
+def decode_algorithm(attributes):
+    """Name of algorithm attributes (C1-C3): 'rsa2048', 'ecdsa ansix9p256r1'..."""
+    attributes = list(attributes)
+    if not attributes:
+        return None
+    algo = ALGORITHM_IDS.get(attributes[0], '%02X' % attributes[0])
+    if attributes[0] == 0x01:
+        if len(attributes) < 3:
+            return algo
+        return '%s%d' % (algo, (attributes[1] << 8) | attributes[2])
+    oid = attributes[1:]
+    if oid and oid[-1] == 0xff:
+        oid = oid[:-1]
+    names = [name for name, value in OID_ALGS.items() if value == oid]
+    return '%s %s' % (algo, names[0] if names else _hex(oid))
+
+def decode_application_data(objects):
+    """Decode the objects of DO 6E (from parse_tlv)"""
+    aid = objects.get(0x4F, [])
+    inventory = {'aid': _hex(aid) if aid else None, 'version': None, 'manufacturer': None,
+                 'serial': None}
+    if len(aid) == 16:
+        inventory['version'] = '%d.%d' % (aid[6], aid[7])
+        inventory['manufacturer'] = _hex(aid[8:10])
+        inventory['serial'] = _hex(aid[10:14])
+    inventory['historical_bytes'] = _hex(objects.get(0x5F52, []))
+    inventory['extended_capabilities'] = _hex(objects.get(0xC0, []))
+    fingerprints = objects.get(0xC5, [])
+    ca_fingerprints = objects.get(0xC6, [])
+    dates = objects.get(0xCD, [])
+    inventory['keys'] = {}
+    for i, (role, tag) in enumerate(zip(KEY_ROLES, (0xC1, 0xC2, 0xC3))):
+        fingerprint = fingerprints[20 * i:20 * (i + 1)]
+        date = int.from_bytes(bytes(dates[4 * i:4 * (i + 1)]), 'big')
+        inventory['keys'][role] = {
+            'algorithm': decode_algorithm(objects.get(tag, [])),
+            'attributes': _hex(objects.get(tag, [])),
+            'fingerprint': _hex(fingerprint) if any(fingerprint) else None,
+            'generated': date or None,
+        }
+    inventory['ca_fingerprints'] = []
+    for i in range(len(ca_fingerprints) // 20):
+        fingerprint = ca_fingerprints[20 * i:20 * (i + 1)]
+        inventory['ca_fingerprints'].append(_hex(fingerprint) if any(fingerprint) else None)
+    pw_status = objects.get(0xC4, [])
+    if len(pw_status) >= 7:
+        names = ('user', 'resetting_code', 'admin')
+        inventory['pin_status'] = {
+            'user_pin_valid_for_several_signatures': pw_status[0] == 0x01,
+            'max_length': dict(zip(names, pw_status[1:4])),
+            'retries': dict(zip(names, pw_status[4:7])),
+        }
+    else:
+        inventory['pin_status'] = None
+    return inventory
+
+def decode_cardholder_data(objects):
+    """Decode the objects of DO 65 (from parse_tlv)"""
+    name = _text(objects.get(0x5B, []))
+    sex = objects.get(0x5F35, [])
+    return {
+        # ISO/IEC 7501-1 order: surname<<given names, '<' between words
+        'name': name.replace('<<', ', ').replace('<', ' ') or None,
+        'language': _text(objects.get(0x5F2D, [])) or None,
+        'sex': SEX.get(sex[0], _hex(sex)) if sex else None,
+    }
+
+def read_inventory(ctx):
+    """Inventory of the connected card of ctx"""
+    connection = ctx.connection
+    result = get_data(connection, 0x6E, "Get application related data")
+    if not _ok(result):
+        raise CardOperationFailed("Reading application related data: SW %02X%02X" % result[1:])
+    inventory = decode_application_data(parse_tlv(result[0]))
+    result = get_data(connection, 0x65, "Get cardholder related data")
+    inventory['cardholder'] = decode_cardholder_data(parse_tlv(result[0])) if _ok(result) else None
+    result = get_data(connection, 0x7A, "Get security support template")
+    counter = parse_tlv(result[0]).get(0x93) if _ok(result) else None
+    inventory['signature_counter'] = None if counter is None else int.from_bytes(bytes(counter), 'big')
+    result = get_data(connection, 0x5F50, "Get URL")
+    inventory['url'] = (_text(result[0]) or None) if _ok(result) else None
+    inventory['kdf'] = kdf_summary(ctx.kdf())
+    inventory['certificates'] = {}
+    for role in KEY_ROLES:
+        result = get_certificate(connection, role)
+        cert = bytes(result[0]) if _ok(result) else b''
+        inventory['certificates'][role] = ({'sha256': hashlib.sha256(cert).hexdigest(),
+                                            'length': len(cert)} if cert else None)
+    # 0103 needs the user PIN and 0104 the Admin PIN: None when protected
+    inventory['private_dos'] = {}
+    for tag in PRIVATE_DOS:
+        result = get_data(connection, tag, "Get private DO %04X" % tag)
+        inventory['private_dos']['%04X' % tag] = _hex(result[0]) if _ok(result) else None
+    alias = inventory['private_dos']['0102']
+    inventory['alias'] = (_text(bytes.fromhex(alias)) or None) if alias else None
+    return inventory
+
+def inventory_card(reader_index):
+    """Inventory of the card of one reader, with its 'reader' index, and
+    'status' and 'error' when it could not be read"""
+    card = {'reader': reader_index, 'status': 'ok', 'error': None}
+    ctx = CardConnectionContext()
+    ctx.reader_index = reader_index
+    try:
+        ctx.connect()
+        card.update(read_inventory(ctx))
+    except Exception as e:
+        card['status'] = 'failed'
+        card['error'] = str(e) or type(e).__name__
+    finally:
+        if ctx.connection is not None:
+            try:
+                ctx.connection.disconnect()
+            except Exception:
+                pass
+    return card
+
+def inventory_readers(reader_indexes):
+    """Inventory the cards of all readers concurrently, one thread per
+    reader. Returns the cards in reader order, and the wall-clock time"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, len(reader_indexes))) as executor:
+        cards = list(executor.map(inventory_card, reader_indexes))
+    return {
+        'cards': cards,
+        'failed': sum(1 for c in cards if c['status'] != 'ok'),
+        'time': round(time.perf_counter() - start, 3),
+    }
@@ -0,0 +1,434 @@
+# SmartPGP : JavaCard implementation of OpenPGP card v3 specification
+# https://github.com/ANSSI-FR/SmartPGP
+# Copyright (C) 2016 ANSSI
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Apply a declarative provisioning profile to many cards at once.
+
+A profile is a JSON object, every entry optional:
+
+    {
+        "algorithms": {"sig": "rsa2048", "dec": "rsa2048", "auth": "P-256"},
+        "generate": ["sig", "dec", "auth"],
+        "certificates": {"sig": "sig.der", "auth": "auth.der"},
+        "alias": "token-{serial}",
+        "pins": {"user": "ENV:USER_PIN", "admin": "ENV:ADMIN_PIN",
+                 "resetting_code": "ENV:RESETTING_CODE"},
+        "kdf": {"hash": "sha256", "iterations": 65011712}
+    }
+
+Certificate paths are relative to the profile, "{serial}" and "{reader}"
+in the alias are replaced per card, PINs are the new PINs ("ENV:VARNAME"
+reads an environment variable) and "kdf" may give a "time" in seconds
+instead of "iterations" (benchmarked once on the host).
+
+Each card runs on its own thread, so a rack of readers takes as long as
+its slowest card. Cards are read before being written, and only the data
+objects that differ from the profile are written: provisioning again is
+cheap and spares the card's EEPROM.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from smartpgp.highlevel import *
+
+
+KEY_ROLES = ('sig', 'dec', 'auth')
+CERTIFICATE_WRITERS = {'sig': put_sign_certificate, 'auth': put_auth_certificate}
+RSA_ALGS = ('rsa2048', 'rsa3072', 'rsa4096')
+
+class InvalidProfile(Exception):
+    pass
+
+def _profile_pin(name, value):
+    if not isinstance(value, str) or not value:
+        raise InvalidProfile("PIN '%s' must be a non-empty string" % name)
+    if not value.startswith('ENV:'):
+        return value
+    try:
+        return os.environ[value[4:]]
+    except KeyError:
+        raise InvalidProfile("Environment variable %s not found (PIN '%s')" % (value[4:], name))
+
+def _key_roles(entry, what):
+    for role in entry:
+        if role not in KEY_ROLES:
+            raise InvalidProfile("Invalid key role '%s' in %s (valid: %s)"
+                                 % (role, what, ', '.join(KEY_ROLES)))
+
+def _entry(raw, name, kind, default):
+    value = raw.get(name, default)
+    if not isinstance(value, kind):
+        raise InvalidProfile("'%s' must be a JSON %s"
+                             % (name, 'object' if kind is dict else 'array'))
+    return value
+
+def load_profile(path):
+    """Read and check a profile; certificates are loaded and the KDF
+    iteration count is resolved once for all cards"""
+    try:
+        with open(path, 'r') as f:
+            raw = json.load(f)
+    except (OSError, ValueError) as e:
+        raise InvalidProfile("Cannot read profile %s: %s" % (path, e))
+    if not isinstance(raw, dict):
+        raise InvalidProfile("A profile is a JSON object")
+    unknown = set(raw) - {'algorithms', 'generate', 'certificates', 'alias', 'pins', 'kdf'}
+    if unknown:
+        raise InvalidProfile("Unknown profile entries: %s" % ', '.join(sorted(unknown)))
+    profile = {}
+
+    algorithms = _entry(raw, 'algorithms', dict, {})
+    _key_roles(algorithms, "algorithms")
+    profile['algorithms'] = {}
+    for role in KEY_ROLES:
+        alg = algorithms.get(role)
+        if alg is None:
+            continue
+        if not isinstance(alg, str) or (alg.lower() not in RSA_ALGS and alg not in ALGS_ALIASES):
+            raise InvalidProfile("Unknown algorithm '%s' for %s" % (alg, role))
+        profile['algorithms'][role] = alg.lower() if alg.lower() in RSA_ALGS else alg
+
+    generate = _entry(raw, 'generate', list, [])
+    _key_roles(generate, "generate")
+    profile['generate'] = [role for role in KEY_ROLES if role in generate]
+
+    certificates = {}
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for role, cert_path in _entry(raw, 'certificates', dict, {}).items():
+        if role not in CERTIFICATE_WRITERS:
+            raise InvalidProfile("Certificates can only be stored for: %s"
+                                 % ', '.join(CERTIFICATE_WRITERS))
+        try:
+            with open(os.path.join(base_dir, cert_path), 'rb') as f:
+                certificates[role] = list(f.read())
+        except (OSError, TypeError) as e:
+            raise InvalidProfile("Cannot read %s certificate: %s" % (role, e))
+    profile['certificates'] = certificates
+
+    alias = raw.get('alias')
+    if alias is not None:
+        try:
+            if len(alias.format(serial='00000000', reader=0).encode('ascii')) > 255:
+                raise InvalidProfile("Alias too long (max 255 bytes)")
+        except (AttributeError, KeyError, IndexError, ValueError):
+            raise InvalidProfile("Alias must be ASCII text, with optional {serial} and {reader}")
+    profile['alias'] = alias
+
+    pins = _entry(raw, 'pins', dict, {})
+    unknown = set(pins) - {'user', 'admin', 'resetting_code'}
+    if unknown:
+        raise InvalidProfile("Unknown PINs: %s" % ', '.join(sorted(unknown)))
+    profile['pins'] = {name: _profile_pin(name, value) for name, value in pins.items()}
+
+    kdf = raw.get('kdf')
+    if kdf is not None:
+        if not isinstance(kdf, dict):
+            raise InvalidProfile("'kdf' must be a JSON object")
+        hash_name = kdf.get('hash', 'sha256')
+        algo = {name: algo for algo, name in KDF_HASHES.items()}.get(hash_name)
+        if algo is None:
+            raise InvalidProfile("Unknown KDF hash '%s'" % hash_name)
+        try:
+            if 'time' in kdf:
+                (iterations,_) = kdf_benchmark(algo, float(kdf['time']))
+            else:
+                iterations = int(kdf.get('iterations', KDF_DEFAULT_ITERATIONS))
+        except (TypeError, ValueError):
+            raise InvalidProfile("KDF 'time' and 'iterations' must be numbers")
+        if not (0 < iterations <= 0xFFFFFFFF):
+            raise InvalidProfile("Invalid KDF iteration count %d" % iterations)
+        kdf = {'algo': algo, 'iterations': iterations}
+    profile['kdf'] = kdf
+    return profile
+
+def _check(result, what):
+    (_,sw1,sw2) = result
+    if sw1!=0x90 or sw2!=0x00:
+        raise CardOperationFailed("%s failed: SW=%02X%02X" % (what, sw1, sw2))
+
+def _card_steps(ctx, profile, reader_index, dry_run=False):
+    """(name, function) steps applying the profile to the connected card.
+
+    PINs change after everything that needs the current Admin PIN, and the
+    KDF comes last: it derives the PINs in place."""
+    steps = []
+    for role, alg in profile['algorithms'].items():
+        steps.append(("algorithm %s %s" % (role, alg), lambda role=role, alg=alg:
+                      _check(switch_crypto(ctx.connection, alg, role), "Algorithm change")))
+    for role in profile['generate']:
+        steps.append(("generate %s" % role, lambda role=role:
+                      _check(generate_key_pair(ctx.connection, role), "Key generation")))
+    for role, cert in profile['certificates'].items():
+        steps.append(("certificate %s" % role, lambda role=role, cert=cert:
+                      _check(CERTIFICATE_WRITERS[role](ctx.connection, cert), "Certificate write")))
+    if profile['alias'] is not None:
+        def put_alias():
+            alias = profile['alias'].format(serial=ctx.card_serial().hex().upper(),
+                                            reader=reader_index)
+            _check(put_data(ctx.connection, 0x0102, alias.encode('ascii'), "Put key alias"),
+                   "Alias write")
+        steps.append(("alias", put_alias))
+    pins = profile['pins']
+    if 'resetting_code' in pins and profile['kdf'] is None:
+        # else the KDF setup sets it
+        steps.append(("resetting code", lambda: _check(set_resetting_code(
+            ctx.connection, ctx.encode_pin(pins['resetting_code'], RESETTING_CODE)),
+            "Resetting code change")))
+    if 'user' in pins:
+        def change_user_pin():
+            ctx.new_pin = pins['user']
+            ctx.cmd_change_user_pin()
+        steps.append(("user PIN", change_user_pin))
+    if 'admin' in pins:
+        def change_admin_pin():
+            ctx.new_pin = pins['admin']
+            ctx.cmd_change_admin_pin()
+        steps.append(("admin PIN", change_admin_pin))
+    if profile['kdf'] is not None:
+        def setup_kdf():
+            ctx.kdf_algo = profile['kdf']['algo']
+            ctx.kdf_iterations = profile['kdf']['iterations']
+            ctx.resetting_code = pins.get('resetting_code')
+            ctx.cmd_setup_kdf()
+            ctx._forget_kdf()
+            if not dry_run and ctx.kdf() is None:
+                raise CardOperationFailed("KDF setup failed")
+        steps.append(("KDF", setup_kdf))
+    return steps
+
+def _attributes_key(attributes):
+    """Comparable part of algorithm attributes: RSA modulus size, or the
+    algorithm and curve OID"""
+    attributes = list(attributes)
+    if attributes[:1] == [0x01]:
+        return tuple(attributes[:3])
+    while attributes and attributes[-1] == 0xff:
+        attributes.pop()
+    return tuple(attributes)
+
+def snapshot_card(ctx, profile, probe_user_pin=True):
+    """Current state of what the profile sets, read in one session: algorithm
+    attributes, fingerprints and PIN retry counters (from DO 6E), the KDF-DO,
+    and the alias, public keys and certificates the profile mentions.
+
+    With probe_user_pin, 'user_pin_set' tells whether the card has the
+    profile's user PIN (True), still the current one, ctx.user_pin (False),
+    or neither (None). The current PIN is verified first, so a fresh card
+    loses no try; on a card already provisioned, the profile's PIN then
+    succeeds and resets the retry counter. The probe only runs with at least
+    3 tries left, so an unknown PIN never blocks the card."""
+    (data,sw1,sw2) = get_data(ctx.connection, 0x6E, "Get application related data")
+    _check((data,sw1,sw2), "Reading application related data")
+    objects = parse_tlv(data)
+    snapshot = {'reader': ctx.reader_index, 'serial': ctx.card_serial().hex().upper(),
+                'algorithms': {}, 'fingerprints': {}, 'keys': {}, 'certificates': {}}
+    fingerprints = objects.get(0xC5, [])
+    for i, (role, tag) in enumerate(zip(KEY_ROLES, (0xC1, 0xC2, 0xC3))):
+        snapshot['algorithms'][role] = bytes(objects.get(tag, [])).hex().upper()
+        fingerprint = bytes(fingerprints[20 * i:20 * (i + 1)])
+        snapshot['fingerprints'][role] = fingerprint.hex().upper() if any(fingerprint) else None
+    pw_status = objects.get(0xC4, [])
+    retries = pw_status[4:7] if len(pw_status) >= 7 else [None] * 3
+    snapshot['pin_retries'] = dict(zip(('user', 'resetting_code', 'admin'), retries))
+    snapshot['kdf'] = kdf_summary(ctx.kdf())
+    if profile['alias'] is not None:
+        (alias,sw1,sw2) = get_data(ctx.connection, 0x0102, "Get key alias")
+        snapshot['alias'] = bytes(alias).decode('ascii', 'replace') if sw1==0x90 and sw2==0x00 else None
+    for role in profile['generate']:
+        (key,sw1,sw2) = get_public_key(ctx.connection, role)
+        snapshot['keys'][role] = (hashlib.sha256(bytes(key)).hexdigest()
+                                  if sw1==0x90 and sw2==0x00 and key else None)
+    for role in profile['certificates']:
+        (cert,sw1,sw2) = get_certificate(ctx.connection, role)
+        snapshot['certificates'][role] = (hashlib.sha256(bytes(cert)).hexdigest()
+                                          if sw1==0x90 and sw2==0x00 and cert else None)
+    pins = profile['pins']
+    if probe_user_pin and 'user' in pins and (snapshot['pin_retries']['user'] or 0) >= 3:
+        snapshot['user_pin_set'] = None
+        for pin in [ctx.user_pin] + ([pins['user']] if pins['user'] != ctx.user_pin else []):
+            (_,sw1,sw2) = verif_user_pin(ctx.connection, ctx.encode_pin(pin, PW1))
+            if sw1==0x90 and sw2==0x00:
+                snapshot['user_pin_set'] = pin == pins['user']
+                break
+    return snapshot
+
+def diff_profile(snapshot, profile, admin_pin):
+    """The part of the profile that changes the card, as a profile.
+
+    Keys are generated in empty slots and in slots whose algorithm changes.
+    PINs cannot be read: the Admin PIN changes unless it is the current one,
+    the resetting code is only set on a card without one, and the user PIN
+    changes unless snapshot_card found it already set. A KDF is only set up
+    on a card without one."""
+    diff = {'algorithms': {}, 'generate': [], 'certificates': {}, 'alias': None, 'pins': {},
+            'kdf': None}
+    for role, alg in profile['algorithms'].items():
+        current = bytes.fromhex(snapshot['algorithms'][role])
+        if _attributes_key(current) != _attributes_key(algorithm_attributes(alg, role)):
+            diff['algorithms'][role] = alg
+    diff['generate'] = [role for role in profile['generate']
+                        if snapshot['keys'].get(role) is None or role in diff['algorithms']]
+    for role, cert in profile['certificates'].items():
+        if snapshot['certificates'].get(role) != hashlib.sha256(bytes(cert)).hexdigest():
+            diff['certificates'][role] = cert
+    if profile['alias'] is not None:
+        alias = profile['alias'].format(serial=snapshot['serial'], reader=snapshot['reader'])
+        if snapshot.get('alias') != alias:
+            diff['alias'] = profile['alias']
+    pins = profile['pins']
+    if 'resetting_code' in pins and not snapshot['pin_retries']['resetting_code']:
+        diff['pins']['resetting_code'] = pins['resetting_code']
+    if 'user' in pins and not snapshot.get('user_pin_set'):
+        diff['pins']['user'] = pins['user']
+    if 'admin' in pins and pins['admin'] != admin_pin:
+        diff['pins']['admin'] = pins['admin']
+    if profile['kdf'] is not None and snapshot['kdf'] is None:
+        diff['kdf'] = profile['kdf']
+        # Setting up the KDF derives the resetting code it is given
+        if 'resetting_code' in pins:
+            diff['pins']['resetting_code'] = pins['resetting_code']
+    return diff
+
+def _verify_admin_pin(ctx, profile):
+    """Verify the Admin PIN of the run, else the profile's one: an earlier
+    run may have changed it before failing (the right PIN resets the retry
+    counter the wrong one took)"""
+    try:
+        ctx.verify_admin_pin()
+    except AdminPINFailed:
+        new_pin = profile['pins'].get('admin')
+        if new_pin is None or new_pin == ctx.admin_pin:
+            raise
+        ctx.admin_pin = new_pin
+        ctx.verify_admin_pin()
+
+def _format_apdu(apdu):
+    """APDU in hex, PIN data masked"""
+    from smartcard.util import toHexString
+    pin_data = apdu[1] in (0x20, 0x24, 0x2C) or (apdu[1] == 0xDA and apdu[2:4] == [0x00, 0xD3])
+    if pin_data and len(apdu) > 5:
+        return "%s <%d bytes of PIN data>" % (toHexString(apdu[:5]), len(apdu) - 5)
+    return toHexString(apdu)
+
+class _DryRunConnection:
+    """Card connection sending the reads (GET DATA, GET RESPONSE, reading
+    public keys) and recording the other APDUs instead of sending them"""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.planned = []
+
+    def transmit(self, apdu):
+        apdu = list(apdu)
+        if apdu[1] in (0xCA, 0xC0) or apdu[1:3] == [0x47, 0x81]:
+            return self._connection.transmit(apdu)
+        self.planned.append(_format_apdu(apdu))
+        return [], 0x90, 0x00
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+def provision_card(reader_index, profile, admin_pin, user_pin="123456", progress=None,
+                   dry_run=False):
+    """Apply the profile to the card of one reader, returns its report.
+
+    The card is read first and only what differs from the profile is
+    written (see diff_profile). With dry_run, nothing is written: the
+    report lists the APDUs each step would send (the user PIN is not probed,
+    so its change is always listed)."""
+    report = {'reader': reader_index, 'serial': None, 'status': 'ok', 'error': None,
+              'snapshot': None, 'steps': []}
+    start = time.perf_counter()
+    ctx = CardConnectionContext()
+    ctx.reader_index = reader_index
+    ctx.admin_pin = admin_pin
+    ctx.user_pin = user_pin
+    step = "connect"
+    try:
+        ctx.connect()
+        report['serial'] = ctx.card_serial().hex().upper()
+        step = "snapshot"
+        snapshot = snapshot_card(ctx, profile, probe_user_pin=not dry_run)
+        report['snapshot'] = snapshot
+        # Steps run with the PINs the card has now
+        if snapshot.get('user_pin_set'):
+            ctx.user_pin = profile['pins']['user']
+        elif 'user_pin_set' in snapshot and snapshot['user_pin_set'] is None:
+            raise UserPINFailed("the user PIN is neither %s nor the profile's" % user_pin)
+        diff = diff_profile(snapshot, profile, ctx.admin_pin)
+        if not dry_run and _card_steps(ctx, diff, reader_index):
+            step = "admin PIN verification"
+            _verify_admin_pin(ctx, profile)
+            diff = diff_profile(snapshot, profile, ctx.admin_pin)
+        steps = _card_steps(ctx, diff, reader_index, dry_run)
+        if progress is not None:
+            progress(reader_index, "%d changes (read in %.1f s)"
+                     % (len(steps), time.perf_counter() - start))
+        if dry_run:
+            ctx.connection = _DryRunConnection(ctx.connection)
+        for step, run in steps:
+            step_start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - step_start
+            if dry_run:
+                report['steps'].append({'step': step, 'apdus': ctx.connection.planned})
+                ctx.connection.planned = []
+            else:
+                report['steps'].append({'step': step, 'time': round(elapsed, 3)})
+            if progress is not None:
+                progress(reader_index, "%s (%.1f s)" % (step, elapsed))
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = "%s: %s" % (step, str(e) or type(e).__name__)
+        if progress is not None:
+            progress(reader_index, "FAILED %s" % report['error'])
+    finally:
+        if ctx.connection is not None:
+            try:
+                ctx.connection.disconnect()
+            except Exception:
+                pass
+    report['time'] = round(time.perf_counter() - start, 3)
+    return report
+
+def provision_readers(reader_indexes, profile, admin_pin, user_pin="123456", progress=None,
+                      dry_run=False):
+    """Provision the cards of all readers concurrently, one thread per
+    reader. Returns the report: per-card results in reader order, the
+    wall-clock time and the summed card time."""
+    lock = threading.Lock()
+    def locked_progress(reader_index, text):
+        with lock:
+            progress(reader_index, text)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, len(reader_indexes))) as executor:
+        cards = list(executor.map(
+            lambda i: provision_card(i, profile, admin_pin, user_pin,
+                                     locked_progress if progress is not None else None, dry_run),
+            reader_indexes))
+    return {
+        'cards': cards,
+        'succeeded': sum(1 for c in cards if c['status'] == 'ok'),
+        'failed': sum(1 for c in cards if c['status'] != 'ok'),
+        'time': round(time.perf_counter() - start, 3),
+        'card_time': round(sum(c['time'] for c in cards), 3),
+    }
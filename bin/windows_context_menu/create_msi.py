@@ -152,6 +152,16 @@ include_files = [
     ('handlers/change_pin_handler.py', 'handlers/change_pin_handler.py'),
     ('handlers/rsa_crypto.py', 'handlers/rsa_crypto.py'),
     ('handlers/rsa_decrypt.py', 'handlers/rsa_decrypt.py'),
+    ('handlers/enc_format.py', 'handlers/enc_format.py'),
+    ('handlers/key_wrap.py', 'handlers/key_wrap.py'),
+    ('handlers/key_cache.py', 'handlers/key_cache.py'),
+    ('handlers/compression.py', 'handlers/compression.py'),
+    ('handlers/enc_checkpoint.py', 'handlers/enc_checkpoint.py'),
+    ('handlers/openpgp_stream.py', 'handlers/openpgp_stream.py'),
+    ('handlers/enc_archive.py', 'handlers/enc_archive.py'),
+    ('handlers/card_sign.py', 'handlers/card_sign.py'),
+    ('handlers/sign_manifest.py', 'handlers/sign_manifest.py'),
+    ('handlers/ssh_agent.py', 'handlers/ssh_agent.py'),
     ('handlers/debug_logger.py', 'handlers/debug_logger.py'),
     ('handlers/__init__.py', 'handlers/__init__.py'),
     ('requirements.txt', 'requirements.txt'),
@@ -5,9 +5,6 @@ This module reads the public key directly from the SmartPGP card using APDUs,
 without relying on GPG keyring.
 """
 
-import sys
-from smartcard.util import toHexString
-
 # Import debug logger
 try:
     from debug_logger import get_logger
@@ -30,6 +27,22 @@ KEY_SLOTS = {
     'authentication': 0xA4  # Authentication key
 }
 
+# Algorithm IDs from the algorithm attributes DO (OpenPGP card 3.4, 4.4.3.9)
+ALGO_RSA = 0x01
+ALGO_ECDH = 0x12
+ALGO_ECDSA = 0x13
+ALGO_EDDSA = 0x16
+
+# Curve OIDs as stored in algorithm attributes -> cryptography curve class name
+EC_CURVES = {
+    bytes([0x2A, 0x86, 0x48, 0xCE, 0x3D, 0x03, 0x01, 0x07]): 'SECP256R1',
+    bytes([0x2B, 0x81, 0x04, 0x00, 0x22]): 'SECP384R1',
+    bytes([0x2B, 0x81, 0x04, 0x00, 0x23]): 'SECP521R1',
+    bytes([0x2B, 0x24, 0x03, 0x03, 0x02, 0x08, 0x01, 0x01, 0x07]): 'BrainpoolP256R1',
+    bytes([0x2B, 0x24, 0x03, 0x03, 0x02, 0x08, 0x01, 0x01, 0x0B]): 'BrainpoolP384R1',
+    bytes([0x2B, 0x24, 0x03, 0x03, 0x02, 0x08, 0x01, 0x01, 0x0D]): 'BrainpoolP512R1',
+}
+
 
 def assemble_apdu_with_len(prefix, data):
     """Assemble APDU command with proper length encoding"""
@@ -64,6 +77,28 @@ def parse_tlv_length(data, offset):
         return 0, 0
 
 
+def curve_oid_from_attributes(attributes):
+    """Curve OID of EC algorithm attributes (algorithm ID || OID [|| import format])"""
+    oid = bytes(attributes[1:])
+    # Optional trailing "import format" byte (0xFF = public key included)
+    if oid and oid[-1] == 0xFF:
+        oid = oid[:-1]
+    return oid
+
+
+def ec_curve(curve_oid):
+    """cryptography curve object for a curve OID, or None if unsupported"""
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    name = EC_CURVES.get(bytes(curve_oid))
+    return getattr(ec, name)() if name else None
+
+
+def ec_curve_oid(curve):
+    """Curve OID of a cryptography curve object, or None if unsupported"""
+    return next((oid for oid, name in EC_CURVES.items() if name == type(curve).__name__), None)
+
+
 def read_public_key_from_card(card, key_slot='encryption'):
     """
     Read the public key from the SmartPGP card using APDU commands.
@@ -75,6 +110,8 @@ def read_public_key_from_card(card, key_slot='encryption'):
     Returns:
         bytes: Raw public key data in OpenPGP format, or None on error
     """
+    from smartcard.util import toHexString
+
     try:
         if key_slot not in KEY_SLOTS:
             logger.error(f"Invalid key slot: {key_slot}. Must be one of: {list(KEY_SLOTS.keys())}")
@@ -150,6 +187,24 @@ def read_public_key_from_card(card, key_slot='encryption'):
         return None
 
 
+def public_key_fingerprint(key_data):
+    """
+    Compute the fingerprint identifying a card key in encrypted file headers.
+
+    This is the SHA-1 of the public key DO (7F49) returned by the card. It is
+    used instead of the OpenPGP fingerprint DOs (C7-C9) because those are
+    only set when the key is generated through GnuPG.
+
+    Args:
+        key_data: Raw bytes from GET PUBLIC KEY response
+
+    Returns:
+        bytes: 20-byte fingerprint
+    """
+    import hashlib
+    return hashlib.sha1(bytes(key_data)).digest()
+
+
 def extract_rsa_public_key_components(key_data):
     """
     Extract RSA public key components (n, e) from OpenPGP card response.
@@ -226,90 +281,320 @@ def extract_rsa_public_key_components(key_data):
         return None, None
 
 
-def convert_to_pgp_format(modulus, exponent):
+def extract_ec_public_point(key_data):
+    """
+    Extract the EC public point from OpenPGP card response.
+
+    Args:
+        key_data: Raw bytes from GET PUBLIC KEY response
+
+    Returns:
+        bytes: Uncompressed point (04 || X || Y), or None on error
+    """
+    try:
+        # Expected structure: 7F49 Len [86 Len point]
+        offset = 0
+        if len(key_data) >= 2 and key_data[0] == 0x7F and key_data[1] == 0x49:
+            offset = 2
+            _, len_bytes = parse_tlv_length(key_data, offset)
+            offset += len_bytes
+
+        if offset >= len(key_data) or key_data[offset] != 0x86:
+            logger.error("Could not find EC public point (tag 0x86) in response")
+            return None
+        offset += 1
+        point_len, len_bytes = parse_tlv_length(key_data, offset)
+        offset += len_bytes
+        if point_len == 0 or offset + point_len > len(key_data):
+            logger.error(f"Invalid EC point length: {point_len}")
+            return None
+
+        point = bytes(key_data[offset:offset + point_len])
+        logger.debug(f"EC public point length: {len(point)} bytes")
+        return point
+
+    except Exception as e:
+        logger.error(f"Error extracting EC public point: {e}", e)
+        return None
+
+
+def read_algorithm_attributes(card, key_slot='encryption'):
+    """
+    Read the algorithm attributes DO (C1/C2/C3) of a key slot.
+
+    Args:
+        card: AEPGPCard object with active connection
+        key_slot: Which key to query ('signature', 'encryption', or 'authentication')
+
+    Returns:
+        bytes: Algorithm attributes (first byte is the algorithm ID), or None on error
+    """
+    tags = {'signature': 0xC1, 'encryption': 0xC2, 'authentication': 0xC3}
+    try:
+        tag = tags[key_slot]
+        get_data_cmd = [0x00, 0xCA, 0x00, tag, 0x00]
+        response, sw1, sw2 = card.connection.transmit(get_data_cmd)
+        card._log_apdu(get_data_cmd, response, sw1, sw2)
+
+        if sw1 != 0x90 or sw2 != 0x00 or not response:
+            logger.error(f"Failed to read algorithm attributes: SW={sw1:02X}{sw2:02X}")
+            return None
+
+        # The applet answers with the full TLV (tag, length, attributes)
+        if response[0] == tag:
+            attr_len, len_bytes = parse_tlv_length(response, 1)
+            response = response[1 + len_bytes:1 + len_bytes + attr_len]
+
+        return bytes(response)
+
+    except Exception as e:
+        logger.error(f"Error reading algorithm attributes: {e}", e)
+        return None
+
+
+def read_openpgp_fingerprint(card, key_slot='encryption'):
+    """
+    Read the OpenPGP v4 fingerprint of a key slot (DO C5).
+
+    Args:
+        card: AEPGPCard object with active connection
+        key_slot: Which key to query ('signature', 'encryption', or 'authentication')
+
+    Returns:
+        bytes: 20-byte fingerprint, or None if not set or on error
+    """
+    index = {'signature': 0, 'encryption': 1, 'authentication': 2}[key_slot]
+    try:
+        get_data_cmd = [0x00, 0xCA, 0x00, 0xC5, 0x00]
+        response, sw1, sw2 = card.connection.transmit(get_data_cmd)
+        card._log_apdu(get_data_cmd, response, sw1, sw2)
+        if sw1 != 0x90 or sw2 != 0x00 or len(response) < 60:
+            logger.error(f"Failed to read key fingerprints: SW={sw1:02X}{sw2:02X}")
+            return None
+        fingerprint = bytes(response[index * 20:(index + 1) * 20])
+        if not any(fingerprint):
+            return None
+        return fingerprint
+    except Exception as e:
+        logger.error(f"Error reading key fingerprints: {e}", e)
+        return None
+
+
+def read_key_generation_time(card, key_slot='encryption'):
+    """
+    Read the generation time of a key slot (DO CD).
+
+    Args:
+        card: AEPGPCard object with active connection
+        key_slot: Which key to query ('signature', 'encryption', or 'authentication')
+
+    Returns:
+        int: Unix timestamp, or None if not set or on error
+    """
+    index = {'signature': 0, 'encryption': 1, 'authentication': 2}[key_slot]
+    try:
+        get_data_cmd = [0x00, 0xCA, 0x00, 0xCD, 0x00]
+        response, sw1, sw2 = card.connection.transmit(get_data_cmd)
+        card._log_apdu(get_data_cmd, response, sw1, sw2)
+        if sw1 != 0x90 or sw2 != 0x00 or len(response) < 12:
+            logger.error(f"Failed to read key generation dates: SW={sw1:02X}{sw2:02X}")
+            return None
+        timestamp = int.from_bytes(bytes(response[index * 4:(index + 1) * 4]), 'big')
+        return timestamp or None
+    except Exception as e:
+        logger.error(f"Error reading key generation dates: {e}", e)
+        return None
+
+
+class PublicKeyRecord:
     """
-    Convert RSA public key components to OpenPGP public key object.
+    Public key of a card key slot, parsed once from its 7F49 response.
 
-    This constructs an OpenPGP v4 public key packet manually and parses it with PGPy.
+    A record holds the raw key material (RSA n/e or the EC point), the
+    fingerprint and the creation time, and cannot be modified. The
+    cryptography key object and the OpenPGP public key packet are built on
+    first use and kept, so use public_key_record() to share records between
+    callers instead of creating them directly.
+    """
+
+    __slots__ = ('key_data', 'attributes', 'algorithm', 'modulus', 'exponent', 'point',
+                 'curve_oid', 'fingerprint', 'created', '_public_key', '_packet')
+
+    def __init__(self, key_data, attributes=None, created=0):
+        """
+        Args:
+            key_data: Raw bytes from GET PUBLIC KEY response
+            attributes: Algorithm attributes of the key slot, or None to assume RSA
+            created: Creation time (Unix timestamp) for the OpenPGP packet
+
+        Raises:
+            ValueError: If the response holds no key of the attributes' algorithm
+        """
+        attributes = bytes(attributes) if attributes else None
+        algorithm = attributes[0] if attributes else ALGO_RSA
+        modulus = exponent = point = curve_oid = None
+        if algorithm == ALGO_RSA:
+            modulus, exponent = extract_rsa_public_key_components(key_data)
+            if not modulus or not exponent:
+                raise ValueError("no RSA modulus and exponent in public key data")
+        elif algorithm in (ALGO_ECDH, ALGO_ECDSA, ALGO_EDDSA):
+            curve_oid = curve_oid_from_attributes(attributes)
+            point = extract_ec_public_point(key_data)
+            if not point:
+                raise ValueError("no EC public point in public key data")
+        else:
+            raise ValueError(f"unknown key algorithm 0x{algorithm:02X}")
+        for name, value in (('key_data', bytes(key_data)), ('attributes', attributes),
+                            ('algorithm', algorithm), ('modulus', modulus),
+                            ('exponent', exponent), ('point', point), ('curve_oid', curve_oid),
+                            ('fingerprint', public_key_fingerprint(key_data)),
+                            ('created', created), ('_public_key', None), ('_packet', None)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"PublicKeyRecord is read-only (cannot set {name})")
+
+    def public_key(self):
+        """cryptography public key object, or None for an unsupported curve"""
+        if self._public_key is None:
+            if self.algorithm == ALGO_RSA:
+                from cryptography.hazmat.primitives.asymmetric import rsa
+
+                numbers = rsa.RSAPublicNumbers(int.from_bytes(self.exponent, 'big'),
+                                               int.from_bytes(self.modulus, 'big'))
+                public_key = numbers.public_key()
+            else:
+                from cryptography.hazmat.primitives.asymmetric import ec
+
+                curve = ec_curve(self.curve_oid)
+                if curve is None:
+                    return None
+                public_key = ec.EllipticCurvePublicKey.from_encoded_point(curve, self.point)
+            object.__setattr__(self, '_public_key', public_key)
+        return self._public_key
+
+    def openpgp_packet(self):
+        """
+        OpenPGP v4 public key packet (RFC 4880, 5.5.2), built without PGPy.
+
+        Returns:
+            bytes: Packet with its header, or None if OpenPGP has no encoding
+                   for the key (EdDSA, ECDH on a curve without KDF parameters)
+        """
+        if self._packet is None:
+            from openpgp_stream import (public_key_body, PUBKEY_RSA, PUBKEY_ECDH, PUBKEY_ECDSA,
+                                        ECDH_KDF_PARAMS)
+
+            if self.algorithm == ALGO_RSA:
+                body = public_key_body(PUBKEY_RSA, self.created, [self.modulus, self.exponent])
+            elif self.algorithm == ALGO_ECDSA:
+                body = public_key_body(PUBKEY_ECDSA, self.created, [self.point], self.curve_oid)
+            elif self.algorithm == ALGO_ECDH and self.curve_oid in ECDH_KDF_PARAMS:
+                body = public_key_body(PUBKEY_ECDH, self.created, [self.point], self.curve_oid)
+            else:
+                return None
+            object.__setattr__(self, '_packet', _public_key_packet(body))
+        return self._packet
+
+    def openpgp_fingerprint(self):
+        """OpenPGP v4 fingerprint (SHA-1 of the packet), or None if there is no packet"""
+        import hashlib
+
+        packet = self.openpgp_packet()
+        return hashlib.sha1(packet).digest() if packet else None
+
+
+# Records by (fingerprint, attributes, creation time), see public_key_record()
+_public_key_records = {}
+
+
+def public_key_record(key_data, attributes=None, created=0):
+    """
+    Shared PublicKeyRecord of a GET PUBLIC KEY response.
+
+    The same key gives the same record, so its key object and OpenPGP
+    packet are only built once per process.
 
     Args:
-        modulus: RSA modulus (n) as bytes
-        exponent: RSA exponent (e) as bytes
+        key_data: Raw bytes from GET PUBLIC KEY response
+        attributes: Algorithm attributes of the key slot, or None to assume RSA
+        created: Creation time (Unix timestamp) for the OpenPGP packet
+
+    Returns:
+        PublicKeyRecord, or None if the key cannot be parsed
+    """
+    attributes = bytes(attributes) if attributes else None
+    key = (public_key_fingerprint(key_data), attributes, created)
+    record = _public_key_records.get(key)
+    if record is None:
+        try:
+            record = PublicKeyRecord(key_data, attributes, created)
+        except ValueError as e:
+            logger.error(f"Cannot parse public key: {e}")
+            return None
+        record = _public_key_records.setdefault(key, record)
+    return record
+
+
+def read_public_key_record(card, key_slot='encryption'):
+    """
+    Read the public key and algorithm attributes of a key slot.
+
+    The record is kept on the card object (AEPGPCard.key_records), so
+    reading the same slot again in one session sends no APDU. Its creation
+    time is the slot's key generation date (DO CD), or 0 if not set.
+
+    Args:
+        card: AEPGPCard object with active connection
+        key_slot: Which key to read ('signature', 'encryption', or 'authentication')
+
+    Returns:
+        PublicKeyRecord, or None on error
+    """
+    records = getattr(card, 'key_records', None)
+    if records is not None and key_slot in records:
+        return records[key_slot]
+    key_data = read_public_key_from_card(card, key_slot)
+    if not key_data:
+        return None
+    created = read_key_generation_time(card, key_slot) or 0
+    record = public_key_record(key_data, read_algorithm_attributes(card, key_slot), created)
+    if record is not None and records is not None:
+        records[key_slot] = record
+    return record
+
+
+def _public_key_packet(body):
+    """Old format public key packet (tag 6) with a two-byte length"""
+    import struct
+
+    return b'\x99' + struct.pack('>H', len(body)) + body
+
+
+def convert_to_pgp_format(record):
+    """
+    Convert a card public key to an OpenPGP public key object.
+
+    The OpenPGP v4 public key packet is the record's own
+    (PublicKeyRecord.openpgp_packet()), so it is built once per key and
+    then parsed with PGPy, which is only needed by callers wanting a PGPKey
+    object.
+
+    Args:
+        record: PublicKeyRecord of the key slot
 
     Returns:
         PGPKey: PGPy public key object, or None on error
     """
     try:
         import pgpy
-        import struct
-        from datetime import datetime
-        import io
 
-        logger.info("Converting RSA components to PGP key object...")
-
-        logger.debug(f"RSA modulus length: {len(modulus)} bytes ({len(modulus)*8} bits)")
-        logger.debug(f"RSA exponent length: {len(exponent)} bytes")
-
-        # Construct OpenPGP v4 public key packet
-        # Reference: RFC 4880 section 5.5.2
-
-        # Packet format:
-        # - Version (1 byte): 0x04
-        # - Creation time (4 bytes): Unix timestamp
-        # - Algorithm (1 byte): 0x01 for RSA (Encrypt or Sign)
-        # - RSA n (MPI format): bit length (2 bytes) + data
-        # - RSA e (MPI format): bit length (2 bytes) + data
-
-        packet = io.BytesIO()
-
-        # Version
-        packet.write(b'\x04')
-
-        # Creation time (use current time)
-        created = int(datetime.utcnow().timestamp())
-        packet.write(struct.pack('>I', created))
-
-        # Algorithm: RSA Encrypt-Only (0x03)
-        # This tells PGPy the key is specifically for encryption
-        packet.write(b'\x03')
-
-        # Write MPI (Multi-Precision Integer) for modulus
-        # MPI format: 2-byte bit length + data (big-endian)
-        n_bits = len(modulus) * 8
-        # Remove leading zero bytes
-        modulus_clean = modulus.lstrip(b'\x00')
-        # Recalculate bit length for cleaned modulus
-        if modulus_clean:
-            n_bits = (len(modulus_clean) - 1) * 8 + modulus_clean[0].bit_length()
-        packet.write(struct.pack('>H', n_bits))
-        packet.write(modulus_clean)
-
-        # Write MPI for exponent
-        e_bits = len(exponent) * 8
-        exponent_clean = exponent.lstrip(b'\x00')
-        if exponent_clean:
-            e_bits = (len(exponent_clean) - 1) * 8 + exponent_clean[0].bit_length()
-        packet.write(struct.pack('>H', e_bits))
-        packet.write(exponent_clean)
-
-        # Get the packet data
-        packet_data = packet.getvalue()
-        logger.debug(f"Constructed packet size: {len(packet_data)} bytes")
-
-        # Create OpenPGP packet with proper header
-        # Old format packet header for public key (tag 6)
-        # If packet length > 255, use 2-byte length format
-        packet_len = len(packet_data)
-
-        if packet_len < 256:
-            # Short length format: tag byte + 1-byte length
-            header = bytes([0x99, packet_len])
-        else:
-            # Long length format: tag byte + 2-byte length
-            header = bytes([0x99]) + struct.pack('>H', packet_len)
+        logger.info("Converting card public key to PGP key object...")
 
-        # Complete packet
-        full_packet = header + packet_data
+        full_packet = record.openpgp_packet()
+        if full_packet is None:
+            logger.error("Card key has no OpenPGP public key packet")
+            return None
 
         logger.debug(f"Full packet size: {len(full_packet)} bytes")
         logger.debug(f"Packet header: {full_packet[:10].hex()}")
@@ -317,7 +602,7 @@ def convert_to_pgp_format(modulus, exponent):
         # Parse the packet with PGPy
         key, _ = pgpy.PGPKey.from_blob(full_packet)
 
-        logger.info("Successfully created PGP key object from RSA components")
+        logger.info("Successfully created PGP key object from card public key")
         logger.debug(f"Key fingerprint: {key.fingerprint}")
 
         # Add an unsigned User ID by directly modifying the key's internal structure
@@ -363,20 +648,17 @@ def read_pgp_public_key_from_card(card, key_slot='encryption'):
     try:
         logger.info(f"Reading PGP public key from card (slot: {key_slot})...")
 
-        # Read raw public key data from card
-        key_data = read_public_key_from_card(card, key_slot)
-        if not key_data:
+        # Read and parse the public key once per card session
+        record = read_public_key_record(card, key_slot)
+        if record is None:
             logger.error("Failed to read public key from card")
             return None
-
-        # Extract RSA components
-        modulus, exponent = extract_rsa_public_key_components(key_data)
-        if not modulus or not exponent:
-            logger.error("Failed to extract RSA components")
+        if record.algorithm != ALGO_RSA:
+            logger.error("Only RSA card keys can be converted to PGP format")
             return None
 
         # Convert to PGP format
-        pgp_key = convert_to_pgp_format(modulus, exponent)
+        pgp_key = convert_to_pgp_format(record)
         if not pgp_key:
             logger.error("Failed to convert to PGP format")
             return None
@@ -391,10 +673,12 @@ def read_pgp_public_key_from_card(card, key_slot='encryption'):
 
 def encrypt_with_card_key(message_data, card, key_slot='encryption'):
     """
-    Encrypt data using RSA public key from card, bypassing PGPy's usage flag checks.
+    Encrypt data to the card's public key as an OpenPGP message.
 
-    This function reads the RSA public key from the card and performs encryption
-    using cryptography library directly, then wraps the result in PGP format.
+    The message is a standard RFC 4880 PKESK + SEIPD message (see
+    openpgp_stream.py) that GnuPG can decrypt with the card, and has no
+    size limit. For large inputs use openpgp_stream.encrypt_stream() with
+    file objects instead of passing the data in memory.
 
     Args:
         message_data: bytes to encrypt
@@ -405,53 +689,19 @@ def encrypt_with_card_key(message_data, card, key_slot='encryption'):
         str: PGP-encrypted message in ASCII armor format, or None on error
     """
     try:
-        from cryptography.hazmat.primitives.asymmetric import rsa, padding
-        from cryptography.hazmat.primitives import hashes, serialization
-        from cryptography.hazmat.backends import default_backend
-        import pgpy
-
-        logger.info("Encrypting data using card RSA public key directly...")
+        import io
+        from openpgp_stream import load_card_recipient, encrypt_stream
 
-        # Read raw key data from card
-        key_data = read_public_key_from_card(card, key_slot)
-        if not key_data:
-            return None
+        logger.info("Encrypting data to the card key as an OpenPGP message...")
 
-        # Extract RSA components
-        modulus_bytes, exponent_bytes = extract_rsa_public_key_components(key_data)
-        if not modulus_bytes or not exponent_bytes:
+        recipient = load_card_recipient(card, key_slot)
+        if recipient is None:
             return None
 
-        # Convert to integers
-        n = int.from_bytes(modulus_bytes, byteorder='big')
-        e = int.from_bytes(exponent_bytes, byteorder='big')
-
-        # Create RSA public key using cryptography library
-        public_numbers = rsa.RSAPublicNumbers(e, n)
-        rsa_public_key = public_numbers.public_key(default_backend())
-
-        logger.debug(f"Created RSA public key: {n.bit_length()} bits")
-
-        # Encrypt the data using RSA-OAEP
-        ciphertext = rsa_public_key.encrypt(
-            message_data,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
-
-        logger.info(f"Encrypted {len(message_data)} bytes -> {len(ciphertext)} bytes ciphertext")
-
-        # Wrap in PGP message format
-        # For now, return base64-encoded ciphertext with PGP armor
-        import base64
-        armored = "-----BEGIN PGP MESSAGE-----\\n\\n"
-        armored += base64.b64encode(ciphertext).decode('ascii')
-        armored += "\\n-----END PGP MESSAGE-----\\n"
-
-        return armored
+        out = io.BytesIO()
+        encrypt_stream(io.BytesIO(message_data), out, [recipient], armor=True)
+        logger.info(f"Encrypted {len(message_data)} bytes -> {out.tell()} bytes armored message")
+        return out.getvalue().decode('ascii')
 
     except Exception as e:
         logger.error(f"Error encrypting with card key: {e}", e)
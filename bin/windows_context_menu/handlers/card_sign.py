@@ -0,0 +1,594 @@
+"""
+AEPGP Card Signatures
+
+Signs digests with the card's signature key (PSO:COMPUTE DIGITAL
+SIGNATURE) and verifies the result on the host, without the card, from
+the public key read once from the card.
+
+RSA keys sign a PKCS#1 v1.5 DigestInfo and ECDSA keys return r || s for
+the digest. The SmartPGP applet has no EdDSA, so EdDSA keys are rejected.
+
+Files are signed by hashing them on the host in bounded memory and sending
+only the digest to the card, so signing takes a single PSO:CDS whatever
+the file size. Signatures are written as OpenPGP detached signatures
+(openpgp_stream.py) or in raw form: the RSA signature or a DER ECDSA
+signature (as produced by openssl dgst -sign). The signature key is cached
+(key_cache.py) so detached signatures can be verified later without the
+card.
+
+Batches of files are signed with sign_files(): the files are hashed on a
+thread pool while the card signs the digests already computed, and PW1 is
+verified only once when the PW1 status byte (DO C4) allows it.
+"""
+
+import os
+import mmap
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+        def warning(self, msg): pass
+    logger = DummyLogger()
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, utils
+
+from card_key_reader import ALGO_RSA, ALGO_ECDSA, ALGO_EDDSA
+
+# Digests accepted for signing
+HASH_ALGORITHMS = {
+    'sha256': hashes.SHA256,
+    'sha384': hashes.SHA384,
+    'sha512': hashes.SHA512,
+}
+
+# ASN.1 DigestInfo prefixes for RSA PKCS#1 v1.5 (RFC 8017, 9.2)
+_DIGEST_INFO_PREFIX = {
+    'sha256': bytes.fromhex("3031300d060960864801650304020105000420"),
+    'sha384': bytes.fromhex("3041300d060960864801650304020205000430"),
+    'sha512': bytes.fromhex("3051300d060960864801650304020305000440"),
+}
+
+ERROR_PIN_NOT_VERIFIED = "PIN not verified"
+ERROR_EDDSA_UNSUPPORTED = "EdDSA keys are not supported by the SmartPGP applet"
+
+# Detached signature formats
+FORMAT_OPENPGP = 'openpgp'
+FORMAT_RAW = 'raw'
+
+
+class SigningKey:
+    """Public half of the card's signature key"""
+
+    def __init__(self, algorithm, public_key, key_data, attributes, fingerprint):
+        self.algorithm = algorithm
+        self.public_key = public_key
+        # Raw 7F49 response and algorithm attributes, kept to embed in manifests
+        self.key_data = key_data
+        self.attributes = attributes
+        self.fingerprint = fingerprint
+
+    def describe(self):
+        if self.algorithm == ALGO_ECDSA:
+            return f"ECDSA {self.public_key.curve.name}"
+        return f"RSA-{self.public_key.key_size}"
+
+    def to_dict(self):
+        return {
+            'algorithm': self.describe(),
+            'fingerprint': self.fingerprint.hex().upper(),
+            'public_key': self.key_data.hex(),
+            'attributes': self.attributes.hex() if self.attributes else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        attributes = bytes.fromhex(d['attributes']) if d.get('attributes') else None
+        return load_signing_key(bytes.fromhex(d['public_key']), attributes)
+
+    def verify(self, signature, digest, hash_name='sha256'):
+        """True if signature is a valid card signature of digest"""
+        algorithm = HASH_ALGORITHMS[hash_name]()
+        try:
+            if self.algorithm == ALGO_ECDSA:
+                half = len(signature) // 2
+                der = utils.encode_dss_signature(int.from_bytes(signature[:half], 'big'),
+                                                 int.from_bytes(signature[half:], 'big'))
+                self.public_key.verify(der, digest, ec.ECDSA(utils.Prehashed(algorithm)))
+            else:
+                self.public_key.verify(signature, digest, padding.PKCS1v15(),
+                                       utils.Prehashed(algorithm))
+            return True
+        except (InvalidSignature, ValueError):
+            return False
+
+
+def load_signing_key(key_data, attributes):
+    """
+    Build a SigningKey from the card's GET PUBLIC KEY response.
+
+    Args:
+        key_data: Raw 7F49 response for the signature key slot
+        attributes: Algorithm attributes of the signature key slot (DO C1),
+                    or None to assume RSA
+
+    Returns:
+        SigningKey, or None if the key cannot be parsed
+    """
+    from card_key_reader import public_key_record
+
+    algorithm = attributes[0] if attributes else ALGO_RSA
+    if algorithm == ALGO_EDDSA:
+        logger.error(ERROR_EDDSA_UNSUPPORTED)
+        return None
+    if algorithm not in (ALGO_ECDSA, ALGO_RSA):
+        logger.error(f"Card signature key algorithm 0x{algorithm:02X} is not supported")
+        return None
+    record = public_key_record(key_data, attributes)
+    if record is None:
+        return None
+    public_key = record.public_key()
+    if public_key is None:
+        logger.error(f"Unsupported curve OID in algorithm attributes: {record.curve_oid.hex()}")
+        return None
+    return SigningKey(algorithm, public_key, record.key_data, attributes, record.fingerprint)
+
+
+def read_signing_key(card):
+    """
+    Read the card's signature public key.
+
+    Returns:
+        tuple: (SigningKey or None, error_message: str or None)
+    """
+    from card_key_reader import read_public_key_record
+
+    record = read_public_key_record(card, 'signature')
+    if record is None:
+        return None, "Failed to read signature public key from card"
+    if record.algorithm == ALGO_EDDSA:
+        return None, ERROR_EDDSA_UNSUPPORTED
+    signing_key = load_signing_key(record.key_data, record.attributes)
+    if signing_key is None:
+        return None, "Failed to parse signature public key from card"
+    return signing_key, None
+
+
+def card_sign_digest(card, signing_key, digest, hash_name='sha256'):
+    """
+    Sign a digest with PSO:COMPUTE DIGITAL SIGNATURE.
+
+    The user PIN must already be verified in mode 81
+    (card_utils.verify_signature_pin).
+
+    Args:
+        card: AEPGPCard object with active connection
+        signing_key: SigningKey from read_signing_key()
+        digest: Digest bytes
+        hash_name: Digest algorithm ('sha256', 'sha384' or 'sha512')
+
+    Returns:
+        tuple: (signature: bytes or None, error_message: str or None)
+    """
+    if signing_key.algorithm == ALGO_RSA:
+        data = _DIGEST_INFO_PREFIX[hash_name] + digest
+    else:
+        data = digest
+    data = list(data)
+    from card_utils import transmit_with_response
+
+    response, sw1, sw2 = transmit_with_response(card, [0x00, 0x2A, 0x9E, 0x9A, len(data)] + data + [0x00])
+
+    if sw1 == 0x69 and sw2 == 0x82:
+        return None, "Signature PIN not verified"
+    if sw1 != 0x90 or sw2 != 0x00:
+        return None, f"Signature failed: SW={sw1:02X}{sw2:02X}"
+    return bytes(response), None
+
+
+def card_authenticate(card, data):
+    """
+    Sign with the authentication key (INTERNAL AUTHENTICATE).
+
+    The user PIN must already be verified in mode 82. RSA keys get a
+    DigestInfo (padded by the card), ECDSA keys a digest; ECDSA keys
+    return r || s.
+
+    Returns:
+        tuple: (signature: bytes or None, error_message: str or None)
+    """
+    from card_utils import transmit_with_response
+
+    data = list(data)
+    response, sw1, sw2 = transmit_with_response(card, [0x00, 0x88, 0x00, 0x00, len(data)] + data + [0x00])
+
+    if sw1 == 0x69 and sw2 == 0x82:
+        return None, ERROR_PIN_NOT_VERIFIED
+    if sw1 != 0x90 or sw2 != 0x00:
+        return None, f"Internal authenticate failed: SW={sw1:02X}{sw2:02X}"
+    return bytes(response), None
+
+
+def _update_from_mmap(h, f, chunk_size):
+    """Feed a regular file to h through a read-only mapping; False if it cannot be mapped"""
+    try:
+        size = os.fstat(f.fileno()).st_size - f.tell()
+        if size <= 0:
+            return False
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, AttributeError):
+        return False
+    with mapped:
+        view = memoryview(mapped)
+        try:
+            for offset in range(f.tell(), len(mapped), chunk_size):
+                h.update(view[offset:offset + chunk_size])
+        finally:
+            view.release()
+    f.seek(0, os.SEEK_END)
+    return True
+
+
+def file_hasher(source, hash_name='sha256', chunk_size=1024 * 1024, use_mmap=False):
+    """
+    Hash a file in bounded memory (hashlib releases the GIL on large updates).
+
+    Args:
+        source: File path or binary file object, read to its end
+        hash_name: Digest algorithm
+        chunk_size: Read size
+        use_mmap: Map regular files instead of reading them (falls back to
+                  reads for pipes and empty files)
+
+    Returns:
+        hashlib hash object, so more data can still be appended
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            return file_hasher(f, hash_name, chunk_size, use_mmap)
+    h = hashlib.new(hash_name)
+    if use_mmap and _update_from_mmap(h, source, chunk_size):
+        return h
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        h.update(chunk)
+    return h
+
+
+def hash_file(path, hash_name='sha256', chunk_size=1024 * 1024):
+    """Digest of a file, read in chunks"""
+    return file_hasher(path, hash_name, chunk_size).digest()
+
+
+def _openpgp_identity(card, signing_key):
+    """v4 fingerprint of the signature key: DO C5, or computed from DO CD"""
+    from card_key_reader import read_openpgp_fingerprint, read_public_key_record
+    from openpgp_stream import signing_key_v4_fingerprint
+
+    fingerprint = read_openpgp_fingerprint(card, 'signature')
+    if fingerprint is not None:
+        return fingerprint
+    # The slot's record carries its generation date and is already read
+    record = read_public_key_record(card, 'signature')
+    created = record.created if record is not None else 0
+    logger.warning("Card has no OpenPGP fingerprint for its signature key; "
+                   f"using a computed one (creation time {created})")
+    return signing_key_v4_fingerprint(signing_key, created)
+
+
+def _cache_signing_key(card, signing_key, openpgp_fingerprint):
+    from card_utils import get_card_serial
+    from key_cache import CachedKey, cache_key, USAGE_SIGNATURE
+
+    cache_key(CachedKey(signing_key.fingerprint, signing_key.key_data, signing_key.attributes,
+                        serial=get_card_serial(card), usage=USAGE_SIGNATURE,
+                        openpgp_fingerprint=openpgp_fingerprint))
+
+
+def remember_signing_key(card, signing_key):
+    """Cache the card's signature key so its signatures verify without the card"""
+    _cache_signing_key(card, signing_key, _openpgp_identity(card, signing_key))
+
+
+def _raw_signature(signing_key, signature):
+    if signing_key.algorithm == ALGO_ECDSA:
+        half = len(signature) // 2
+        return utils.encode_dss_signature(int.from_bytes(signature[:half], 'big'),
+                                          int.from_bytes(signature[half:], 'big'))
+    return signature
+
+
+def _card_signature_from_raw(signing_key, signature):
+    """Inverse of _raw_signature, None if signature does not fit the key"""
+    if signing_key.algorithm != ALGO_ECDSA:
+        return signature
+    try:
+        r, s = utils.decode_dss_signature(signature)
+    except ValueError:
+        return None
+    size = (signing_key.public_key.curve.key_size + 7) // 8
+    if max(r, s).bit_length() > size * 8:
+        return None
+    return r.to_bytes(size, 'big') + s.to_bytes(size, 'big')
+
+
+def sign_stream(card, fin, fout, pin, hash_name='sha256', fmt=FORMAT_OPENPGP, armor=False,
+                use_mmap=False):
+    """
+    Write a detached signature of a stream with the card's signature key.
+
+    The input is hashed on the host first; the user PIN is then verified
+    (PW1 mode 81) and the digest signed with one PSO:CDS.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        fin: Binary file object with the data to sign
+        fout: Binary file object receiving the signature
+        pin: User PIN
+        hash_name: 'sha256', 'sha384' or 'sha512'
+        fmt: FORMAT_OPENPGP or FORMAT_RAW
+        armor: ASCII-armor an OpenPGP signature
+        use_mmap: Hash regular input files through a memory mapping
+
+    Returns:
+        tuple: (signing_key: SigningKey or None, error_message: str or None)
+    """
+    from card_utils import verify_signature_pin
+
+    error_msg = _check_sign_options(hash_name, fmt)
+    if error_msg:
+        return None, error_msg
+
+    signing_key, error_msg = read_signing_key(card)
+    if error_msg:
+        return None, error_msg
+    fingerprint = _openpgp_identity(card, signing_key)
+
+    sig, digest = _hash_for_signature(fin, signing_key, fingerprint, hash_name, fmt, use_mmap)
+
+    success, error_msg = verify_signature_pin(card, pin)
+    if not success:
+        return None, error_msg
+    signature, error_msg = _sign_checked(card, signing_key, digest, hash_name)
+    if error_msg:
+        return None, error_msg
+    logger.info(f"Signed {hash_name} digest with {signing_key.describe()}")
+
+    _write_detached(fout, signing_key, sig, digest, signature, armor)
+    _cache_signing_key(card, signing_key, fingerprint)
+    return signing_key, None
+
+
+def _check_sign_options(hash_name, fmt):
+    if hash_name not in HASH_ALGORITHMS:
+        return f"Unsupported hash algorithm: {hash_name}"
+    if fmt not in (FORMAT_OPENPGP, FORMAT_RAW):
+        return f"Unsupported signature format: {fmt}"
+    return None
+
+
+def _hash_for_signature(source, signing_key, fingerprint, hash_name, fmt, use_mmap=False):
+    """
+    Returns:
+        tuple: (OpenPGPSignature, or None for raw signatures; digest to sign)
+    """
+    from openpgp_stream import new_signature
+
+    h = file_hasher(source, hash_name, use_mmap=use_mmap)
+    sig = None
+    if fmt == FORMAT_OPENPGP:
+        sig = new_signature(signing_key, hash_name, fingerprint, int(time.time()))
+        h.update(sig.trailer())
+    return sig, h.digest()
+
+
+def _sign_checked(card, signing_key, digest, hash_name):
+    signature, error_msg = card_sign_digest(card, signing_key, digest, hash_name)
+    if error_msg:
+        return None, error_msg
+    if not signing_key.verify(signature, digest, hash_name):
+        return None, "Card returned an invalid signature"
+    return signature, None
+
+
+def _write_detached(fout, signing_key, sig, digest, signature, armor):
+    from openpgp_stream import finish_signature, write_signature
+
+    if sig is not None:
+        write_signature(fout, finish_signature(sig, digest, signature), armor)
+    else:
+        fout.write(_raw_signature(signing_key, signature))
+
+
+def _hash_item(item, signing_key, fingerprint, hash_name, fmt, use_mmap):
+    source, _ = item
+    try:
+        return _hash_for_signature(source, signing_key, fingerprint, hash_name, fmt, use_mmap), None
+    except OSError as e:
+        return None, str(e)
+
+
+class BatchResult:
+    """Outcome of sign_files()"""
+
+    def __init__(self):
+        # (source path, signature path) of the signed files
+        self.signed = []
+        # (source path, error message) of the files that could not be signed
+        self.failed = []
+        self.pin_verifications = 0
+        self.elapsed = 0.0
+
+    @property
+    def signatures_per_second(self):
+        return len(self.signed) / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def sign_files(card, items, pin, hash_name='sha256', fmt=FORMAT_OPENPGP, armor=False,
+               workers=4, use_mmap=False):
+    """
+    Write detached signatures for a batch of files.
+
+    Files are hashed on a thread pool while the card signs, in input order,
+    the digests already computed. PW1 (mode 81) is verified once for the
+    whole batch if the PW1 status byte allows several signatures, and
+    before each signature otherwise. Unreadable files are reported and
+    skipped; a card error stops the batch.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        items: List of (source path, signature path) pairs
+        pin: User PIN
+        hash_name: 'sha256', 'sha384' or 'sha512'
+        fmt: FORMAT_OPENPGP or FORMAT_RAW
+        armor: ASCII-armor OpenPGP signatures
+        workers: Number of parallel hashing threads
+        use_mmap: Hash regular files through a memory mapping
+
+    Returns:
+        tuple: (BatchResult or None, error_message: str or None); after a
+               card error the partial BatchResult comes with the message
+    """
+    from card_utils import verify_signature_pin, signature_pin_reusable
+
+    error_msg = _check_sign_options(hash_name, fmt)
+    if error_msg:
+        return None, error_msg
+
+    signing_key, error_msg = read_signing_key(card)
+    if error_msg:
+        return None, error_msg
+    fingerprint = _openpgp_identity(card, signing_key)
+    reusable = signature_pin_reusable(card)
+    logger.info("PW1 " + ("stays verified for the batch" if reusable
+                          else "is verified before each signature"))
+
+    result = BatchResult()
+    start = time.perf_counter()
+    pin_verified = False
+    error_msg = None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # The pool hashes ahead while the card signs in input order
+        futures = [pool.submit(_hash_item, item, signing_key, fingerprint, hash_name, fmt, use_mmap)
+                   for item in items]
+        for (source, output), future in zip(items, futures):
+            prepared, read_error = future.result()
+            if read_error:
+                result.failed.append((source, read_error))
+                continue
+            sig, digest = prepared
+            if not pin_verified:
+                success, error_msg = verify_signature_pin(card, pin)
+                result.pin_verifications += 1
+                if not success:
+                    break
+                pin_verified = reusable
+            signature, error_msg = _sign_checked(card, signing_key, digest, hash_name)
+            if error_msg:
+                break
+            tmp_output = output + '.tmp'
+            try:
+                with open(tmp_output, 'wb') as fout:
+                    _write_detached(fout, signing_key, sig, digest, signature, armor)
+                os.replace(tmp_output, output)
+            except OSError as e:
+                result.failed.append((source, str(e)))
+                continue
+            result.signed.append((source, output))
+        if error_msg:
+            # Do not hash the files left after a card error
+            for future in futures:
+                future.cancel()
+    result.elapsed = time.perf_counter() - start
+
+    if result.signed:
+        _cache_signing_key(card, signing_key, fingerprint)
+    logger.info(f"Signed {len(result.signed)} files in {result.elapsed:.2f}s "
+                f"({result.signatures_per_second:.1f} signatures/s, "
+                f"{result.pin_verifications} PIN verifications)")
+    return result, error_msg
+
+
+def verify_stream(fin, signature_data, signer=None, hash_name='sha256', use_mmap=False):
+    """
+    Check a detached signature against the cached card signature keys,
+    without the card.
+
+    OpenPGP signatures name their issuer and hash algorithm; raw signatures
+    are checked with hash_name against every candidate key.
+
+    Args:
+        fin: Binary file object with the signed data
+        signature_data: Signature file contents (OpenPGP binary or armored, or raw)
+        signer: Expected signer (fingerprint, serial or alias in the key
+                cache), or None to accept any cached signature key
+        hash_name: Digest algorithm of raw signatures
+        use_mmap: Hash regular input files through a memory mapping
+
+    Returns:
+        tuple: (CachedKey of the signer or None, error_message: str or None)
+    """
+    import io
+    from key_cache import load_cached_keys, find_cached_key, USAGE_SIGNATURE
+    from openpgp_stream import OpenPGPError, read_signature, card_signature_from_mpis
+
+    if signer is not None:
+        entry = find_cached_key(signer, usage=USAGE_SIGNATURE)
+        if entry is None:
+            return None, f"No unique cached signature key matches '{signer}'"
+        candidates = [entry]
+    else:
+        candidates = load_cached_keys(USAGE_SIGNATURE)
+    if not candidates:
+        return None, "No cached signature keys; sign once with the card to cache its key"
+
+    try:
+        sig = read_signature(io.BytesIO(signature_data))
+    except OpenPGPError:
+        sig = None
+
+    if sig is not None:
+        hash_name = sig.hash_name
+        if hash_name not in HASH_ALGORITHMS:
+            return None, f"Unsupported signature hash algorithm: {sig.hash_id}"
+        issuer, key_id = sig.issuer_fingerprint, sig.issuer_key_id
+        candidates = [entry for entry in candidates
+                      if entry.openpgp_fingerprint is not None
+                      and (entry.openpgp_fingerprint == issuer
+                           or (issuer is None and entry.openpgp_fingerprint[-8:] == key_id))]
+        if not candidates:
+            issuer_hex = (issuer or key_id or b'').hex().upper()
+            return None, f"Signature issuer {issuer_hex} is not a cached signature key"
+    elif hash_name not in HASH_ALGORITHMS:
+        return None, f"Unsupported hash algorithm: {hash_name}"
+
+    h = file_hasher(fin, hash_name, use_mmap=use_mmap)
+    if sig is not None:
+        h.update(sig.trailer())
+    digest = h.digest()
+
+    for entry in candidates:
+        signing_key = load_signing_key(entry.key_data, entry.attributes)
+        if signing_key is None:
+            continue
+        if sig is not None:
+            if sig.digest_prefix != digest[:2]:
+                return None, "Bad signature"
+            signature = card_signature_from_mpis(signing_key, sig)
+        else:
+            signature = _card_signature_from_raw(signing_key, signature_data)
+        if signature is not None and signing_key.verify(signature, digest, hash_name):
+            return entry, None
+    return None, "Bad signature"
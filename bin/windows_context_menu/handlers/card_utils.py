@@ -20,17 +20,16 @@ except ImportError:
         def debug(self, msg): pass
     logger = DummyLogger()
 
-try:
-    from smartcard.System import readers
-    from smartcard.Exceptions import NoCardException, CardConnectionException
-    from smartcard.util import toHexString, toBytes
-except ImportError:
-    print("ERROR: pyscard library not found. Install it with: pip install pyscard")
-    sys.exit(1)
+# pyscard is imported by the functions using a card: the dialogs and
+# encryption to a cached key start without it
+PYSCARD_MISSING = "pyscard library not found. Install it with: pip install pyscard"
 
 # OpenPGP AID (Application Identifier)
 OPENPGP_AID = [0xD2, 0x76, 0x00, 0x01, 0x24, 0x01]
 
+# Safety cap on GET RESPONSE chaining
+_MAX_GET_RESPONSE_ITERATIONS = 16
+
 # Supported ATRs (Answer To Reset) for AEPGP/SmartPGP cards
 # Multiple ATRs are supported to work with different card manufacturers
 SUPPORTED_ATRS = [
@@ -47,9 +46,12 @@ class AEPGPCard:
     def __init__(self, connection):
         self.connection = connection
         self.reader = connection.getReader()
+        # PublicKeyRecord per key slot, see card_key_reader.read_public_key_record()
+        self.key_records = {}
 
     def _log_apdu(self, command, response, sw1, sw2):
         """Log APDU command and response"""
+        from smartcard.util import toHexString
         cmd_hex = toHexString(command)
         resp_hex = toHexString(response) if response else ""
         logger.debug(f"APDU CMD: {cmd_hex}")
@@ -101,6 +103,12 @@ def find_aepgp_card():
         tuple: (AEPGPCard object, None) on success
                (None, error_message) on failure
     """
+    try:
+        from smartcard.System import readers
+        from smartcard.Exceptions import NoCardException, CardConnectionException
+    except ImportError:
+        return None, PYSCARD_MISSING
+
     try:
         reader_list = readers()
 
@@ -151,6 +159,34 @@ def find_aepgp_card():
         return None, f"Error accessing smart card:\n\n{str(e)}"
 
 
+def find_aepgp_readers():
+    """
+    List the readers holding an AEPGP/SmartPGP card.
+
+    Returns:
+        list: (reader index, reader name) pairs, in reader order
+    """
+    from smartcard.System import readers
+    from smartcard.Exceptions import NoCardException, CardConnectionException
+
+    found = []
+    for index, reader in enumerate(readers()):
+        try:
+            connection = reader.createConnection()
+            connection.connect()
+        except (NoCardException, CardConnectionException):
+            continue
+        try:
+            if verify_supported_atr(connection.getATR()):
+                found.append((index, str(reader)))
+        finally:
+            try:
+                connection.disconnect()
+            except:
+                pass
+    return found
+
+
 def get_card_info(card):
     """
     Get basic information about the AEPGP card.
@@ -159,18 +195,39 @@ def get_card_info(card):
         card: AEPGPCard object
 
     Returns:
-        dict: Card information
+        dict: Card information, with the application related data (hex) and
+        the version, manufacturer and serial from its AID when readable
     """
     try:
+        from card_key_reader import parse_tlv_length
+
         # GET DATA command for application related data (0x00 0x6E)
         GET_DATA = [0x00, 0xCA, 0x00, 0x6E, 0x00]
         response, sw1, sw2 = card.connection.transmit(GET_DATA)
+        while sw1 == 0x61:
+            more, sw1, sw2 = card.connection.transmit([0x00, 0xC0, 0x00, 0x00, sw2])
+            response = response + more
 
         info = {
             'reader': card.reader,
             'connected': True,
             'response_status': f"{sw1:02X}{sw2:02X}"
         }
+        if sw1 != 0x90 or sw2 != 0x00:
+            return info
+
+        info['application_data'] = bytes(response).hex().upper()
+        # The AID (4F) comes first, inside the 6E template if the card
+        # returns it with its tag
+        offset = 0
+        if response[:1] == [0x6E]:
+            _, len_bytes = parse_tlv_length(response, 1)
+            offset = 1 + len_bytes
+        if response[offset:offset + 2] == [0x4F, 0x10] and len(response) >= offset + 18:
+            aid = response[offset + 2:offset + 18]
+            info['version'] = f"{aid[6]}.{aid[7]}"
+            info['manufacturer'] = bytes(aid[8:10]).hex().upper()
+            info['serial'] = bytes(aid[10:14]).hex().upper()
 
         return info
     except Exception as e:
@@ -181,6 +238,117 @@ def get_card_info(card):
         }
 
 
+def verify_user_pin(card, pin):
+    """
+    Verify the user PIN for decryption operations (PW1 mode 82).
+
+    Args:
+        card: AEPGPCard object
+        pin: User PIN string, or bytes already derived with the card's KDF
+
+    Returns:
+        tuple: (success: bool, error_message: str or None)
+    """
+    return _verify_pw1(card, pin, 0x82)
+
+
+def verify_signature_pin(card, pin):
+    """
+    Verify the user PIN for PSO:COMPUTE DIGITAL SIGNATURE (PW1 mode 81).
+
+    Unless the PW1 status byte (DO C4) allows several signatures (see
+    signature_pin_reusable), the card clears this verification after each
+    signature.
+
+    Args:
+        card: AEPGPCard object
+        pin: User PIN string, or bytes already derived with the card's KDF
+
+    Returns:
+        tuple: (success: bool, error_message: str or None)
+    """
+    return _verify_pw1(card, pin, 0x81)
+
+
+def signature_pin_reusable(card):
+    """
+    Read the PW1 status byte (first byte of DO C4).
+
+    Returns:
+        bool: True if one PW1 verification in mode 81 is valid for several
+              signatures, False if the card requires it before each one (also
+              when DO C4 cannot be read)
+    """
+    try:
+        get_data_cmd = [0x00, 0xCA, 0x00, 0xC4, 0x00]
+        response, sw1, sw2 = card.connection.transmit(get_data_cmd)
+        card._log_apdu(get_data_cmd, response, sw1, sw2)
+        if sw1 != 0x90 or sw2 != 0x00 or not response:
+            logger.error(f"Failed to read PW status bytes: SW={sw1:02X}{sw2:02X}")
+            return False
+        # Some cards return the DO with its tag and length
+        if response[0] == 0xC4 and len(response) > 2:
+            response = response[2:]
+        return response[0] == 0x01
+    except Exception as e:
+        logger.error(f"Failed to read PW status bytes: {e}", e)
+        return False
+
+
+def _verify_pw1(card, pin, mode):
+    # Verify PIN APDU: 00 20 00 [81|82] [length] [PIN]
+    # A PIN already derived with the card's KDF is given as bytes
+    pin_bytes = [ord(c) for c in pin] if isinstance(pin, str) else list(pin)
+    verify_pin_cmd = [0x00, 0x20, 0x00, mode, len(pin_bytes)] + pin_bytes
+
+    response, sw1, sw2 = card.connection.transmit(verify_pin_cmd)
+    card._log_apdu(verify_pin_cmd, response, sw1, sw2)
+
+    if sw1 == 0x90 and sw2 == 0x00:
+        logger.info("PIN verified successfully")
+        return True, None
+    if sw1 == 0x63:
+        retries = sw2 & 0x0F
+        return False, f"Wrong PIN. {retries} retries remaining"
+    return False, f"PIN verification failed: SW={sw1:02X}{sw2:02X}"
+
+
+def get_card_serial(card):
+    """
+    Read the card serial number from the application identifier (DO 4F).
+
+    Returns:
+        bytes: 4-byte serial number, or None on error
+    """
+    try:
+        get_data_cmd = [0x00, 0xCA, 0x00, 0x4F, 0x00]
+        response, sw1, sw2 = card.connection.transmit(get_data_cmd)
+        card._log_apdu(get_data_cmd, response, sw1, sw2)
+        if sw1 != 0x90 or sw2 != 0x00 or len(response) < 14:
+            logger.error(f"Failed to read card AID: SW={sw1:02X}{sw2:02X}")
+            return None
+        # AID: RID(5) PIX(1) version(2) manufacturer(2) serial(4) RFU(2)
+        return bytes(response[10:14])
+    except Exception as e:
+        logger.error(f"Failed to read card serial: {e}", e)
+        return None
+
+
+def transmit_with_response(card, apdu):
+    """Send an APDU, collecting the response data announced by SW 61xx"""
+    response, sw1, sw2 = card.connection.transmit(apdu)
+    card._log_apdu(apdu, response, sw1, sw2)
+
+    iteration = 0
+    while sw1 == 0x61 and iteration < _MAX_GET_RESPONSE_ITERATIONS:
+        iteration += 1
+        get_response_cmd = [0x00, 0xC0, 0x00, 0x00, sw2]
+        chunk, sw1, sw2 = card.connection.transmit(get_response_cmd)
+        card._log_apdu(get_response_cmd, chunk, sw1, sw2)
+        response = response + chunk
+    return response, sw1, sw2
+
+
 def _get_response_if_needed(card, response, sw1, sw2):
     if sw1 != 0x61:
         return response, sw1, sw2
@@ -424,6 +592,7 @@ if __name__ == "__main__":
     print(f"AEPGP card found in reader: {card.reader}")
 
     # Print ATR
+    from smartcard.util import toHexString
     atr = card.connection.getATR()
     print(f"ATR: {toHexString(atr)}")
 
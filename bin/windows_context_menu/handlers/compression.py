@@ -0,0 +1,99 @@
+"""
+AEPGP Streaming Compression
+
+Optional compression stage applied to file data before AES-GCM encryption
+(and after decryption). zlib from the standard library is always
+available; zstd is used when the `zstandard` package is installed.
+
+The algorithm is recorded in the encrypted file header (see enc_format.py).
+Compression is skipped automatically when a sample of the input does not
+compress, e.g. for media files or archives.
+"""
+
+import zlib
+
+from enc_format import COMPRESS_NONE, COMPRESS_ZLIB, COMPRESS_ZSTD
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Requested modes accepted by encrypt_file_with_card_key()
+COMPRESSION_MODES = (None, 'none', 'auto', 'zlib', 'zstd')
+
+# Skip compression unless the sample shrinks below this ratio
+_MIN_SAVING_RATIO = 0.9
+
+_ZLIB_LEVEL = 6
+_ZSTD_LEVEL = 3
+
+
+class CompressionUnavailable(Exception):
+    pass
+
+
+def zstd_available():
+    return zstandard is not None
+
+
+def choose_compression(mode, sample):
+    """
+    Pick the compression algorithm for a file.
+
+    Args:
+        mode: None/'none' (no compression), 'auto' (zstd if available,
+              else zlib), 'zlib' or 'zstd'
+        sample: First chunk of the plaintext
+
+    Returns:
+        int: COMPRESS_* algorithm ID
+
+    Raises:
+        CompressionUnavailable: If 'zstd' is requested but not installed
+    """
+    if mode is None or mode == 'none':
+        return COMPRESS_NONE
+    if mode == 'zstd':
+        if not zstd_available():
+            raise CompressionUnavailable("zstd compression requires: pip install zstandard")
+        alg = COMPRESS_ZSTD
+    elif mode == 'zlib':
+        alg = COMPRESS_ZLIB
+    elif mode == 'auto':
+        alg = COMPRESS_ZSTD if zstd_available() else COMPRESS_ZLIB
+    else:
+        raise ValueError(f"Unknown compression mode: {mode}")
+
+    if not sample:
+        return COMPRESS_NONE
+    # Cheap probe: a fast zlib pass over the sample predicts both algorithms well
+    if len(zlib.compress(sample, 1)) > len(sample) * _MIN_SAVING_RATIO:
+        return COMPRESS_NONE
+    return alg
+
+
+def new_compressor(alg):
+    """Return a streaming compressor (compress()/flush()) or None"""
+    if alg == COMPRESS_NONE:
+        return None
+    if alg == COMPRESS_ZLIB:
+        return zlib.compressobj(_ZLIB_LEVEL)
+    if alg == COMPRESS_ZSTD:
+        if not zstd_available():
+            raise CompressionUnavailable("zstd compression requires: pip install zstandard")
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unknown compression algorithm: {alg}")
+
+
+def new_decompressor(alg):
+    """Return a streaming decompressor (decompress()/flush()) or None"""
+    if alg == COMPRESS_NONE:
+        return None
+    if alg == COMPRESS_ZLIB:
+        return zlib.decompressobj()
+    if alg == COMPRESS_ZSTD:
+        if not zstd_available():
+            raise CompressionUnavailable("This file is zstd-compressed: pip install zstandard")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown compression algorithm: {alg}")
@@ -8,8 +8,6 @@ when using the AEPGP context menu tools.
 import os
 import sys
 import datetime
-import traceback
-from pathlib import Path
 
 
 class DebugLogger:
@@ -60,6 +58,7 @@ class DebugLogger:
                 new_entry += f"Type: {type(exception).__name__}\n"
                 new_entry += f"Message: {str(exception)}\n"
                 new_entry += f"\nTraceback:\n"
+                import traceback
                 new_entry += traceback.format_exc()
 
             new_entry += f"{'='*80}\n\n"
@@ -0,0 +1,365 @@
+"""
+AEPGP Encrypted Archives
+
+Packs files and directory trees into a single encrypted container, so a
+folder of small documents costs one card operation instead of one per
+file. The data key is wrapped once in a version 2 header carrying
+TAG_ARCHIVE (see enc_format.py):
+
+    [version 2 header: recipients, TAG_SEGMENT_SIZE, TAG_ARCHIVE]
+    [12 bytes: base IV]
+    member data: segments of every member, one after the other, each
+        [4 bytes: ciphertext length L][L bytes: ciphertext][16 bytes: GCM tag]
+    index: one segment holding the zlib-compressed JSON member list
+    [8 bytes: index offset][4 bytes: index segment number][8 bytes: "AEPGPIDX"]
+
+Segments are numbered across the whole archive and sealed with
+segment_nonce(); only the index segment carries the final flag. The index
+records, for each member, its path, size, modification time, compression
+and the offset, number and count of its segments, so members can be
+listed and extracted on their own without decrypting the rest.
+"""
+
+import os
+import json
+import struct
+
+from enc_format import (EncHeader, InvalidFormat, encode_header, read_header, segment_nonce,
+                        IV_SIZE, TAG_SIZE, DATA_KEY_SIZE, DEFAULT_SEGMENT_SIZE,
+                        SEGMENT_LENGTH_SIZE, COMPRESS_ZLIB)
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+    logger = DummyLogger()
+
+ARCHIVE_VERSION = 1
+INDEX_MAGIC = b"AEPGPIDX"
+TRAILER_SIZE = 8 + 4 + len(INDEX_MAGIC)
+
+# Sanity limit so a corrupted index length cannot make us allocate gigabytes
+_MAX_INDEX_LENGTH = 256 * 1024 * 1024
+
+
+class ArchiveMember:
+    """One file stored in an archive"""
+
+    def __init__(self, path, size, mtime_ns, compression, offset, first_segment,
+                 segment_count=0, stored_size=0):
+        # Relative path with '/' separators
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.compression = compression
+        # Absolute file offset of the first segment
+        self.offset = offset
+        self.first_segment = first_segment
+        self.segment_count = segment_count
+        # Bytes taken by the member's segments in the archive
+        self.stored_size = stored_size
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'compression': self.compression,
+            'offset': self.offset,
+            'first_segment': self.first_segment,
+            'segment_count': self.segment_count,
+            'stored_size': self.stored_size,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['path'], d['size'], d['mtime_ns'], d['compression'], d['offset'],
+                   d['first_segment'], d['segment_count'], d.get('stored_size', 0))
+
+
+class Archive:
+    """An opened archive: header, recovered data key and member index"""
+
+    def __init__(self, header, aes_key, iv, members):
+        self.header = header
+        self.aes_key = aes_key
+        self.iv = iv
+        self.members = members
+
+
+def _walk_members(paths, exclude=None):
+    """Yield (source path, archive path) for files and directory trees"""
+    for path in paths:
+        base = os.path.dirname(os.path.abspath(path))
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    if exclude and os.path.abspath(full) in exclude:
+                        continue
+                    yield full, os.path.relpath(os.path.abspath(full), base).replace(os.sep, '/')
+        else:
+            yield path, os.path.basename(path)
+
+
+def _member_output_path(output_dir, name):
+    """Map an archive path below output_dir, rejecting absolute paths and '..'"""
+    parts = name.split('/')
+    if (not name or name.startswith('/') or '\\' in name
+            or any(p in ('', '.', '..') or ':' in p for p in parts)):
+        raise InvalidFormat(f"Unsafe path in archive: {name!r}")
+    return os.path.join(output_dir, *parts)
+
+
+def create_archive(card, paths, fout, recipients=None, compression=None, segment_size=None,
+                   exclude=None):
+    """
+    Pack files and directory trees into an encrypted archive.
+
+    Only the card's public key is used (no PIN). Each member is compressed
+    on its own when compression is enabled and its first segment compresses.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        paths: List of file or directory paths
+        fout: Binary file object to write the archive to (need not be seekable)
+        recipients: Optional list of additional cards from the key cache
+        compression: None (off), 'auto', 'zlib' or 'zstd'
+        segment_size: Plaintext bytes per segment
+        exclude: Set of absolute paths to skip in directories (e.g. the
+                 archive being written and its temporary file)
+
+    Returns:
+        tuple: (success: bool, error_message: str or None)
+    """
+    try:
+        from compression import COMPRESSION_MODES, choose_compression
+        from rsa_crypto import resolve_recipients, wrap_for_card_key, wrap_for_recipients, seal_segment
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        if compression not in COMPRESSION_MODES:
+            return False, f"Unknown compression mode: {compression}"
+        if segment_size is None:
+            segment_size = DEFAULT_SEGMENT_SIZE
+        for path in paths:
+            if not os.path.exists(path):
+                return False, f"Input not found: {path}"
+
+        extra_keys, error_msg = resolve_recipients(recipients)
+        if error_msg:
+            return False, error_msg
+
+        aes_key = os.urandom(DATA_KEY_SIZE)
+        iv = os.urandom(IV_SIZE)
+        recipient, error_msg = wrap_for_card_key(card, aes_key)
+        if error_msg:
+            return False, error_msg
+        header_recipients = [recipient]
+        wrap_for_recipients(aes_key, header_recipients, extra_keys)
+
+        # TAG_COMPRESSION describes the index, members record their own
+        header = encode_header(EncHeader(recipients=header_recipients, compression=COMPRESS_ZLIB,
+                                         segment_size=segment_size, segment_count=None,
+                                         archive=True))
+        fout.write(header)
+        fout.write(iv)
+        offset = len(header) + IV_SIZE
+
+        aesgcm = AESGCM(aes_key)
+        members = []
+        segment_index = 0
+        for source, name in _walk_members(paths, exclude):
+            st = os.stat(source)
+            with open(source, 'rb') as f:
+                segment = f.read(segment_size)
+                member = ArchiveMember(name, 0, st.st_mtime_ns,
+                                       choose_compression(compression, segment),
+                                       offset, segment_index)
+                while segment:
+                    record = seal_segment(aesgcm, iv, segment_index, False, segment,
+                                          member.compression)
+                    fout.write(record)
+                    member.size += len(segment)
+                    member.segment_count += 1
+                    member.stored_size += len(record)
+                    offset += len(record)
+                    segment_index += 1
+                    segment = f.read(segment_size)
+            members.append(member)
+            logger.debug(f"Archived {name}: {member.size} bytes, {member.segment_count} segments")
+
+        index = json.dumps({
+            'version': ARCHIVE_VERSION,
+            'members': [m.to_dict() for m in members],
+        }).encode('utf-8')
+        fout.write(seal_segment(aesgcm, iv, segment_index, True, index, COMPRESS_ZLIB))
+        fout.write(struct.pack('>QI', offset, segment_index) + INDEX_MAGIC)
+        fout.flush()
+
+        logger.info(f"Archive written: {len(members)} members, {segment_index} data segments")
+        return True, None
+
+    except Exception as e:
+        logger.error(f"Archive creation failed with exception: {e}", e)
+        return False, f"Archive creation failed: {str(e)}"
+
+
+def _open_segment(aesgcm, iv, index, final, sealed, compression_alg):
+    from compression import new_decompressor
+    from cryptography.exceptions import InvalidTag
+
+    try:
+        data = aesgcm.decrypt(segment_nonce(iv, index, final), sealed, None)
+    except InvalidTag:
+        raise InvalidFormat(f"Archive segment {index} failed authentication "
+                            "(file corrupted, truncated or tampered with)")
+    decompressor = new_decompressor(compression_alg)
+    if decompressor is not None:
+        data = decompressor.decompress(data) + decompressor.flush()
+    return data
+
+
+def _read_segment(fin, index, max_length):
+    length_data = fin.read(SEGMENT_LENGTH_SIZE)
+    if len(length_data) < SEGMENT_LENGTH_SIZE:
+        raise InvalidFormat(f"Archive is truncated (segment {index})")
+    length = struct.unpack('>I', length_data)[0]
+    if length > max_length:
+        raise InvalidFormat(f"Invalid archive format (segment {index} too long)")
+    sealed = fin.read(length + TAG_SIZE)
+    if len(sealed) < length + TAG_SIZE:
+        raise InvalidFormat(f"Archive is truncated (segment {index})")
+    return sealed
+
+
+def open_archive(card, fin):
+    """
+    Recover the data key of an archive with the card and decrypt its index.
+
+    The caller selects the applet and verifies the user PIN. Only the
+    header, the trailer and the index are read.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        fin: Seekable binary file object of the archive
+
+    Returns:
+        tuple: (Archive or None, error_message: str or None)
+    """
+    try:
+        from key_wrap import select_card_recipient, unwrap_data_key
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        header = read_header(fin)
+        if not header.archive:
+            return None, "Not an AEPGP archive"
+        iv = fin.read(IV_SIZE)
+        if len(iv) < IV_SIZE:
+            return None, "Invalid archive format (missing IV)"
+
+        fin.seek(0, os.SEEK_END)
+        if fin.tell() < header.body_offset + IV_SIZE + TRAILER_SIZE:
+            return None, "Archive is truncated (index missing)"
+        fin.seek(-TRAILER_SIZE, os.SEEK_END)
+        trailer = fin.read(TRAILER_SIZE)
+        if trailer[-len(INDEX_MAGIC):] != INDEX_MAGIC:
+            return None, "Archive is truncated (index missing)"
+        index_offset, index_segment = struct.unpack('>QI', trailer[:12])
+
+        recipient = select_card_recipient(card, header)
+        if recipient is None:
+            return None, "This archive was not encrypted for the inserted card"
+        aes_key, error_msg = unwrap_data_key(card, recipient)
+        if error_msg:
+            return None, error_msg
+
+        # The index segment number and final flag are bound into its nonce,
+        # so a forged trailer fails authentication
+        fin.seek(index_offset)
+        sealed = _read_segment(fin, index_segment, _MAX_INDEX_LENGTH)
+        index = json.loads(_open_segment(AESGCM(aes_key), iv, index_segment, True,
+                                         sealed, header.compression))
+        if index.get('version') != ARCHIVE_VERSION:
+            return None, f"Unsupported archive version: {index.get('version')}"
+        members = [ArchiveMember.from_dict(d) for d in index['members']]
+        return Archive(header, aes_key, iv, members), None
+
+    except InvalidFormat as e:
+        return None, str(e)
+    except Exception as e:
+        logger.error(f"Archive open failed with exception: {e}", e)
+        return None, f"Failed to open archive: {str(e)}"
+
+
+def extract_members(archive, fin, output_dir, names=None):
+    """
+    Extract members of an opened archive, restoring modification times.
+
+    Only the segments of the selected members are read and decrypted.
+    Each member is written to a .tmp file and moved into place once all
+    of its segments have been authenticated.
+
+    Args:
+        archive: Archive returned by open_archive()
+        fin: Seekable binary file object of the archive
+        output_dir: Directory to extract into
+        names: Archive paths (or directory prefixes) to extract, None for all
+
+    Returns:
+        tuple: (list of extracted archive paths or None, error_message: str or None)
+    """
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        members = archive.members
+        if names:
+            prefixes = [n.rstrip('/') for n in names]
+            members = [m for m in members
+                       if any(m.path == p or m.path.startswith(p + '/') for p in prefixes)]
+            if not members:
+                return None, "No matching member in archive: " + ", ".join(names)
+
+        aesgcm = AESGCM(archive.aes_key)
+        segment_size = archive.header.segment_size
+        max_length = segment_size + segment_size // 8 + 1024
+        extracted = []
+        for member in members:
+            dest = _member_output_path(output_dir, member.path)
+            os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+            tmp_dest = dest + '.tmp'
+            try:
+                size = 0
+                fin.seek(member.offset)
+                with open(tmp_dest, 'wb') as fout:
+                    for i in range(member.segment_count):
+                        index = member.first_segment + i
+                        sealed = _read_segment(fin, index, max_length)
+                        data = _open_segment(aesgcm, archive.iv, index, False, sealed,
+                                             member.compression)
+                        fout.write(data)
+                        size += len(data)
+                if size != member.size:
+                    raise InvalidFormat(f"Size mismatch for {member.path}")
+                os.replace(tmp_dest, dest)
+            except Exception:
+                if os.path.exists(tmp_dest):
+                    os.remove(tmp_dest)
+                raise
+            os.utime(dest, ns=(member.mtime_ns, member.mtime_ns))
+            extracted.append(member.path)
+            logger.debug(f"Extracted {member.path}: {size} bytes")
+
+        logger.info(f"Extracted {len(extracted)} members to {output_dir}")
+        return extracted, None
+
+    except InvalidFormat as e:
+        return None, str(e)
+    except Exception as e:
+        logger.error(f"Archive extraction failed with exception: {e}", e)
+        return None, f"Extraction failed: {str(e)}"
@@ -0,0 +1,144 @@
+"""
+AEPGP Resumable Encryption Checkpoints
+
+A resumable encryption writes independently sealed segments (see
+enc_format.py) to <output>.ciphertmp and periodically records its
+progress in <output>.ckpt, a small JSON file:
+    - the input file identity (path, size, modification time)
+    - the segment size, compression algorithm and base IV
+    - the AES data key wrapped to the recipients, exactly as it will
+      appear in the final header (the clear key is never stored)
+    - the index of the next segment and the matching input and
+      .ciphertmp offsets
+
+A restarted run unwraps the data key with the card and continues from the
+last recorded segment. Both files are removed once the final output has
+been moved into place.
+"""
+
+import os
+import json
+
+from enc_format import encode_recipient, decode_recipient
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+    logger = DummyLogger()
+
+CHECKPOINT_VERSION = 1
+
+
+def checkpoint_path(output_file):
+    return output_file + ".ckpt"
+
+
+class EncCheckpoint:
+    """Progress of a resumable encryption"""
+
+    def __init__(self, input_path, input_size, input_mtime, segment_size, compression,
+                 iv, recipients, segment_index=0, input_offset=0, output_offset=0,
+                 complete=False):
+        self.input_path = input_path
+        self.input_size = input_size
+        self.input_mtime = input_mtime
+        self.segment_size = segment_size
+        self.compression = compression
+        self.iv = iv
+        self.recipients = recipients
+        self.segment_index = segment_index
+        self.input_offset = input_offset
+        self.output_offset = output_offset
+        # True once the last segment has been written
+        self.complete = complete
+
+    def to_dict(self):
+        return {
+            'version': CHECKPOINT_VERSION,
+            'input_path': self.input_path,
+            'input_size': self.input_size,
+            'input_mtime': self.input_mtime,
+            'segment_size': self.segment_size,
+            'compression': self.compression,
+            'iv': self.iv.hex(),
+            'recipients': [encode_recipient(r).hex() for r in self.recipients],
+            'segment_index': self.segment_index,
+            'input_offset': self.input_offset,
+            'output_offset': self.output_offset,
+            'complete': self.complete,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {d.get('version')}")
+        return cls(
+            d['input_path'],
+            d['input_size'],
+            d['input_mtime'],
+            d['segment_size'],
+            d['compression'],
+            bytes.fromhex(d['iv']),
+            [decode_recipient(bytes.fromhex(r)) for r in d['recipients']],
+            segment_index=d['segment_index'],
+            input_offset=d['input_offset'],
+            output_offset=d['output_offset'],
+            complete=d.get('complete', False),
+        )
+
+    def matches_input(self, input_file, segment_size):
+        """True if the checkpoint belongs to this (unchanged) input file"""
+        try:
+            st = os.stat(input_file)
+        except OSError:
+            return False
+        return (self.input_path == os.path.abspath(input_file)
+                and self.input_size == st.st_size
+                and self.input_mtime == st.st_mtime_ns
+                and self.segment_size == segment_size)
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    Write a checkpoint atomically.
+
+    The segments it refers to must already be flushed to disk.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint.to_dict(), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Load a checkpoint.
+
+    Returns:
+        EncCheckpoint, or None if missing or unreadable
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return EncCheckpoint.from_dict(json.load(f))
+    except Exception as e:
+        logger.error(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+
+
+def remove_checkpoint(path):
+    for p in (path, path + '.tmp'):
+        if os.path.exists(p):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
@@ -0,0 +1,435 @@
+"""
+AEPGP Encrypted File Container Format
+
+This module reads and writes the header of .enc files produced by
+rsa_crypto.py.
+
+Two layouts are supported:
+
+Legacy (version 1, RSA only, no magic):
+    [4 bytes: encrypted AES key length]
+    [encrypted AES key]
+    [12 bytes: IV]
+    [16 bytes: GCM auth tag]
+    [ciphertext]
+
+Version 2:
+    [8 bytes: magic "AEPGPENC"]
+    [1 byte: format version (0x02)]
+    [4 bytes: header length N]
+    [N bytes: header fields]
+    [12 bytes: IV]
+    [16 bytes: GCM auth tag]
+    [ciphertext]
+
+Version 2, segmented (header carries TAG_SEGMENT_SIZE):
+    [8 bytes: magic "AEPGPENC"]
+    [1 byte: format version (0x02)]
+    [4 bytes: header length N]
+    [N bytes: header fields]
+    [12 bytes: base IV]
+    segments, each:
+        [4 bytes: ciphertext length L]
+        [L bytes: ciphertext]
+        [16 bytes: GCM auth tag]
+
+Each segment holds at most segment_size bytes of plaintext (compressed
+on its own when compression is enabled) and is sealed independently with
+the nonce from segment_nonce(), which binds the segment index and marks
+the last segment so that reordering and truncation are detected.
+
+Header fields are encoded as [1 byte tag][2 bytes length][value]. A
+recipient entry (TAG_RECIPIENT) nests its own fields with the same
+encoding and describes how the AES data key is wrapped for one card key.
+A header may carry several recipient entries wrapping the same data key,
+each identified by the key fingerprint (public key modes) or the card
+serial number (card AES mode), so the decryptor can pick the entry of the
+inserted card without trial decryption. Unknown tags are skipped so that
+newer writers remain readable.
+
+Archives (header carries TAG_ARCHIVE, see enc_archive.py) pack many files
+into one segmented container followed by an encrypted index.
+
+inspect_file() and scan_paths() report the metadata of encrypted files
+from the header alone (a few hundred bytes per file), without a card.
+"""
+
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b"AEPGPENC"
+FORMAT_VERSION_LEGACY = 1
+FORMAT_VERSION = 2
+
+IV_SIZE = 12
+TAG_SIZE = 16
+
+# Top-level header tags
+TAG_RECIPIENT = 0x10
+TAG_COMPRESSION = 0x20
+TAG_ORIGINAL_SIZE = 0x21
+TAG_SEGMENT_SIZE = 0x22
+TAG_SEGMENT_COUNT = 0x23
+TAG_ARCHIVE = 0x24
+
+# Recipient entry tags
+TAG_WRAP_ALG = 0x11
+TAG_WRAPPED_KEY = 0x12
+TAG_EPHEMERAL_POINT = 0x13
+TAG_CURVE_OID = 0x14
+TAG_KEY_FINGERPRINT = 0x15
+TAG_CARD_SERIAL = 0x16
+
+# Key wrapping algorithms
+WRAP_RSA_PKCS1 = 0x01   # RSA PKCS#1 v1.5 with the card DEC key
+WRAP_ECDH = 0x02        # Ephemeral ECDH with the card DEC key + HKDF + AES key wrap
+WRAP_CARD_AES = 0x03    # On-card AES key (PSO:ENCIPHER / PSO:DECIPHER)
+
+WRAP_ALG_NAMES = {
+    WRAP_RSA_PKCS1: "RSA-PKCS1v15",
+    WRAP_ECDH: "ECDH-HKDF-AESKW",
+    WRAP_CARD_AES: "CARD-AES",
+}
+
+# Compression applied to the plaintext before encryption
+COMPRESS_NONE = 0x00
+COMPRESS_ZLIB = 0x01
+COMPRESS_ZSTD = 0x02
+
+COMPRESSION_NAMES = {
+    COMPRESS_NONE: "none",
+    COMPRESS_ZLIB: "zlib",
+    COMPRESS_ZSTD: "zstd",
+}
+
+# Data encryption algorithm (all versions)
+DATA_CIPHER = "AES-256-GCM"
+DATA_KEY_SIZE = 32
+
+# Plaintext bytes per segment for segmented files
+DEFAULT_SEGMENT_SIZE = 1024 * 1024
+SEGMENT_LENGTH_SIZE = 4
+
+# Sanity limit so a corrupted length field cannot make us allocate gigabytes
+_MAX_HEADER_LENGTH = 1024 * 1024
+# Wrapped key lengths of legacy (RSA 1024 to 4096 bits) files
+_LEGACY_KEY_LENGTHS = (128, 256, 384, 512)
+
+
+class InvalidFormat(Exception):
+    pass
+
+
+class Recipient:
+    """Wrapped data key for one card key"""
+
+    def __init__(self, wrap_alg, wrapped_key, ephemeral_point=None, curve_oid=None,
+                 fingerprint=None, serial=None):
+        self.wrap_alg = wrap_alg
+        self.wrapped_key = wrapped_key
+        self.ephemeral_point = ephemeral_point
+        self.curve_oid = curve_oid
+        self.fingerprint = fingerprint
+        self.serial = serial
+
+
+class EncHeader:
+    """Parsed header of an encrypted file"""
+
+    def __init__(self, version=FORMAT_VERSION, recipients=None, compression=COMPRESS_NONE,
+                 original_size=None, segment_size=None, segment_count=1, archive=False):
+        self.version = version
+        self.recipients = recipients or []
+        self.compression = compression
+        # Plaintext size in bytes, None if not recorded
+        self.original_size = original_size
+        # None for a single GCM stream, else plaintext bytes per segment
+        self.segment_size = segment_size
+        # None if unknown (segmented stream written to a pipe)
+        self.segment_count = segment_count
+        # True for a multi-file archive (see enc_archive.py)
+        self.archive = archive
+        # Offset of the IV, i.e. first byte after the header
+        self.body_offset = 0
+
+
+def _encode_fields(fields):
+    out = b""
+    for tag, value in fields:
+        if len(value) > 0xFFFF:
+            raise InvalidFormat(f"Header field 0x{tag:02X} too long ({len(value)} bytes)")
+        out += struct.pack('>BH', tag, len(value)) + value
+    return out
+
+
+def _decode_fields(data):
+    fields = []
+    offset = 0
+    while offset < len(data):
+        if offset + 3 > len(data):
+            raise InvalidFormat("Truncated header field")
+        tag, length = struct.unpack('>BH', data[offset:offset + 3])
+        offset += 3
+        if offset + length > len(data):
+            raise InvalidFormat(f"Truncated header field 0x{tag:02X}")
+        fields.append((tag, data[offset:offset + length]))
+        offset += length
+    return fields
+
+
+def encode_recipient(recipient):
+    fields = [
+        (TAG_WRAP_ALG, bytes([recipient.wrap_alg])),
+        (TAG_WRAPPED_KEY, recipient.wrapped_key),
+    ]
+    if recipient.ephemeral_point is not None:
+        fields.append((TAG_EPHEMERAL_POINT, recipient.ephemeral_point))
+    if recipient.curve_oid is not None:
+        fields.append((TAG_CURVE_OID, recipient.curve_oid))
+    if recipient.fingerprint is not None:
+        fields.append((TAG_KEY_FINGERPRINT, recipient.fingerprint))
+    if recipient.serial is not None:
+        fields.append((TAG_CARD_SERIAL, recipient.serial))
+    return _encode_fields(fields)
+
+
+def decode_recipient(data):
+    values = dict(_decode_fields(data))
+    if TAG_WRAP_ALG not in values or TAG_WRAPPED_KEY not in values:
+        raise InvalidFormat("Recipient entry without wrap algorithm or wrapped key")
+    return Recipient(
+        values[TAG_WRAP_ALG][0],
+        values[TAG_WRAPPED_KEY],
+        ephemeral_point=values.get(TAG_EPHEMERAL_POINT),
+        curve_oid=values.get(TAG_CURVE_OID),
+        fingerprint=values.get(TAG_KEY_FINGERPRINT),
+        serial=values.get(TAG_CARD_SERIAL),
+    )
+
+
+def encode_header(header):
+    """
+    Serialize a version 2 header (everything before the IV).
+
+    Args:
+        header: EncHeader object
+
+    Returns:
+        bytes: Encoded header
+    """
+    fields = [(TAG_RECIPIENT, encode_recipient(r)) for r in header.recipients]
+    if header.compression != COMPRESS_NONE:
+        fields.append((TAG_COMPRESSION, bytes([header.compression])))
+    if header.original_size is not None:
+        fields.append((TAG_ORIGINAL_SIZE, struct.pack('>Q', header.original_size)))
+    if header.segment_size is not None:
+        fields.append((TAG_SEGMENT_SIZE, struct.pack('>I', header.segment_size)))
+        if header.segment_count is not None:
+            fields.append((TAG_SEGMENT_COUNT, struct.pack('>I', header.segment_count)))
+    if header.archive:
+        fields.append((TAG_ARCHIVE, bytes([1])))
+    body = _encode_fields(fields)
+    return MAGIC + bytes([FORMAT_VERSION]) + struct.pack('>I', len(body)) + body
+
+
+def read_header(f):
+    """
+    Read the header of an encrypted file, legacy or version 2.
+
+    On return the file position is at the IV.
+
+    Args:
+        f: Binary file object positioned at the start of the file
+
+    Returns:
+        EncHeader: Parsed header
+
+    Raises:
+        InvalidFormat: If the header is truncated or malformed
+    """
+    start = f.read(len(MAGIC))
+    if start != MAGIC:
+        # Legacy RSA-only layout: the first 4 bytes are the wrapped key length
+        if len(start) < 4:
+            raise InvalidFormat("Invalid encrypted file format (too short)")
+        key_len = struct.unpack('>I', start[:4])[0]
+        if key_len > _MAX_HEADER_LENGTH:
+            raise InvalidFormat("Invalid encrypted file format (bad key length)")
+        # Read on from the bytes already consumed (works on pipes too)
+        wrapped_key = start[4:4 + key_len]
+        wrapped_key += f.read(key_len - len(wrapped_key))
+        if len(wrapped_key) < key_len:
+            raise InvalidFormat("Invalid encrypted file format (truncated key)")
+        header = EncHeader(FORMAT_VERSION_LEGACY,
+                           [Recipient(WRAP_RSA_PKCS1, wrapped_key)])
+        header.body_offset = 4 + key_len
+        return header
+
+    fixed = f.read(5)
+    if len(fixed) < 5:
+        raise InvalidFormat("Invalid encrypted file format (truncated header)")
+    version = fixed[0]
+    if version != FORMAT_VERSION:
+        raise InvalidFormat(f"Unsupported encrypted file version: {version}")
+    header_len = struct.unpack('>I', fixed[1:])[0]
+    if header_len > _MAX_HEADER_LENGTH:
+        raise InvalidFormat("Invalid encrypted file format (header too long)")
+    data = f.read(header_len)
+    if len(data) < header_len:
+        raise InvalidFormat("Invalid encrypted file format (truncated header)")
+
+    header = EncHeader(version, segment_count=None)
+    for tag, value in _decode_fields(data):
+        if tag == TAG_RECIPIENT:
+            header.recipients.append(decode_recipient(value))
+        elif tag == TAG_COMPRESSION and len(value) == 1:
+            header.compression = value[0]
+        elif tag == TAG_ORIGINAL_SIZE and len(value) == 8:
+            header.original_size = struct.unpack('>Q', value)[0]
+        elif tag == TAG_SEGMENT_SIZE and len(value) == 4:
+            header.segment_size = struct.unpack('>I', value)[0]
+        elif tag == TAG_SEGMENT_COUNT and len(value) == 4:
+            header.segment_count = struct.unpack('>I', value)[0]
+        elif tag == TAG_ARCHIVE:
+            header.archive = True
+    if not header.recipients:
+        raise InvalidFormat("Encrypted file has no recipient entry")
+    if header.segment_size == 0:
+        raise InvalidFormat("Invalid encrypted file format (zero segment size)")
+    if header.segment_size is None:
+        header.segment_count = 1
+    header.body_offset = len(MAGIC) + 5 + header_len
+    return header
+
+
+def segment_nonce(base_iv, index, final):
+    """
+    GCM nonce of a segment: 7 bytes of the base IV, the 4-byte segment
+    index and a final-segment flag byte.
+    """
+    return base_iv[:7] + struct.pack('>IB', index, 1 if final else 0)
+
+
+def select_recipient(header, fingerprint=None, serial=None):
+    """
+    Pick the recipient entry for the inserted card.
+
+    Entries carrying a fingerprint are matched against the card's key
+    fingerprint, card AES entries against its serial number. Files with a
+    single anonymous entry (legacy files) match any card.
+
+    Args:
+        header: EncHeader object
+        fingerprint: Fingerprint of the card's encryption key, or None
+        serial: Card serial number, or None
+
+    Returns:
+        Recipient, or None if the file was not encrypted for this card
+    """
+    for recipient in header.recipients:
+        if recipient.fingerprint is not None and recipient.fingerprint == fingerprint:
+            return recipient
+        if recipient.serial is not None and recipient.serial == serial:
+            return recipient
+    if len(header.recipients) == 1:
+        recipient = header.recipients[0]
+        if recipient.fingerprint is None and recipient.serial is None:
+            return recipient
+    return None
+
+
+def _plausible_legacy(start, file_size):
+    # Legacy files have no magic: only accept RSA-sized wrapped keys
+    # (1024 to 4096 bits) followed by room for the IV and tag
+    if len(start) < 4:
+        return False
+    key_len = struct.unpack('>I', start[:4])[0]
+    return key_len in _LEGACY_KEY_LENGTHS and file_size >= 4 + key_len + IV_SIZE + TAG_SIZE
+
+
+def inspect_file(path):
+    """
+    Report the metadata of an encrypted file from its header only.
+
+    Args:
+        path: Path to the file
+
+    Returns:
+        dict: JSON-serializable metadata. 'format' is None and 'error' is
+        set if the file is not an encrypted file in a known format.
+    """
+    info = {'path': path, 'format': None}
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            # Check the magic, or the legacy key length, before reading
+            # anything else: arbitrary files must be rejected cheaply
+            start = f.read(len(MAGIC))
+            if start != MAGIC and not _plausible_legacy(start, file_size):
+                info['error'] = "Not an AEPGP encrypted file"
+                return info
+            f.seek(0)
+            header = read_header(f)
+    except (OSError, InvalidFormat) as e:
+        info['error'] = str(e)
+        return info
+
+    ciphertext_size = file_size - header.body_offset - IV_SIZE - TAG_SIZE
+    original_size = header.original_size
+    if original_size is None and header.compression == COMPRESS_NONE and header.segment_size is None:
+        # GCM does not pad: uncompressed plaintext is as long as the ciphertext
+        original_size = ciphertext_size
+
+    info.update({
+        'format': "legacy" if header.version == FORMAT_VERSION_LEGACY else "v2",
+        'version': header.version,
+        'file_size': file_size,
+        'header_size': header.body_offset,
+        'cipher': DATA_CIPHER,
+        'data_key_bits': DATA_KEY_SIZE * 8,
+        'compression': COMPRESSION_NAMES.get(header.compression, header.compression),
+        'segment_size': header.segment_size,
+        'segment_count': header.segment_count,
+        'original_size': original_size,
+        'archive': header.archive,
+        'recipients': [{
+            'wrap_alg': WRAP_ALG_NAMES.get(r.wrap_alg, r.wrap_alg),
+            'wrapped_key_length': len(r.wrapped_key),
+            'fingerprint': r.fingerprint.hex().upper() if r.fingerprint is not None else None,
+            'serial': r.serial.hex().upper() if r.serial is not None else None,
+            'curve_oid': r.curve_oid.hex() if r.curve_oid is not None else None,
+        } for r in header.recipients],
+    })
+    return info
+
+
+def _iter_files(paths, extension):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if extension is None or name.lower().endswith(extension):
+                        yield os.path.join(root, name)
+        else:
+            # Files named explicitly are always inspected
+            yield path
+
+
+def scan_paths(paths, extension='.enc', workers=8):
+    """
+    Inspect files and directory trees in parallel.
+
+    Args:
+        paths: List of file or directory paths
+        extension: Only inspect files with this extension inside
+                   directories (None for all files)
+        workers: Number of parallel reader threads
+
+    Returns:
+        Iterator of inspect_file() results, in path order
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for info in pool.map(inspect_file, _iter_files(paths, extension)):
+            yield info
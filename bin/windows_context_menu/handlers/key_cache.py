@@ -0,0 +1,177 @@
+"""
+AEPGP Local Public Key Cache
+
+This module keeps a local copy of the encryption public keys of the cards
+seen on this machine, so that files can be encrypted to several cards
+(e.g. all tokens of a team) while only one of them is inserted. Signature
+keys are cached as well (usage "signature"), so detached signatures can be
+verified without the card, and so are authentication keys (usage
+"authentication", see ssh_agent.py).
+
+Each cached key is stored as a small JSON file named after its
+fingerprint in the cache directory:
+    Windows: %LOCALAPPDATA%\\AEPGP\\keys
+    Others:  ~/.aepgp/keys
+The location can be overridden with the AEPGP_KEY_CACHE environment
+variable.
+"""
+
+import os
+import json
+import time
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+    logger = DummyLogger()
+
+
+def get_cache_dir():
+    """Return the key cache directory (not created)"""
+    override = os.environ.get('AEPGP_KEY_CACHE')
+    if override:
+        return override
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+        return os.path.join(base, 'AEPGP', 'keys')
+    return os.path.join(os.path.expanduser('~'), '.aepgp', 'keys')
+
+
+USAGE_ENCRYPTION = 'encryption'
+USAGE_SIGNATURE = 'signature'
+USAGE_AUTHENTICATION = 'authentication'
+
+
+class CachedKey:
+    """Public key of a card, as stored in the cache"""
+
+    def __init__(self, fingerprint, key_data, attributes=None, serial=None, alias=None, cached=None,
+                 usage=USAGE_ENCRYPTION, openpgp_fingerprint=None):
+        self.fingerprint = fingerprint
+        self.key_data = key_data
+        self.attributes = attributes
+        self.serial = serial
+        self.alias = alias
+        self.cached = cached
+        self.usage = usage
+        # v4 fingerprint the card presents to OpenPGP peers (DO C5 or computed)
+        self.openpgp_fingerprint = openpgp_fingerprint
+
+    def to_dict(self):
+        return {
+            'fingerprint': self.fingerprint.hex(),
+            'key_data': self.key_data.hex(),
+            'attributes': self.attributes.hex() if self.attributes is not None else None,
+            'serial': self.serial.hex() if self.serial is not None else None,
+            'alias': self.alias,
+            'cached': self.cached,
+            'usage': self.usage,
+            'openpgp_fingerprint': (self.openpgp_fingerprint.hex()
+                                    if self.openpgp_fingerprint is not None else None),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            bytes.fromhex(d['fingerprint']),
+            bytes.fromhex(d['key_data']),
+            attributes=bytes.fromhex(d['attributes']) if d.get('attributes') else None,
+            serial=bytes.fromhex(d['serial']) if d.get('serial') else None,
+            alias=d.get('alias'),
+            cached=d.get('cached'),
+            usage=d.get('usage', USAGE_ENCRYPTION),
+            openpgp_fingerprint=(bytes.fromhex(d['openpgp_fingerprint'])
+                                 if d.get('openpgp_fingerprint') else None),
+        )
+
+    def describe(self):
+        label = self.alias or (self.serial.hex().upper() if self.serial else "unknown card")
+        return f"{label} ({self.fingerprint.hex().upper()})"
+
+
+def cache_key(entry):
+    """
+    Store or refresh a key in the cache.
+
+    Args:
+        entry: CachedKey object
+
+    Returns:
+        bool: True on success
+    """
+    try:
+        cache_dir = get_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        entry.cached = int(time.time())
+        path = os.path.join(cache_dir, entry.fingerprint.hex().upper() + '.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+        logger.debug(f"Cached public key {entry.describe()} in {cache_dir}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to cache public key: {e}", e)
+        return False
+
+
+def load_cached_keys(usage=USAGE_ENCRYPTION):
+    """
+    Load the keys of one usage from the cache.
+
+    Args:
+        usage: USAGE_ENCRYPTION, USAGE_SIGNATURE or USAGE_AUTHENTICATION
+
+    Returns:
+        list: CachedKey objects (unreadable entries are skipped)
+    """
+    cache_dir = get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return []
+    keys = []
+    for name in sorted(os.listdir(cache_dir)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(cache_dir, name), 'r', encoding='utf-8') as f:
+                entry = CachedKey.from_dict(json.load(f))
+            if entry.usage == usage:
+                keys.append(entry)
+        except Exception as e:
+            logger.error(f"Skipping unreadable key cache entry {name}: {e}")
+    return keys
+
+
+def find_cached_key(selector, keys=None, usage=USAGE_ENCRYPTION):
+    """
+    Find a cached key by fingerprint (or unique fingerprint prefix), card
+    serial number or alias.
+
+    Args:
+        selector: Hex fingerprint/prefix, hex serial or alias string
+        keys: Optional list of CachedKey to search instead of the cache
+        usage: Key usage searched when keys is None
+
+    Returns:
+        CachedKey, or None if no unique match
+    """
+    if keys is None:
+        keys = load_cached_keys(usage)
+    wanted = selector.replace(' ', '').upper()
+    if not wanted:
+        return None
+    matches = [k for k in keys
+               if k.fingerprint.hex().upper().startswith(wanted)
+               or (k.openpgp_fingerprint is not None
+                   and k.openpgp_fingerprint.hex().upper().startswith(wanted))
+               or (k.serial is not None and k.serial.hex().upper() == wanted)
+               or (k.alias is not None and k.alias == selector)]
+    if len(matches) != 1:
+        return None
+    return matches[0]
@@ -0,0 +1,321 @@
+"""
+AEPGP Data Key Wrapping
+
+This module wraps the per-file AES data key for the card's decryption key
+and unwraps it again with the card's private key.
+
+Supported wrapping algorithms (see enc_format.py):
+- RSA PKCS#1 v1.5: the data key is encrypted to the card's RSA key and
+  recovered with PSO:DECIPHER.
+- ECDH: the host performs an ephemeral ECDH against the card's public
+  point, derives a key-encryption key with HKDF-SHA256 and wraps the data
+  key with AES key wrap (RFC 3394). On decryption the ephemeral point is
+  sent with PSO:DECIPHER and the card returns the shared secret.
+- Card AES: the data key is encrypted with the AES key stored on the card
+  (DO D5) via PSO:ENCIPHER and recovered with PSO:DECIPHER. This needs the
+  card and the user PIN at encryption time, but unwrapping is a single
+  symmetric operation on the card, much faster than an RSA private key
+  operation.
+"""
+
+import sys
+
+from enc_format import Recipient, select_recipient, WRAP_RSA_PKCS1, WRAP_ECDH, WRAP_CARD_AES
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+        def warning(self, msg): pass
+    logger = DummyLogger()
+
+try:
+    from cryptography.hazmat.primitives.asymmetric import ec, padding
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap
+    from cryptography.hazmat.backends import default_backend
+except ImportError:
+    logger.error("Cryptography library not found. Install it with: pip install cryptography")
+    print("ERROR: Cryptography library not found.")
+    sys.exit(1)
+
+
+_ECDH_KDF_INFO = b"AEPGP ECDH data key wrap"
+
+
+class CardPublicKey:
+    """Public half of the card's decryption key, ready for wrapping"""
+
+    def __init__(self, wrap_alg, public_key, curve_oid=None, record=None):
+        self.wrap_alg = wrap_alg
+        self.public_key = public_key
+        self.curve_oid = curve_oid
+        # card_key_reader.PublicKeyRecord the key was parsed from, if any
+        self.record = record
+
+    def describe(self):
+        if self.wrap_alg == WRAP_ECDH:
+            return f"ECDH {self.public_key.curve.name}"
+        return f"RSA-{self.public_key.key_size}"
+
+
+def _encode_len(length):
+    if length > 0xff:
+        return [0x82, (length >> 8) & 0xff, length & 0xff]
+    if length > 0x7f:
+        return [0x81, length & 0xff]
+    return [length]
+
+
+def load_card_public_key(key_data, attributes):
+    """
+    Build a CardPublicKey from the card's GET PUBLIC KEY response.
+
+    Args:
+        key_data: Raw 7F49 response for the encryption key slot
+        attributes: Algorithm attributes of the encryption key slot (DO C2),
+                    or None to assume RSA
+
+    Returns:
+        CardPublicKey, or None on error
+    """
+    from card_key_reader import public_key_record, ALGO_ECDH, ALGO_RSA
+
+    if attributes and attributes[0] not in (ALGO_ECDH, ALGO_RSA):
+        logger.error(f"Card encryption key algorithm 0x{attributes[0]:02X} cannot wrap keys")
+        return None
+    # Records are shared, so the key object is only built once per key
+    record = public_key_record(key_data, attributes)
+    if record is None:
+        return None
+    public_key = record.public_key()
+    if public_key is None:
+        logger.error(f"Unsupported curve OID in algorithm attributes: {record.curve_oid.hex()}")
+        return None
+    if record.algorithm == ALGO_ECDH:
+        return CardPublicKey(WRAP_ECDH, public_key, record.curve_oid, record)
+    return CardPublicKey(WRAP_RSA_PKCS1, public_key, record=record)
+
+
+def _ecdh_kek(shared_secret, ephemeral_point):
+    """Derive the key-encryption key from the ECDH shared secret (X coordinate)"""
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=_ECDH_KDF_INFO + ephemeral_point,
+        backend=default_backend()
+    )
+    return hkdf.derive(bytes(shared_secret))
+
+
+def wrap_data_key(data_key, card_key):
+    """
+    Wrap an AES data key for the card's decryption key.
+
+    IMPORTANT — RSA padding scheme: PKCS#1 v1.5, NOT OAEP. The card's
+    PSO:DECIPHER expects PKCS#1 v1.5 ciphertext (0x00 padding indicator).
+
+    Args:
+        data_key: AES key bytes
+        card_key: CardPublicKey
+
+    Returns:
+        Recipient: Header entry carrying the wrapped key
+    """
+    if card_key.wrap_alg == WRAP_ECDH:
+        curve = card_key.public_key.curve
+        ephemeral = ec.generate_private_key(curve, default_backend())
+        ephemeral_point = ephemeral.public_key().public_bytes(
+            serialization.Encoding.X962,
+            serialization.PublicFormat.UncompressedPoint
+        )
+        shared_secret = ephemeral.exchange(ec.ECDH(), card_key.public_key)
+        kek = _ecdh_kek(shared_secret, ephemeral_point)
+        wrapped_key = aes_key_wrap(kek, data_key, default_backend())
+        return Recipient(WRAP_ECDH, wrapped_key,
+                         ephemeral_point=ephemeral_point,
+                         curve_oid=card_key.curve_oid)
+
+    wrapped_key = card_key.public_key.encrypt(data_key, padding.PKCS1v15())
+    return Recipient(WRAP_RSA_PKCS1, wrapped_key)
+
+
+def _transmit_pso(card, p1_p2, pso_data, extended=False):
+    """Send a PSO command and collect a possibly chained response"""
+    from card_utils import transmit_with_response
+
+    data_len = len(pso_data)
+    if extended:
+        # Extended APDU: CLA INS P1 P2 00 Lc_high Lc_low Data Le_high Le_low
+        pso_cmd = [0x00, 0x2A] + p1_p2 + [0x00, (data_len >> 8) & 0xFF, data_len & 0xFF] + pso_data + [0x00, 0x00]
+    else:
+        pso_cmd = [0x00, 0x2A] + p1_p2 + [data_len] + pso_data + [0x00]
+
+    logger.debug(f"Sending PSO command: {len(pso_cmd)} bytes (data: {data_len} bytes)")
+    return transmit_with_response(card, pso_cmd)
+
+
+def _transmit_decipher(card, decipher_data, extended):
+    return _transmit_pso(card, [0x80, 0x86], decipher_data, extended)
+
+
+def card_ecdh(card, point):
+    """
+    Compute the ECDH shared secret of the card's decryption key and a point.
+
+    The user PIN (PW1 mode 82) must already be verified.
+
+    Args:
+        card: AEPGPCard object with active connection
+        point: Uncompressed EC point (04 || X || Y)
+
+    Returns:
+        tuple: (X coordinate of the shared point: bytes or None, error_message: str or None)
+    """
+    point = list(point)
+    # A6 { 7F49 { 86 point } } as required by OpenPGP card 3.4, 7.2.11
+    do_86 = [0x86] + _encode_len(len(point)) + point
+    do_7f49 = [0x7F, 0x49] + _encode_len(len(do_86)) + do_86
+    decipher_data = [0xA6] + _encode_len(len(do_7f49)) + do_7f49
+
+    response, sw1, sw2 = _transmit_decipher(card, decipher_data, extended=False)
+    if sw1 != 0x90 or sw2 != 0x00:
+        return None, f"Decryption failed: SW={sw1:02X}{sw2:02X}"
+    return bytes(response), None
+
+
+def card_rsa_decipher(card, ciphertext):
+    """
+    Decrypt a PKCS#1 v1.5 RSA cryptogram with the card's decryption key.
+
+    The user PIN (PW1 mode 82) must already be verified.
+
+    Args:
+        card: AEPGPCard object with active connection
+        ciphertext: RSA cryptogram bytes
+
+    Returns:
+        tuple: (plaintext: bytes or None, error_message: str or None)
+    """
+    # The 0x00 padding-indicator byte signals PKCS#1 v1.5 per OpenPGP
+    # card spec (0x00 = PKCS#1 v1.5, 0x02 = OAEP).
+    decipher_data = [0x00] + list(ciphertext)
+    response, sw1, sw2 = _transmit_decipher(card, decipher_data, extended=True)
+    if sw1 != 0x90 or sw2 != 0x00:
+        return None, f"Decryption failed: SW={sw1:02X}{sw2:02X}"
+    return bytes(response), None
+
+
+def wrap_data_key_with_card(card, data_key):
+    """
+    Wrap an AES data key with the AES key stored on the card (PSO:ENCIPHER).
+
+    The user PIN (PW1 mode 82) must already be verified.
+
+    Args:
+        card: AEPGPCard object with active connection
+        data_key: AES key bytes (multiple of 16 bytes)
+
+    Returns:
+        tuple: (Recipient or None, error_message: str or None)
+    """
+    response, sw1, sw2 = _transmit_pso(card, [0x86, 0x80], list(data_key))
+    if sw1 == 0x69 and sw2 == 0x85:
+        return None, "No AES key stored on the card (use put-aes-key first)"
+    if sw1 != 0x90 or sw2 != 0x00:
+        return None, f"Card AES encryption failed: SW={sw1:02X}{sw2:02X}"
+    # Response is the 0x02 padding indicator followed by the cryptogram
+    if not response or response[0] != 0x02 or len(response) - 1 != len(data_key):
+        return None, f"Unexpected PSO:ENCIPHER response ({len(response)} bytes)"
+    return Recipient(WRAP_CARD_AES, bytes(response[1:])), None
+
+
+def select_card_recipient(card, header):
+    """
+    Pick the recipient entry of a header that the inserted card can unwrap.
+
+    The card's key fingerprint and serial number are only read when some
+    entry needs them.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        header: EncHeader object
+
+    Returns:
+        Recipient, or None if the file was not encrypted for this card
+    """
+    from card_key_reader import read_public_key_from_card, public_key_fingerprint
+    from card_utils import get_card_serial
+
+    fingerprint = None
+    serial = None
+    if any(r.fingerprint is not None for r in header.recipients):
+        key_data = read_public_key_from_card(card, 'encryption')
+        if key_data:
+            fingerprint = public_key_fingerprint(key_data)
+    if any(r.serial is not None for r in header.recipients):
+        serial = get_card_serial(card)
+    return select_recipient(header, fingerprint, serial)
+
+
+def unwrap_data_key(card, recipient, key_size=32):
+    """
+    Recover the AES data key with the card's private key.
+
+    The user PIN (PW1 mode 82) must already be verified.
+
+    Args:
+        card: AEPGPCard object with active connection
+        recipient: Recipient entry from the file header
+        key_size: Expected data key length in bytes
+
+    Returns:
+        tuple: (data_key: bytes or None, error_message: str or None)
+    """
+    if recipient.wrap_alg == WRAP_ECDH:
+        if not recipient.ephemeral_point:
+            return None, "Invalid encrypted file format (missing ephemeral key)"
+        shared_secret, error_msg = card_ecdh(card, recipient.ephemeral_point)
+        if error_msg:
+            return None, error_msg
+
+        kek = _ecdh_kek(shared_secret, recipient.ephemeral_point)
+        try:
+            data_key = aes_key_unwrap(kek, recipient.wrapped_key, default_backend())
+        except Exception:
+            return None, "Decryption failed: data key unwrap failed (wrong card?)"
+        return data_key, None
+
+    if recipient.wrap_alg == WRAP_CARD_AES:
+        # 0x02 padding indicator selects the card's AES key
+        decipher_data = [0x02] + list(recipient.wrapped_key)
+        response, sw1, sw2 = _transmit_decipher(card, decipher_data, extended=False)
+        if sw1 != 0x90 or sw2 != 0x00:
+            return None, f"Decryption failed: SW={sw1:02X}{sw2:02X}"
+        if len(response) != key_size:
+            return None, f"Decrypted key has wrong size: {len(response)} bytes (expected {key_size})"
+        return bytes(response), None
+
+    if recipient.wrap_alg == WRAP_RSA_PKCS1:
+        response, error_msg = card_rsa_decipher(card, recipient.wrapped_key)
+        if error_msg:
+            return None, error_msg
+
+        if len(response) < key_size:
+            return None, f"Decrypted key too short: {len(response)} bytes (expected {key_size})"
+        if len(response) > key_size:
+            logger.warning(
+                f"Card DECIPHER returned {len(response)} bytes (expected {key_size}). "
+                f"Using first {key_size} bytes as the AES key. "
+                "This may indicate unexpected card output — check card firmware."
+            )
+        return bytes(response[:key_size]), None
+
+    return None, f"Unsupported key wrapping algorithm: 0x{recipient.wrap_alg:02X}"
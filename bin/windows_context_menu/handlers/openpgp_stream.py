@@ -0,0 +1,1062 @@
+"""
+AEPGP Streaming OpenPGP Messages
+
+This module writes and reads RFC 4880 encrypted messages for the card's
+encryption key in constant memory, so card-encrypted data can be
+exchanged with GnuPG and other OpenPGP implementations:
+
+    PKESK v3 (tag 1)        session key encrypted to the card key
+                            (RSA PKCS#1 v1.5, or ECDH per RFC 6637)
+    SEIPD v1 (tag 18)       AES-256 CFB with modification detection code
+        Literal data (tag 11)
+        MDC (tag 19)
+
+The SEIPD and literal data packets are written with partial body lengths,
+so the input size does not need to be known in advance. The reader also
+accepts old-format packet headers, compressed data packets (tag 8, as
+GnuPG compresses by default), marker packets, several PKESK packets and
+ASCII armor.
+
+Detached signatures (tag 2, v4, binary document) made with the card's
+signature key are written and parsed by the signature helpers below
+(see card_sign.py for signing and verification).
+
+Key identification: the key ID in the PKESK is taken from the card's
+OpenPGP fingerprint (DO C5). When the card has no fingerprint, the
+wildcard key ID is used for RSA keys; ECDH needs a fingerprint for its
+KDF, so a v4 fingerprint is computed from the public key and the key
+generation date (DO CD). Such messages only decrypt with GnuPG if its
+copy of the key has the same fingerprint.
+"""
+
+import os
+import sys
+import bz2
+import zlib
+import struct
+import array
+import base64
+import hashlib
+import shutil
+import tempfile
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+        def warning(self, msg): pass
+    logger = DummyLogger()
+
+from cryptography.hazmat.primitives.asymmetric import ec, padding
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap
+from cryptography.hazmat.backends import default_backend
+try:
+    # OpenPGP CFB lives with the legacy modes in recent cryptography releases
+    from cryptography.hazmat.decrepit.ciphers.modes import CFB
+except ImportError:
+    CFB = modes.CFB
+
+from enc_format import WRAP_ECDH
+
+
+# Packet tags (RFC 4880, 4.3)
+TAG_PKESK = 1
+TAG_SIGNATURE = 2
+TAG_COMPRESSED = 8
+TAG_MARKER = 10
+TAG_LITERAL = 11
+TAG_SEIPD = 18
+TAG_MDC = 19
+
+# Public key algorithms (RFC 4880, 9.1 and RFC 6637)
+PUBKEY_RSA = 1
+PUBKEY_ECDH = 18
+PUBKEY_ECDSA = 19
+
+# Symmetric algorithms (RFC 4880, 9.2): ID -> key size
+SYM_AES128 = 7
+SYM_AES192 = 8
+SYM_AES256 = 9
+SYM_KEY_SIZES = {SYM_AES128: 16, SYM_AES192: 24, SYM_AES256: 32}
+
+# Hash algorithms (RFC 4880, 9.4)
+HASH_SHA256 = 8
+HASH_SHA384 = 9
+HASH_SHA512 = 10
+_HASHES = {HASH_SHA256: hashlib.sha256, HASH_SHA384: hashlib.sha384, HASH_SHA512: hashlib.sha512}
+HASH_IDS = {'sha256': HASH_SHA256, 'sha384': HASH_SHA384, 'sha512': HASH_SHA512}
+
+# Signature type and subpackets (RFC 4880, 5.2.1 and 5.2.3.1)
+SIG_BINARY_DOCUMENT = 0x00
+SUBPACKET_CREATION_TIME = 2
+SUBPACKET_ISSUER = 16
+SUBPACKET_ISSUER_FINGERPRINT = 33
+
+# Compression algorithms (RFC 4880, 9.3)
+COMPRESS_UNCOMPRESSED = 0
+COMPRESS_ZIP = 1
+COMPRESS_ZLIB = 2
+COMPRESS_BZIP2 = 3
+
+# ECDH KDF parameters (hash, key wrap algorithm) per curve, as used by
+# GnuPG when it creates ECDH keys
+ECDH_KDF_PARAMS = {
+    bytes([0x2A, 0x86, 0x48, 0xCE, 0x3D, 0x03, 0x01, 0x07]): (HASH_SHA256, SYM_AES128),
+    bytes([0x2B, 0x81, 0x04, 0x00, 0x22]): (HASH_SHA384, SYM_AES256),
+    bytes([0x2B, 0x81, 0x04, 0x00, 0x23]): (HASH_SHA512, SYM_AES256),
+    bytes([0x2B, 0x24, 0x03, 0x03, 0x02, 0x08, 0x01, 0x01, 0x07]): (HASH_SHA256, SYM_AES128),
+    bytes([0x2B, 0x24, 0x03, 0x03, 0x02, 0x08, 0x01, 0x01, 0x0B]): (HASH_SHA384, SYM_AES256),
+    bytes([0x2B, 0x24, 0x03, 0x03, 0x02, 0x08, 0x01, 0x01, 0x0D]): (HASH_SHA512, SYM_AES256),
+}
+
+WILDCARD_KEY_ID = bytes(8)
+
+# Partial body chunk size (must be a power of two, at least 512)
+PARTIAL_CHUNK_SIZE = 1 << 16
+
+_READ_SIZE = 65536
+_MDC_PACKET_SIZE = 22  # D3 14 + SHA-1
+
+
+class OpenPGPError(Exception):
+    pass
+
+
+def _mpi(value):
+    """Encode a big-endian unsigned integer as an OpenPGP MPI"""
+    value = bytes(value).lstrip(b'\x00')
+    bits = (len(value) - 1) * 8 + value[0].bit_length() if value else 0
+    return struct.pack('>H', bits) + value
+
+
+def _read_mpi(data, offset):
+    if offset + 2 > len(data):
+        raise OpenPGPError("Truncated MPI")
+    bits = struct.unpack('>H', data[offset:offset + 2])[0]
+    length = (bits + 7) // 8
+    offset += 2
+    if offset + length > len(data):
+        raise OpenPGPError("Truncated MPI")
+    return data[offset:offset + length], offset + length
+
+
+def _encode_length(length):
+    """New-format packet length (RFC 4880, 4.2.2)"""
+    if length < 192:
+        return bytes([length])
+    if length < 8384:
+        length -= 192
+        return bytes([(length >> 8) + 192, length & 0xFF])
+    return b'\xFF' + struct.pack('>I', length)
+
+
+def _packet(tag, body):
+    return bytes([0xC0 | tag]) + _encode_length(len(body)) + body
+
+
+def _checksum(data):
+    return struct.pack('>H', sum(data) & 0xFFFF)
+
+
+class OpenPGPRecipient:
+    """The card's encryption key as an OpenPGP recipient"""
+
+    def __init__(self, card_key, fingerprint, key_id=None):
+        # key_wrap.CardPublicKey
+        self.card_key = card_key
+        # v4 fingerprint, needed by the ECDH KDF
+        self.fingerprint = fingerprint
+        self.key_id = key_id if key_id is not None else fingerprint[-8:]
+
+    @property
+    def is_ecdh(self):
+        return self.card_key.wrap_alg == WRAP_ECDH
+
+
+def public_key_body(pubkey_algo, created, values, curve_oid=None):
+    """
+    Body of a v4 public key packet (RFC 4880, 5.5.2; RFC 6637, 9).
+
+    Args:
+        pubkey_algo: OpenPGP public key algorithm
+        created: Creation time (Unix timestamp)
+        values: Big-endian key material: [n, e] for RSA, [point] for EC
+        curve_oid: Curve OID of an EC key
+
+    Returns:
+        bytes: Packet body, without PGPy or cryptography objects
+    """
+    body = b'\x04' + struct.pack('>I', created) + bytes([pubkey_algo])
+    if curve_oid is not None:
+        body += bytes([len(curve_oid)]) + curve_oid
+    body += b''.join(_mpi(value) for value in values)
+    if pubkey_algo == PUBKEY_ECDH:
+        hash_id, kek_id = ECDH_KDF_PARAMS[curve_oid]
+        body += bytes([3, 1, hash_id, kek_id])
+    return body
+
+
+def v4_fingerprint(card_key, created):
+    """
+    Compute the OpenPGP v4 fingerprint of a card key.
+
+    The packet is the shared PublicKeyRecord's, so it is built once per
+    key and creation time.
+
+    Args:
+        card_key: CardPublicKey from key_wrap.load_card_public_key()
+        created: Creation time (Unix timestamp)
+    """
+    from card_key_reader import public_key_record
+
+    record = card_key.record
+    return public_key_record(record.key_data, record.attributes, created).openpgp_fingerprint()
+
+
+def load_card_recipient(card, key_slot='encryption'):
+    """
+    Read the card's encryption key and OpenPGP identity.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        key_slot: Key slot holding the decryption key
+
+    Returns:
+        OpenPGPRecipient, or None on error
+    """
+    from card_key_reader import read_public_key_record, read_openpgp_fingerprint
+    from key_wrap import load_card_public_key
+
+    record = read_public_key_record(card, key_slot)
+    if record is None:
+        return None
+    card_key = load_card_public_key(record.key_data, record.attributes)
+    if card_key is None:
+        return None
+    if card_key.wrap_alg == WRAP_ECDH and card_key.curve_oid not in ECDH_KDF_PARAMS:
+        logger.error(f"No OpenPGP ECDH parameters for curve {card_key.curve_oid.hex()}")
+        return None
+
+    fingerprint = read_openpgp_fingerprint(card, key_slot)
+    if fingerprint is not None:
+        return OpenPGPRecipient(card_key, fingerprint)
+
+    logger.warning("Card has no OpenPGP fingerprint for its encryption key; "
+                   f"using a computed one (creation time {record.created})")
+    key_id = None if card_key.wrap_alg == WRAP_ECDH else WILDCARD_KEY_ID
+    return OpenPGPRecipient(card_key, record.openpgp_fingerprint(), key_id)
+
+
+def _ecdh_param(recipient_fingerprint, curve_oid):
+    hash_id, kek_id = ECDH_KDF_PARAMS[curve_oid]
+    return (bytes([len(curve_oid)]) + curve_oid + bytes([PUBKEY_ECDH, 3, 1, hash_id, kek_id])
+            + b"Anonymous Sender    " + recipient_fingerprint)
+
+
+def _ecdh_kek(shared_x, recipient_fingerprint, curve_oid):
+    """RFC 6637, 7: KEK = Hash(00 00 00 01 || Z || Param), truncated"""
+    hash_id, kek_id = ECDH_KDF_PARAMS[curve_oid]
+    digest = _HASHES[hash_id](b'\x00\x00\x00\x01' + bytes(shared_x)
+                              + _ecdh_param(recipient_fingerprint, curve_oid)).digest()
+    return digest[:SYM_KEY_SIZES[kek_id]]
+
+
+def _pkcs5_pad(data):
+    pad = 8 - len(data) % 8
+    return data + bytes([pad]) * pad
+
+
+def _pkcs5_unpad(data):
+    if not data or data[-1] < 1 or data[-1] > 8 or data[-data[-1]:] != bytes([data[-1]]) * data[-1]:
+        raise OpenPGPError("Invalid session key padding")
+    return data[:-data[-1]]
+
+
+def encode_pkesk(recipient, sym_alg, session_key):
+    """
+    Build a PKESK packet carrying the session key for a recipient.
+
+    Returns:
+        bytes: Complete packet
+    """
+    m = bytes([sym_alg]) + session_key + _checksum(session_key)
+    card_key = recipient.card_key
+    body = b'\x03' + recipient.key_id
+    if recipient.is_ecdh:
+        ephemeral = ec.generate_private_key(card_key.public_key.curve, default_backend())
+        ephemeral_point = ephemeral.public_key().public_bytes(
+            serialization.Encoding.X962,
+            serialization.PublicFormat.UncompressedPoint
+        )
+        shared_x = ephemeral.exchange(ec.ECDH(), card_key.public_key)
+        kek = _ecdh_kek(shared_x, recipient.fingerprint, card_key.curve_oid)
+        wrapped = aes_key_wrap(kek, _pkcs5_pad(m), default_backend())
+        body += bytes([PUBKEY_ECDH]) + _mpi(ephemeral_point) + bytes([len(wrapped)]) + wrapped
+    else:
+        # PKCS#1 v1.5, as expected by the card's PSO:DECIPHER
+        body += bytes([PUBKEY_RSA]) + _mpi(card_key.public_key.encrypt(m, padding.PKCS1v15()))
+    return _packet(TAG_PKESK, body)
+
+
+class _PartialBodyWriter:
+    """Writes one packet whose body is emitted with partial body lengths"""
+
+    def __init__(self, out, tag, chunk_size=PARTIAL_CHUNK_SIZE):
+        self._out = out
+        self._chunk_size = chunk_size
+        self._power = chunk_size.bit_length() - 1
+        self._buffer = bytearray()
+        out.write(bytes([0xC0 | tag]))
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) > self._chunk_size:
+            self._out.write(bytes([0xE0 | self._power]))
+            self._out.write(self._buffer[:self._chunk_size])
+            del self._buffer[:self._chunk_size]
+
+    def close(self):
+        # The last part always carries a regular length, possibly zero
+        self._out.write(_encode_length(len(self._buffer)))
+        self._out.write(self._buffer)
+        self._buffer = bytearray()
+
+
+class _ArmorWriter:
+    """ASCII armor (RFC 4880, 6.2) for a binary output stream"""
+
+    def __init__(self, out, label=b"MESSAGE"):
+        self._out = out
+        self._label = label
+        self._buffer = bytearray()
+        self._crc = _CRC24_INIT
+        out.write(b"-----BEGIN PGP " + label + b"-----\n\n")
+
+    def write(self, data):
+        self._crc = _crc24(self._crc, data)
+        self._buffer += data
+        # 48 binary bytes per 64-character line
+        full = len(self._buffer) - len(self._buffer) % 48
+        for i in range(0, full, 48):
+            self._out.write(base64.b64encode(bytes(self._buffer[i:i + 48])) + b"\n")
+        del self._buffer[:full]
+
+    def close(self):
+        if self._buffer:
+            self._out.write(base64.b64encode(bytes(self._buffer)) + b"\n")
+        self._out.write(b"=" + base64.b64encode(struct.pack('>I', self._crc)[1:]) + b"\n")
+        self._out.write(b"-----END PGP " + self._label + b"-----\n")
+
+
+_CRC24_INIT = 0xB704CE
+_CRC24_POLY = 0x1864CFB
+
+
+def _make_crc24_tables():
+    """Slicing-by-4 tables: tables[k][b] is the CRC register after byte b
+    followed by k zero bytes"""
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= _CRC24_POLY
+        table.append(crc & 0xFFFFFF)
+    tables = [table]
+    for _ in range(3):
+        tables.append([((crc << 8) & 0xFFFFFF) ^ table[crc >> 16] for crc in tables[-1]])
+    return tables
+
+
+_CRC24_TABLES = _make_crc24_tables()
+
+
+def _crc24(crc, data):
+    t0, t1, t2, t3 = _CRC24_TABLES
+    # Four bytes per step, as big-endian words XORed with the register
+    whole = len(data) & ~3
+    words = array.array('I')
+    if words.itemsize == 4 and whole:
+        words.frombytes(bytes(data[:whole]))
+        if sys.byteorder == 'little':
+            words.byteswap()
+        for w in words:
+            x = w ^ (crc << 8)
+            crc = t3[x >> 24] ^ t2[(x >> 16) & 0xFF] ^ t1[(x >> 8) & 0xFF] ^ t0[x & 0xFF]
+    else:
+        whole = 0
+    for b in data[whole:]:
+        crc = ((crc << 8) & 0xFFFFFF) ^ t0[((crc >> 16) ^ b) & 0xFF]
+    return crc
+
+
+class _EncryptedSink:
+    """Output of the inner packets: hashed for the MDC and encrypted into the SEIPD body"""
+
+    def __init__(self, seipd, encryptor):
+        self._seipd = seipd
+        self._encryptor = encryptor
+        self.mdc = hashlib.sha1()
+
+    def write(self, data):
+        self.mdc.update(data)
+        self._seipd.write(self._encryptor.update(bytes(data)))
+
+
+class OpenPGPEncryptor:
+    """
+    Streaming writer for an encrypted OpenPGP message.
+
+    Usage:
+        enc = OpenPGPEncryptor(fout, [recipient])
+        enc.write(data) ...
+        enc.close()
+    """
+
+    def __init__(self, out, recipients, filename=b"", armor=False, timestamp=0,
+                 chunk_size=PARTIAL_CHUNK_SIZE):
+        if not recipients:
+            raise OpenPGPError("No recipient")
+        self._armor = _ArmorWriter(out) if armor else None
+        out = self._armor or out
+
+        session_key = os.urandom(SYM_KEY_SIZES[SYM_AES256])
+        for recipient in recipients:
+            out.write(encode_pkesk(recipient, SYM_AES256, session_key))
+
+        # SEIPD: version 1, then CFB with a zero IV over
+        # [random prefix + 2 repeated bytes][packets][MDC packet]
+        self._seipd = _PartialBodyWriter(out, TAG_SEIPD, chunk_size)
+        self._seipd.write(b'\x01')
+        self._encryptor = Cipher(algorithms.AES(session_key), CFB(bytes(16)),
+                                 backend=default_backend()).encryptor()
+        self._sink = _EncryptedSink(self._seipd, self._encryptor)
+        prefix = os.urandom(16)
+        self._sink.write(prefix + prefix[-2:])
+
+        # Literal data packet (binary), streamed inside the encrypted body
+        filename = bytes(filename)[:255]
+        self._literal = _PartialBodyWriter(self._sink, TAG_LITERAL, chunk_size)
+        self._literal.write(b'b' + bytes([len(filename)]) + filename + struct.pack('>I', timestamp))
+
+    def write(self, data):
+        self._literal.write(data)
+
+    def close(self):
+        self._literal.close()
+        # The MDC hash covers its own packet header
+        self._sink.mdc.update(b'\xD3\x14')
+        self._seipd.write(self._encryptor.update(b'\xD3\x14' + self._sink.mdc.digest()))
+        self._seipd.write(self._encryptor.finalize())
+        self._seipd.close()
+        if self._armor is not None:
+            self._armor.close()
+
+
+def encrypt_stream(fin, fout, recipients, filename=b"", armor=False):
+    """
+    Encrypt a binary stream to an OpenPGP message in constant memory.
+
+    Args:
+        fin: Binary file object to read plaintext from
+        fout: Binary file object to write the message to
+        recipients: List of OpenPGPRecipient
+        filename: File name stored in the literal data packet
+        armor: Write ASCII armor instead of binary packets
+
+    Returns:
+        int: Number of plaintext bytes encrypted
+    """
+    encryptor = OpenPGPEncryptor(fout, recipients, filename=filename, armor=armor)
+    total = 0
+    while True:
+        chunk = fin.read(_READ_SIZE)
+        if not chunk:
+            break
+        encryptor.write(chunk)
+        total += len(chunk)
+    encryptor.close()
+    return total
+
+
+class _Reader:
+    """Minimal buffered reader interface shared by the stream layers"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._eof = False
+
+    def _fill(self):
+        """Append more data to self._buffer, set self._eof when exhausted"""
+        raise NotImplementedError
+
+    def read(self, n=-1):
+        while not self._eof and (n < 0 or len(self._buffer) < n):
+            self._fill()
+        if n < 0:
+            n = len(self._buffer)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    def read_exact(self, n):
+        data = self.read(n)
+        if len(data) < n:
+            raise OpenPGPError("Truncated OpenPGP message")
+        return data
+
+    def peek_byte(self):
+        while not self._buffer and not self._eof:
+            self._fill()
+        return self._buffer[0] if self._buffer else None
+
+    def drain(self):
+        while not self._eof:
+            self._buffer.clear()
+            self._fill()
+        self._buffer.clear()
+
+
+class _FileReader(_Reader):
+    def __init__(self, f):
+        super().__init__()
+        self._f = f
+
+    def _fill(self):
+        data = self._f.read(_READ_SIZE)
+        if data:
+            self._buffer += data
+        else:
+            self._eof = True
+
+
+def _iter_lines(head, f):
+    """Yield the lines of a binary stream whose first bytes were already read"""
+    pending = bytes(head)
+    while True:
+        nl = pending.find(b"\n")
+        if nl >= 0:
+            yield pending[:nl + 1]
+            pending = pending[nl + 1:]
+            continue
+        data = f.read(_READ_SIZE)
+        if not data:
+            if pending:
+                yield pending
+            return
+        pending += data
+
+
+class _ArmorReader(_Reader):
+    """Decodes an ASCII-armored message and checks its CRC24"""
+
+    def __init__(self, lines, label=b"MESSAGE"):
+        super().__init__()
+        self._lines = lines
+        self._crc = _CRC24_INIT
+        begin = b"-----BEGIN PGP " + label + b"-----"
+        for line in self._lines:
+            if line.startswith(begin):
+                break
+        else:
+            raise OpenPGPError(f"No PGP {label.decode()} armor found")
+        # Skip armor headers up to the blank line
+        for line in self._lines:
+            if not line.strip():
+                break
+
+    def _fill(self):
+        line = next(self._lines, b"").strip()
+        if not line or line.startswith(b"-----END"):
+            self._eof = True
+            return
+        if line.startswith(b"="):
+            # Base64 data lines never start with "=": this is the checksum
+            expected = int.from_bytes(base64.b64decode(line[1:]), 'big')
+            if expected != self._crc:
+                raise OpenPGPError("ASCII armor checksum mismatch")
+            return
+        data = base64.b64decode(line)
+        self._crc = _crc24(self._crc, data)
+        self._buffer += data
+
+
+def _open_input(f, label=b"MESSAGE"):
+    """Wrap a binary file object, detecting ASCII armor"""
+    head = f.read(_READ_SIZE)
+    if not head:
+        raise OpenPGPError("Empty OpenPGP message")
+    if head[0] & 0x80:
+        reader = _FileReader(f)
+        reader._buffer += head
+        return reader
+    # Not a binary packet: treat as armored text
+    return _ArmorReader(_iter_lines(head, f), label)
+
+
+def _read_new_length(reader):
+    """Returns (length, partial)"""
+    first = reader.read_exact(1)[0]
+    if first < 192:
+        return first, False
+    if first < 224:
+        return ((first - 192) << 8) + reader.read_exact(1)[0] + 192, False
+    if first == 255:
+        return struct.unpack('>I', reader.read_exact(4))[0], False
+    return 1 << (first & 0x1F), True
+
+
+def _read_packet_header(reader):
+    """
+    Returns (tag, length, partial) or None at end of stream. length is
+    None for old-format indeterminate lengths (body runs to the end).
+    """
+    first = reader.read(1)
+    if not first:
+        return None
+    first = first[0]
+    if not first & 0x80:
+        raise OpenPGPError(f"Invalid OpenPGP packet header: 0x{first:02X}")
+    if first & 0x40:
+        length, partial = _read_new_length(reader)
+        return first & 0x3F, length, partial
+    tag = (first >> 2) & 0x0F
+    length_type = first & 0x03
+    if length_type == 3:
+        return tag, None, False
+    size = (1, 2, 4)[length_type]
+    return tag, int.from_bytes(reader.read_exact(size), 'big'), False
+
+
+class _PacketBodyReader(_Reader):
+    """Body of one packet, following partial body length continuations"""
+
+    def __init__(self, source, length, partial):
+        super().__init__()
+        self._source = source
+        self._remaining = length
+        self._partial = partial
+
+    def _fill(self):
+        if self._remaining is None:
+            data = self._source.read(_READ_SIZE)
+            if data:
+                self._buffer += data
+            else:
+                self._eof = True
+            return
+        while self._remaining == 0:
+            if not self._partial:
+                self._eof = True
+                return
+            self._remaining, self._partial = _read_new_length(self._source)
+        data = self._source.read(min(self._remaining, _READ_SIZE))
+        if not data:
+            raise OpenPGPError("Truncated OpenPGP packet")
+        self._remaining -= len(data)
+        self._buffer += data
+
+
+class _SEIPDReader(_Reader):
+    """Decrypts a SEIPD v1 body and checks the MDC at the end"""
+
+    def __init__(self, body, session_key):
+        super().__init__()
+        self._body = body
+        self._decryptor = Cipher(algorithms.AES(session_key), CFB(bytes(16)),
+                                 backend=default_backend()).decryptor()
+        self._mdc = hashlib.sha1()
+        self._held = b""
+        prefix = self._decryptor.update(body.read(18))
+        if len(prefix) < 18:
+            raise OpenPGPError("Truncated encrypted data packet")
+        if prefix[14:16] != prefix[16:18]:
+            raise OpenPGPError("Session key is wrong (quick check failed)")
+        self._mdc.update(prefix)
+
+    def _fill(self):
+        data = self._body.read(_READ_SIZE)
+        if not data:
+            self._finish()
+            return
+        data = self._held + self._decryptor.update(data)
+        # Hold back what may be the MDC packet until the end of the body
+        self._held = data[-_MDC_PACKET_SIZE:]
+        data = data[:-_MDC_PACKET_SIZE]
+        self._mdc.update(data)
+        self._buffer += data
+
+    def _finish(self):
+        held = self._held + self._decryptor.finalize()
+        if len(held) != _MDC_PACKET_SIZE or held[:2] != b'\xD3\x14':
+            raise OpenPGPError("Missing modification detection code")
+        self._mdc.update(held[:2])
+        if self._mdc.digest() != held[2:]:
+            raise OpenPGPError("Modification detected: the message was altered")
+        self._eof = True
+
+
+class _DecompressReader(_Reader):
+    """Body of a compressed data packet"""
+
+    def __init__(self, source, algo):
+        super().__init__()
+        self._source = source
+        if algo == COMPRESS_UNCOMPRESSED:
+            self._decompressor = None
+        elif algo == COMPRESS_ZIP:
+            self._decompressor = zlib.decompressobj(-15)
+        elif algo == COMPRESS_ZLIB:
+            self._decompressor = zlib.decompressobj()
+        elif algo == COMPRESS_BZIP2:
+            self._decompressor = bz2.BZ2Decompressor()
+        else:
+            raise OpenPGPError(f"Unsupported compression algorithm: {algo}")
+
+    def _fill(self):
+        data = self._source.read(_READ_SIZE)
+        if not data:
+            if hasattr(self._decompressor, 'flush'):
+                self._buffer += self._decompressor.flush()
+            self._eof = True
+            return
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        self._buffer += data
+
+
+class _PKESK:
+    def __init__(self, key_id, algo, ciphertext=None, point=None, wrapped=None):
+        self.key_id = key_id
+        self.algo = algo
+        self.ciphertext = ciphertext
+        self.point = point
+        self.wrapped = wrapped
+
+
+def _parse_pkesk(body):
+    if len(body) < 10 or body[0] != 3:
+        return None
+    key_id, algo = body[1:9], body[9]
+    if algo == PUBKEY_RSA:
+        ciphertext, _ = _read_mpi(body, 10)
+        return _PKESK(key_id, algo, ciphertext=ciphertext)
+    if algo == PUBKEY_ECDH:
+        point, offset = _read_mpi(body, 10)
+        if offset >= len(body):
+            raise OpenPGPError("Truncated ECDH session key packet")
+        length = body[offset]
+        return _PKESK(key_id, algo, point=point, wrapped=body[offset + 1:offset + 1 + length])
+    return _PKESK(key_id, algo)
+
+
+def _decrypt_session_key(card, pkesk, recipient):
+    """Recover (symmetric algorithm, session key) with the card"""
+    from key_wrap import card_ecdh, card_rsa_decipher
+
+    if recipient.is_ecdh:
+        shared_x, error_msg = card_ecdh(card, pkesk.point)
+        if error_msg:
+            raise OpenPGPError(error_msg)
+        kek = _ecdh_kek(shared_x, recipient.fingerprint, recipient.card_key.curve_oid)
+        try:
+            m = _pkcs5_unpad(aes_key_unwrap(kek, pkesk.wrapped, default_backend()))
+        except Exception:
+            raise OpenPGPError("Session key unwrap failed (wrong key?)")
+    else:
+        # The card expects a cryptogram as long as the modulus
+        size = (recipient.card_key.public_key.key_size + 7) // 8
+        m, error_msg = card_rsa_decipher(card, pkesk.ciphertext.rjust(size, b'\x00'))
+        if error_msg:
+            raise OpenPGPError(error_msg)
+
+    sym_alg, session_key, checksum = m[0], m[1:-2], m[-2:]
+    if SYM_KEY_SIZES.get(sym_alg) != len(session_key):
+        raise OpenPGPError(f"Unsupported symmetric algorithm: {sym_alg}")
+    if _checksum(session_key) != checksum:
+        raise OpenPGPError("Session key checksum mismatch")
+    return sym_alg, session_key
+
+
+def _copy_literal(reader, fout):
+    """Write the literal data found in a packet sequence, returns (size, filename)"""
+    while True:
+        header = _read_packet_header(reader)
+        if header is None:
+            raise OpenPGPError("No literal data in message")
+        tag, length, partial = header
+        body = _PacketBodyReader(reader, length, partial)
+        if tag == TAG_COMPRESSED:
+            return _copy_literal(_DecompressReader(body, body.read_exact(1)[0]), fout)
+        if tag == TAG_LITERAL:
+            body.read_exact(1)  # data format
+            filename = body.read_exact(body.read_exact(1)[0])
+            body.read_exact(4)  # date
+            total = 0
+            while True:
+                chunk = body.read(_READ_SIZE)
+                if not chunk:
+                    return total, filename
+                fout.write(chunk)
+                total += len(chunk)
+        if tag in (2, 4):
+            # Signature packets of signed messages are not verified here
+            logger.warning("Ignoring signature packet in encrypted message")
+            body.drain()
+            continue
+        raise OpenPGPError(f"Unexpected packet in encrypted data: tag {tag}")
+
+
+def decrypt_stream(card, fin, fout, recipient=None, release_unverified=False):
+    """
+    Decrypt an OpenPGP message (binary or armored) with the card.
+
+    The user PIN (PW1 mode 82) must already be verified. The integrity
+    check (MDC) is only complete at the end of the message, so the
+    plaintext is spooled to a temporary file and copied to fout once it
+    passed. Callers that discard fout on error themselves (e.g. writing to
+    a temporary file) can set release_unverified to stream it directly.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        fin: Binary file object to read the message from
+        fout: Binary file object to write the plaintext to
+        recipient: OpenPGPRecipient of the card (read from the card if None)
+        release_unverified: Write plaintext to fout before the MDC is checked
+
+    Returns:
+        tuple: (plaintext size: int, file name from the literal packet: bytes)
+
+    Raises:
+        OpenPGPError: If the message is malformed, not for this card or altered
+    """
+    if recipient is None:
+        recipient = load_card_recipient(card)
+        if recipient is None:
+            raise OpenPGPError("Failed to read the card's encryption key")
+
+    reader = _open_input(fin)
+    pkesks = []
+    while True:
+        header = _read_packet_header(reader)
+        if header is None:
+            raise OpenPGPError("No encrypted data in message")
+        tag, length, partial = header
+        body = _PacketBodyReader(reader, length, partial)
+        if tag == TAG_PKESK:
+            pkesk = _parse_pkesk(body.read())
+            if pkesk is not None:
+                pkesks.append(pkesk)
+        elif tag == TAG_MARKER:
+            body.drain()
+        elif tag == TAG_SEIPD:
+            break
+        elif tag == 9:
+            raise OpenPGPError("Encrypted data without integrity protection is not supported")
+        else:
+            raise OpenPGPError(f"Unsupported OpenPGP packet: tag {tag}")
+
+    algo = PUBKEY_ECDH if recipient.is_ecdh else PUBKEY_RSA
+    candidates = [p for p in pkesks if p.algo == algo and p.key_id == recipient.key_id]
+    candidates += [p for p in pkesks if p.algo == algo and p.key_id == WILDCARD_KEY_ID
+                   and p not in candidates]
+    if not candidates:
+        raise OpenPGPError("This message was not encrypted for the inserted card")
+
+    session_key = None
+    error = None
+    for pkesk in candidates:
+        try:
+            sym_alg, session_key = _decrypt_session_key(card, pkesk, recipient)
+            break
+        except OpenPGPError as e:
+            error = e
+    if session_key is None:
+        raise error
+
+    if body.read_exact(1) != b'\x01':
+        raise OpenPGPError("Unsupported encrypted data packet version")
+    plaintext = _SEIPDReader(body, session_key)
+    if release_unverified:
+        total, filename = _copy_literal(plaintext, fout)
+        # Consume any trailing packets and check the MDC
+        plaintext.drain()
+    else:
+        with tempfile.TemporaryFile() as spool:
+            total, filename = _copy_literal(plaintext, spool)
+            plaintext.drain()
+            spool.seek(0)
+            shutil.copyfileobj(spool, fout, _READ_SIZE)
+    logger.info(f"OpenPGP message decrypted: {total} bytes")
+    return total, filename
+
+
+def signing_key_v4_fingerprint(signing_key, created):
+    """Compute the OpenPGP v4 fingerprint of a card signature key (see v4_fingerprint())"""
+    from card_key_reader import public_key_record
+
+    return public_key_record(signing_key.key_data, signing_key.attributes,
+                             created).openpgp_fingerprint()
+
+
+def _pubkey_algo(signing_key):
+    from card_key_reader import ALGO_ECDSA
+    return PUBKEY_ECDSA if signing_key.algorithm == ALGO_ECDSA else PUBKEY_RSA
+
+
+def _subpacket(kind, data):
+    return _encode_length(len(data) + 1) + bytes([kind]) + data
+
+
+class OpenPGPSignature:
+    """A v4 binary document signature packet"""
+
+    def __init__(self, pubkey_algo, hash_id, hashed, unhashed, digest_prefix, mpis):
+        self.pubkey_algo = pubkey_algo
+        self.hash_id = hash_id
+        # Version through hashed subpackets, as covered by the signature
+        self.hashed = hashed
+        self.unhashed = unhashed
+        self.digest_prefix = digest_prefix
+        self.mpis = mpis
+
+    @property
+    def hash_name(self):
+        return {v: k for k, v in HASH_IDS.items()}.get(self.hash_id)
+
+    def _subpackets(self, area):
+        offset = 0
+        while offset < len(area):
+            first = area[offset]
+            if first < 192:
+                length, offset = first, offset + 1
+            elif first < 255:
+                length, offset = ((first - 192) << 8) + area[offset + 1] + 192, offset + 2
+            else:
+                length, offset = struct.unpack('>I', area[offset + 1:offset + 5])[0], offset + 5
+            if length == 0 or offset + length > len(area):
+                raise OpenPGPError("Malformed signature subpacket")
+            yield area[offset] & 0x7F, area[offset + 1:offset + length]
+            offset += length
+
+    def _find(self, kind):
+        for area in (self.hashed[6:], self.unhashed):
+            for k, data in self._subpackets(area):
+                if k == kind:
+                    return data
+        return None
+
+    @property
+    def issuer_fingerprint(self):
+        data = self._find(SUBPACKET_ISSUER_FINGERPRINT)
+        return data[1:] if data and data[0] == 4 else None
+
+    @property
+    def issuer_key_id(self):
+        data = self._find(SUBPACKET_ISSUER)
+        if data is not None:
+            return data
+        fingerprint = self.issuer_fingerprint
+        return fingerprint[-8:] if fingerprint else None
+
+    @property
+    def created(self):
+        data = self._find(SUBPACKET_CREATION_TIME)
+        return struct.unpack('>I', data)[0] if data and len(data) == 4 else None
+
+    def trailer(self):
+        """Bytes hashed after the signed data (RFC 4880, 5.2.4)"""
+        return self.hashed + b'\x04\xff' + struct.pack('>I', len(self.hashed))
+
+
+def new_signature(signing_key, hash_name, fingerprint, timestamp):
+    """
+    Start a binary document signature; hash the data, then sig.trailer(),
+    and complete it with finish_signature().
+    """
+    hashed_subpackets = (_subpacket(SUBPACKET_CREATION_TIME, struct.pack('>I', timestamp))
+                         + _subpacket(SUBPACKET_ISSUER_FINGERPRINT, b'\x04' + fingerprint))
+    pubkey_algo = _pubkey_algo(signing_key)
+    hash_id = HASH_IDS[hash_name]
+    hashed = (bytes([4, SIG_BINARY_DOCUMENT, pubkey_algo, hash_id])
+              + struct.pack('>H', len(hashed_subpackets)) + hashed_subpackets)
+    unhashed = _subpacket(SUBPACKET_ISSUER, fingerprint[-8:])
+    return OpenPGPSignature(pubkey_algo, hash_id, hashed, unhashed, None, [])
+
+
+def finish_signature(sig, digest, card_signature):
+    """Attach the card's signature (RSA bytes, ECDSA r || s) to sig"""
+    sig.digest_prefix = digest[:2]
+    if sig.pubkey_algo == PUBKEY_RSA:
+        sig.mpis = [card_signature]
+    else:
+        half = len(card_signature) // 2
+        sig.mpis = [card_signature[:half], card_signature[half:]]
+    return sig
+
+
+def write_signature(fout, sig, armor=False):
+    body = (sig.hashed + struct.pack('>H', len(sig.unhashed)) + sig.unhashed
+            + sig.digest_prefix + b''.join(_mpi(v) for v in sig.mpis))
+    packet = _packet(TAG_SIGNATURE, body)
+    if armor:
+        writer = _ArmorWriter(fout, b"SIGNATURE")
+        writer.write(packet)
+        writer.close()
+    else:
+        fout.write(packet)
+
+
+def read_signature(f):
+    """
+    Read a detached signature (binary or armored).
+
+    Raises:
+        OpenPGPError: If no v4 signature packet is found
+    """
+    reader = _open_input(f, b"SIGNATURE")
+    while True:
+        header = _read_packet_header(reader)
+        if header is None:
+            raise OpenPGPError("No signature packet found")
+        tag, length, partial = header
+        body = _PacketBodyReader(reader, length, partial).read()
+        if tag == TAG_SIGNATURE:
+            break
+    if len(body) < 6 or body[0] != 4:
+        raise OpenPGPError("Only v4 signatures are supported")
+    hashed_len = struct.unpack('>H', body[4:6])[0]
+    offset = 6 + hashed_len
+    hashed = body[:offset]
+    unhashed_len = struct.unpack('>H', body[offset:offset + 2])[0]
+    offset += 2
+    unhashed = body[offset:offset + unhashed_len]
+    offset += unhashed_len
+    digest_prefix = body[offset:offset + 2]
+    offset += 2
+    mpis = []
+    while offset < len(body):
+        value, offset = _read_mpi(body, offset)
+        mpis.append(value)
+    if body[1] != SIG_BINARY_DOCUMENT:
+        raise OpenPGPError(f"Not a binary document signature (type 0x{body[1]:02X})")
+    return OpenPGPSignature(body[2], body[3], hashed, unhashed, digest_prefix, mpis)
+
+
+def card_signature_from_mpis(signing_key, sig):
+    """Convert the MPIs of sig back to the card's signature format"""
+    if sig.pubkey_algo != _pubkey_algo(signing_key):
+        return None
+    if sig.pubkey_algo == PUBKEY_RSA:
+        size = (signing_key.public_key.key_size + 7) // 8
+        return sig.mpis[0].rjust(size, b'\x00')
+    size = (signing_key.public_key.curve.key_size + 7) // 8
+    return b''.join(v.rjust(size, b'\x00') for v in sig.mpis[:2])
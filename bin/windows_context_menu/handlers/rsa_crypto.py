@@ -1,13 +1,12 @@
 """
 AEPGP RSA Encryption Module
 
-This module provides RSA encryption using the AEPGP card's public key.
-Uses the cryptography library for hybrid encryption (RSA + AES).
+This module provides hybrid encryption using the AEPGP card's public key.
+Uses the cryptography library for hybrid encryption (RSA or ECDH + AES).
 """
 
 import os
-import sys
-from pathlib import Path
+import struct
 
 # Import debug logger
 try:
@@ -20,24 +19,362 @@ except ImportError:
         def debug(self, msg): print(f"DEBUG: {msg}")
     logger = DummyLogger()
 
-try:
-    from cryptography.hazmat.primitives.asymmetric import rsa, padding
-    from cryptography.hazmat.primitives import hashes, serialization
+
+WRAP_MODE_PUBLIC_KEY = 'public-key'
+WRAP_MODE_CARD_AES = 'card-aes'
+
+
+_CHUNK = 65536  # 64 KiB streaming chunk size
+
+# Persist a checkpoint every this many segments in resumable mode
+_CHECKPOINT_SEGMENTS = 16
+
+
+def _encrypt_stream(input_file, tmp_cipher, aes_key, iv, header_recipients, compression):
+    """
+    Encrypt the whole file as a single AES-256-GCM stream into tmp_cipher.
+
+    AES-GCM auth_tag is only available after finalize(), but the file
+    format places auth_tag BEFORE the ciphertext. The ciphertext therefore
+    goes to a temp file first and the final output is assembled in the
+    correct order afterwards (see enc_format.py):
+        [header][12B IV][16B auth_tag][ciphertext]
+    The optional compression stage sits between the file reader and the
+    encryptor; the header records the algorithm actually used.
+
+    Returns:
+        tuple: (encoded header: bytes, auth_tag: bytes)
+    """
+    from enc_format import EncHeader, encode_header, COMPRESSION_NAMES
+    from compression import choose_compression, new_compressor
     from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
     from cryptography.hazmat.backends import default_backend
-    logger.info("Cryptography library imported successfully")
-except ImportError:
-    logger.error("Cryptography library not found. Install it with: pip install cryptography")
-    print("ERROR: Cryptography library not found.")
-    sys.exit(1)
+
+    logger.info("Encrypting file data with AES-256-GCM (streaming)...")
+    print("Encrypting file data...")
+    cipher = Cipher(
+        algorithms.AES(aes_key),
+        modes.GCM(iv),
+        backend=default_backend()
+    )
+    encryptor = cipher.encryptor()
+    bytes_processed = 0
+
+    with open(input_file, 'rb') as fin, open(tmp_cipher, 'wb') as ftmp:
+        chunk = fin.read(_CHUNK)
+        # The first chunk doubles as the compressibility sample
+        compression_alg = choose_compression(compression, chunk)
+        compressor = new_compressor(compression_alg)
+        if compression is not None:
+            logger.info(f"Compression: {COMPRESSION_NAMES[compression_alg]}")
+        while chunk:
+            if compressor is not None:
+                ftmp.write(encryptor.update(compressor.compress(chunk)))
+            else:
+                ftmp.write(encryptor.update(chunk))
+            bytes_processed += len(chunk)
+            chunk = fin.read(_CHUNK)
+        if compressor is not None:
+            ftmp.write(encryptor.update(compressor.flush()))
+        # finalize() flushes any buffered output and makes tag available
+        last_block = encryptor.finalize()
+        if last_block:
+            ftmp.write(last_block)
+
+    logger.info(f"File encrypted: {bytes_processed} bytes plaintext")
+    header = encode_header(EncHeader(recipients=header_recipients,
+                                     compression=compression_alg,
+                                     original_size=bytes_processed))
+    return header, encryptor.tag
 
 
-def encrypt_file_with_card_key(input_file, output_file):
+def seal_segment(aesgcm, iv, index, final, segment, compression_alg):
+    """Compress (optionally) and seal one segment, returns the segment record"""
+    from enc_format import TAG_SIZE, segment_nonce
+    from compression import new_compressor
+
+    compressor = new_compressor(compression_alg)
+    if compressor is not None:
+        segment = compressor.compress(segment) + compressor.flush()
+    sealed = aesgcm.encrypt(segment_nonce(iv, index, final), segment, None)
+    return struct.pack('>I', len(sealed) - TAG_SIZE) + sealed
+
+
+def _encrypt_segments(input_file, tmp_cipher, aes_key, checkpoint, ckpt_file, compression):
+    """
+    Encrypt the file as independently sealed segments into tmp_cipher,
+    starting from the position recorded in the checkpoint.
+
+    The checkpoint is saved every _CHECKPOINT_SEGMENTS segments, after the
+    segments it covers have been flushed to disk. On error the partial
+    output and the checkpoint are kept for the next run.
+
+    Returns:
+        bytes: Encoded header
+    """
+    from enc_format import EncHeader, encode_header, COMPRESSION_NAMES
+    from enc_checkpoint import save_checkpoint
+    from compression import choose_compression
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    logger.info("Encrypting file data with AES-256-GCM (resumable segments)...")
+    print("Encrypting file data...")
+    aesgcm = AESGCM(aes_key)
+    segment_size = checkpoint.segment_size
+
+    mode = 'r+b' if checkpoint.output_offset > 0 else 'wb'
+    with open(input_file, 'rb') as fin, open(tmp_cipher, mode) as ftmp:
+        # Drop anything written after the last checkpoint
+        ftmp.truncate(checkpoint.output_offset)
+        ftmp.seek(checkpoint.output_offset)
+        fin.seek(checkpoint.input_offset)
+
+        while not checkpoint.complete:
+            segment = fin.read(segment_size)
+            if checkpoint.compression is None:
+                # The first segment doubles as the compressibility sample
+                checkpoint.compression = choose_compression(compression, segment)
+                if compression is not None:
+                    logger.info(f"Compression: {COMPRESSION_NAMES[checkpoint.compression]}")
+            final = checkpoint.input_offset + len(segment) >= checkpoint.input_size
+
+            record = seal_segment(aesgcm, checkpoint.iv, checkpoint.segment_index, final,
+                                   segment, checkpoint.compression)
+            ftmp.write(record)
+
+            checkpoint.segment_index += 1
+            checkpoint.input_offset += len(segment)
+            checkpoint.output_offset += len(record)
+            checkpoint.complete = final
+            if final or checkpoint.segment_index % _CHECKPOINT_SEGMENTS == 0:
+                ftmp.flush()
+                os.fsync(ftmp.fileno())
+                save_checkpoint(ckpt_file, checkpoint)
+
+    logger.info(f"File encrypted: {checkpoint.input_offset} bytes plaintext, "
+                f"{checkpoint.segment_index} segments")
+    return encode_header(EncHeader(recipients=checkpoint.recipients,
+                                   compression=checkpoint.compression,
+                                   original_size=checkpoint.input_offset,
+                                   segment_size=segment_size,
+                                   segment_count=checkpoint.segment_index))
+
+
+def _assemble_output(output_file, header, prefix, tmp_cipher):
+    """
+    Write [header][prefix][ciphertext from tmp_cipher] to output_file
+    atomically (write to .tmp, then os.replace() so a crash never leaves a
+    partial .enc file).
+    """
+    logger.debug(f"Assembling encrypted output atomically: {output_file}")
+    tmp_output = output_file + ".tmp"
+    try:
+        with open(tmp_output, 'wb') as fout, open(tmp_cipher, 'rb') as fsrc:
+            fout.write(header)
+            fout.write(prefix)
+            while True:
+                chunk = fsrc.read(_CHUNK)
+                if not chunk:
+                    break
+                fout.write(chunk)
+        os.replace(tmp_output, output_file)  # atomic on both Windows and POSIX
+    except Exception:
+        if os.path.exists(tmp_output):
+            try:
+                os.remove(tmp_output)
+            except OSError:
+                pass
+        raise
+
+
+def wrap_for_card_key(card, aes_key):
+    """
+    Wrap the AES data key to the inserted card's encryption public key and
+    remember the card in the local key cache.
+
+    Returns:
+        tuple: (Recipient or None, error_message: str or None)
+    """
+    from card_utils import get_card_serial, get_key_alias
+    from card_key_reader import read_public_key_record
+    from key_cache import CachedKey, cache_key
+    from key_wrap import load_card_public_key, wrap_data_key
+
+    record = read_public_key_record(card, 'encryption')
+    if record is None:
+        return None, "Failed to read public key from card"
+
+    # RSA keys wrap with PKCS#1 v1.5, EC keys with ephemeral ECDH
+    card_key = load_card_public_key(record.key_data, record.attributes)
+    if card_key is None:
+        return None, "Failed to parse public key from card"
+    logger.info(f"Successfully loaded public key: {card_key.describe()}")
+
+    # IMPORTANT: RSA wrapping must stay PKCS#1 v1.5 — the card
+    # PSO:DECIPHER expects it (signalled by the 0x00 padding-indicator byte).
+    recipient = wrap_data_key(aes_key, card_key)
+    recipient.fingerprint = record.fingerprint
+    logger.info(f"AES key wrapped for {card_key.describe()}: {len(recipient.wrapped_key)} bytes")
+
+    # Remember this card so it can be used as an additional recipient later
+    cache_key(CachedKey(recipient.fingerprint, record.key_data, record.attributes,
+                        serial=get_card_serial(card), alias=get_key_alias(card)))
+    return recipient, None
+
+
+def resolve_recipients(recipients):
+    """
+    Look up additional recipients in the local key cache.
+
+    Returns:
+        tuple: (list of (CachedKey, CardPublicKey), error_message: str or None)
+    """
+    from key_cache import load_cached_keys, find_cached_key
+    from key_wrap import load_card_public_key
+
+    extra_keys = []
+    if not recipients:
+        return extra_keys, None
+    cached_keys = load_cached_keys()
+    for selector in recipients:
+        entry = find_cached_key(selector, cached_keys)
+        if entry is None:
+            return None, f"Recipient not found (or ambiguous) in key cache: {selector}"
+        card_key = load_card_public_key(entry.key_data, entry.attributes)
+        if card_key is None:
+            return None, f"Cached public key is unusable: {entry.describe()}"
+        extra_keys.append((entry, card_key))
+    return extra_keys, None
+
+
+def wrap_for_recipients(aes_key, header_recipients, extra_keys):
+    """Wrap the same AES key to every additional recipient"""
+    from key_wrap import wrap_data_key
+
+    for entry, card_key in extra_keys:
+        if any(r.fingerprint == entry.fingerprint for r in header_recipients):
+            continue
+        logger.info(f"Wrapping AES key for recipient {entry.describe()}...")
+        extra = wrap_data_key(aes_key, card_key)
+        extra.fingerprint = entry.fingerprint
+        header_recipients.append(extra)
+
+
+def _read_full(f, size):
+    """Read up to size bytes, fewer only at end of stream (pipes return short reads)"""
+    data = f.read(size)
+    while data and len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def encrypt_stream_with_card(card, fin, fout, recipients=None, compression=None,
+                             segment_size=None):
+    """
+    Encrypt a binary stream to the inserted card's public key in bounded
+    memory, e.g. from stdin to stdout.
+
+    The output is a segmented file (see enc_format.py) whose header is
+    written before the data, so it omits the plaintext size and segment
+    count. At most two segments of plaintext are held in memory.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        fin: Binary file object to read plaintext from
+        fout: Binary file object to write the encrypted stream to
+        recipients: Optional list of additional cards from the key cache
+        compression: None (off), 'auto', 'zlib' or 'zstd'
+        segment_size: Plaintext bytes per segment
+
+    Returns:
+        tuple: (success: bool, error_message: str or None)
+    """
+    try:
+        from enc_format import EncHeader, encode_header, DEFAULT_SEGMENT_SIZE
+        from compression import COMPRESSION_MODES, choose_compression
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        if compression not in COMPRESSION_MODES:
+            return False, f"Unknown compression mode: {compression}"
+        if segment_size is None:
+            segment_size = DEFAULT_SEGMENT_SIZE
+
+        extra_keys, error_msg = resolve_recipients(recipients)
+        if error_msg:
+            logger.error(error_msg)
+            return False, error_msg
+
+        aes_key = os.urandom(32)
+        iv = os.urandom(12)
+        recipient, error_msg = wrap_for_card_key(card, aes_key)
+        if error_msg:
+            logger.error(error_msg)
+            return False, error_msg
+        header_recipients = [recipient]
+        wrap_for_recipients(aes_key, header_recipients, extra_keys)
+
+        # The first segment doubles as the compressibility sample
+        segment = _read_full(fin, segment_size)
+        compression_alg = choose_compression(compression, segment)
+        fout.write(encode_header(EncHeader(recipients=header_recipients,
+                                           compression=compression_alg,
+                                           segment_size=segment_size,
+                                           segment_count=None)))
+        fout.write(iv)
+
+        # Read one segment ahead to know which one is the last
+        aesgcm = AESGCM(aes_key)
+        index = 0
+        total = 0
+        while True:
+            next_segment = _read_full(fin, segment_size)
+            final = not next_segment
+            fout.write(seal_segment(aesgcm, iv, index, final, segment, compression_alg))
+            total += len(segment)
+            if final:
+                break
+            segment = next_segment
+            index += 1
+        fout.flush()
+
+        logger.info(f"Stream encrypted: {total} bytes plaintext, {index + 1} segments")
+        return True, None
+
+    except Exception as e:
+        logger.error(f"Stream encryption failed with exception: {e}", e)
+        return False, f"Encryption failed: {str(e)}"
+
+
+def encrypt_file_with_card_key(input_file, output_file, wrap_mode=WRAP_MODE_PUBLIC_KEY, pin=None,
+                               recipients=None, compression=None, resumable=False,
+                               segment_size=None):
     """
     Encrypt a file using hybrid encryption (RSA + AES) with the card's public key.
 
-    Uses AES-256-GCM for file encryption and RSA PKCS#1 v1.5 for AES key
-    encryption.
+    Uses AES-256-GCM for file encryption. The AES key is wrapped according
+    to the card's decryption key type: RSA PKCS#1 v1.5 for RSA keys, or
+    ephemeral ECDH + HKDF + AES key wrap for EC keys (see key_wrap.py).
+    With wrap_mode='card-aes' the AES key is instead encrypted on the card
+    with its stored AES key (PSO:ENCIPHER), which requires the user PIN now
+    but makes unwrapping much faster at decryption time.
+
+    The inserted card's public key is stored in the local key cache (see
+    key_cache.py). Additional cards can be given in `recipients`: the same
+    AES key is then wrapped to each of their cached public keys, so any of
+    the cards can decrypt the file.
+
+    With `compression` set, the plaintext is compressed (zlib, or zstd when
+    available) before encryption unless a sample shows it does not compress
+    (see compression.py).
+
+    With `resumable` set, the file is written as independently sealed
+    segments and progress is checkpointed next to the output (see
+    enc_checkpoint.py). If a previous run for the same output was
+    interrupted, it is continued from the last checkpoint; this needs the
+    card and the user PIN to unwrap the data key again.
 
     IMPORTANT — padding scheme: RSA key encryption uses PKCS#1 v1.5, NOT OAEP.
     The card's PSO:DECIPHER APDU expects PKCS#1 v1.5 ciphertext; the mandatory
@@ -48,14 +385,24 @@ def encrypt_file_with_card_key(input_file, output_file):
     Args:
         input_file: Path to file to encrypt
         output_file: Path for encrypted output
+        wrap_mode: 'public-key' (card DEC key) or 'card-aes' (card AES key)
+        pin: User PIN, required for 'card-aes'
+        recipients: Optional list of additional cards to encrypt to, each a
+                    fingerprint (prefix), card serial or alias from the key cache
+        compression: None (off), 'auto', 'zlib' or 'zstd'
+        resumable: Write a segmented file that can be resumed after an interruption
+        segment_size: Plaintext bytes per segment in resumable mode
 
     Returns:
         tuple: (success: bool, error_message: str or None)
     """
     try:
-        from card_utils import find_aepgp_card
-        from card_key_reader import read_public_key_from_card, extract_rsa_public_key_components
-        import struct
+        from card_utils import find_aepgp_card, verify_user_pin, get_card_serial
+        from key_wrap import wrap_data_key_with_card
+        from key_wrap import select_card_recipient, unwrap_data_key
+        from enc_format import EncHeader, DEFAULT_SEGMENT_SIZE
+        from enc_checkpoint import EncCheckpoint, checkpoint_path, load_checkpoint, remove_checkpoint
+        from compression import COMPRESSION_MODES
 
         logger.info(f"Starting file encryption: {input_file}")
         print(f"Encrypting: {input_file}")
@@ -70,6 +417,62 @@ def encrypt_file_with_card_key(input_file, output_file):
         logger.info(f"Input file size: {file_size} bytes")
         print(f"File size: {file_size} bytes")
 
+        if wrap_mode not in (WRAP_MODE_PUBLIC_KEY, WRAP_MODE_CARD_AES):
+            error_msg = f"Unknown key wrapping mode: {wrap_mode}"
+            logger.error(error_msg)
+            return False, error_msg
+
+        if compression not in COMPRESSION_MODES:
+            error_msg = f"Unknown compression mode: {compression}"
+            logger.error(error_msg)
+            return False, error_msg
+
+        if wrap_mode == WRAP_MODE_CARD_AES and pin is None:
+            error_msg = "PIN not provided — card AES wrapping requires the user PIN"
+            logger.error(error_msg)
+            return False, error_msg
+
+        # Look for an interrupted run of the same job
+        if segment_size is None:
+            segment_size = DEFAULT_SEGMENT_SIZE
+        tmp_cipher = output_file + ".ciphertmp"
+        ckpt_file = checkpoint_path(output_file)
+        resume = None
+        if resumable:
+            resume = load_checkpoint(ckpt_file)
+            if resume is not None and not (
+                    resume.matches_input(input_file, segment_size)
+                    and os.path.exists(tmp_cipher)
+                    and os.path.getsize(tmp_cipher) >= resume.output_offset):
+                logger.info("Discarding checkpoint of a different or modified input file")
+                remove_checkpoint(ckpt_file)
+                resume = None
+            if resume is not None:
+                logger.info(f"Resuming at segment {resume.segment_index} "
+                            f"({resume.input_offset} of {resume.input_size} bytes)")
+                print(f"Resuming interrupted encryption at {resume.input_offset} of {file_size} bytes")
+                if pin is None:
+                    error_msg = ("PIN not provided — resuming needs the user PIN to recover the "
+                                 f"data key (or delete {ckpt_file} to start over)")
+                    logger.error(error_msg)
+                    return False, error_msg
+        elif os.path.exists(ckpt_file):
+            # A non-resumable run replaces any interrupted resumable one
+            remove_checkpoint(ckpt_file)
+
+        # Resolve additional recipients from the local key cache
+        extra_keys = []
+        if resume is None:
+            extra_keys, error_msg = resolve_recipients(recipients)
+            if error_msg:
+                logger.error(error_msg)
+                return False, error_msg
+
+        # Generate random AES key and IV
+        logger.debug("Generating AES key and IV...")
+        aes_key = os.urandom(32)  # 256-bit AES key
+        iv = os.urandom(12)       # 96-bit IV for GCM
+
         # Find and connect to card
         logger.info("Connecting to AEPGP card...")
         print("Connecting to AEPGP card...")
@@ -86,113 +489,84 @@ def encrypt_file_with_card_key(input_file, output_file):
             # Select OpenPGP applet
             card.select_applet()
 
-            # Read public key from card
-            logger.info("Reading public key from card...")
-            print("Reading public key from card...")
-            key_data = read_public_key_from_card(card, 'encryption')
-            if not key_data:
-                error_msg = "Failed to read public key from card"
-                logger.error(error_msg)
-                return False, error_msg
-
-            # Extract RSA components
-            modulus_bytes, exponent_bytes = extract_rsa_public_key_components(key_data)
-            if not modulus_bytes or not exponent_bytes:
-                error_msg = "Failed to extract RSA components"
-                logger.error(error_msg)
-                return False, error_msg
+            if resume is not None:
+                # Recover the data key wrapped in the checkpoint
+                header_recipients = resume.recipients
+                recipient = select_card_recipient(card, EncHeader(recipients=header_recipients))
+                if recipient is None:
+                    error_msg = "The interrupted encryption was started with another card"
+                    logger.error(error_msg)
+                    return False, error_msg
+                success, error_msg = verify_user_pin(card, pin)
+                if not success:
+                    logger.error(error_msg)
+                    return False, error_msg
+                aes_key, error_msg = unwrap_data_key(card, recipient)
+                if error_msg:
+                    logger.error(error_msg)
+                    return False, error_msg
+                iv = resume.iv
+                logger.info("Data key recovered from checkpoint")
+            elif wrap_mode == WRAP_MODE_CARD_AES:
+                # PSO:ENCIPHER requires PW1 (mode 82)
+                logger.info("Verifying PIN...")
+                print("Verifying PIN...")
+                success, error_msg = verify_user_pin(card, pin)
+                if not success:
+                    logger.error(error_msg)
+                    return False, error_msg
 
-            # Create RSA public key
-            n = int.from_bytes(modulus_bytes, byteorder='big')
-            e = int.from_bytes(exponent_bytes, byteorder='big')
-            public_numbers = rsa.RSAPublicNumbers(e, n)
-            rsa_public_key = public_numbers.public_key(default_backend())
+                logger.info("Wrapping AES key with the card AES key...")
+                print("Encrypting AES key with card AES key...")
+                recipient, error_msg = wrap_data_key_with_card(card, aes_key)
+                if error_msg:
+                    logger.error(error_msg)
+                    return False, error_msg
+                recipient.serial = get_card_serial(card)
+            else:
+                logger.info("Reading public key from card...")
+                print("Reading public key from card...")
+                recipient, error_msg = wrap_for_card_key(card, aes_key)
+                if error_msg:
+                    logger.error(error_msg)
+                    return False, error_msg
 
-            logger.info(f"Successfully loaded RSA public key: {n.bit_length()} bits")
-            print(f"Public key loaded: {n.bit_length()} bits")
+            if resume is None:
+                logger.info(f"AES key wrapped: {len(recipient.wrapped_key)} bytes")
+                header_recipients = [recipient]
 
         finally:
             card.disconnect()
             logger.debug("Card disconnected")
 
-        # Generate random AES key and IV
-        logger.debug("Generating AES key and IV...")
-        aes_key = os.urandom(32)  # 256-bit AES key
-        iv = os.urandom(12)       # 96-bit IV for GCM
-
-        # Stream plaintext through AES-256-GCM into a temp ciphertext file.
-        # AES-GCM auth_tag is only available after finalize(), but the file
-        # format places auth_tag BEFORE the ciphertext.  We therefore write
-        # ciphertext to a temp file first, then assemble the final output in
-        # the correct order:
-        #   [4B key_len][encrypted_key][12B IV][16B auth_tag][ciphertext]
-        _CHUNK = 65536  # 64 KiB streaming chunk size
-        logger.info("Encrypting file data with AES-256-GCM (streaming)...")
-        print("Encrypting file data...")
-        cipher = Cipher(
-            algorithms.AES(aes_key),
-            modes.GCM(iv),
-            backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
-        tmp_cipher = output_file + ".ciphertmp"
-        bytes_processed = 0
+        # Wrap the same AES key to every additional recipient
+        for entry, _ in extra_keys:  # empty when resuming
+            print(f"Adding recipient: {entry.describe()}")
+        wrap_for_recipients(aes_key, header_recipients, extra_keys)
 
-        try:
-            with open(input_file, 'rb') as fin, open(tmp_cipher, 'wb') as ftmp:
-                while True:
-                    chunk = fin.read(_CHUNK)
-                    if not chunk:
-                        break
-                    ftmp.write(encryptor.update(chunk))
-                    bytes_processed += len(chunk)
-                # finalize() flushes any buffered output and makes tag available
-                last_block = encryptor.finalize()
-                if last_block:
-                    ftmp.write(last_block)
-
-            auth_tag = encryptor.tag
-            logger.info(f"File encrypted: {bytes_processed} bytes plaintext")
-
-            # Encrypt the AES key with RSA PKCS#1 v1.5.
-            # IMPORTANT: Do NOT change to OAEP — the card PSO:DECIPHER expects
-            # PKCS#1 v1.5 (signalled by the 0x00 padding-indicator byte).
-            logger.info("Encrypting AES key with RSA-PKCS#1 v1.5...")
-            print("Encrypting AES key with card's public key...")
-            encrypted_aes_key = rsa_public_key.encrypt(aes_key, padding.PKCS1v15())
-            logger.info(f"AES key encrypted: {len(encrypted_aes_key)} bytes")
-
-            # Assemble the final output file atomically (write to .tmp, then
-            # os.replace() so a crash never leaves a partial .enc file).
-            logger.debug(f"Assembling encrypted output atomically: {output_file}")
-            tmp_output = output_file + ".tmp"
+        if resumable:
+            if resume is None:
+                st = os.stat(input_file)
+                resume = EncCheckpoint(os.path.abspath(input_file), st.st_size, st.st_mtime_ns,
+                                       segment_size, None, iv, header_recipients)
+            header = _encrypt_segments(input_file, tmp_cipher, aes_key, resume, ckpt_file,
+                                       compression)
+            _assemble_output(output_file, header, iv, tmp_cipher)
+            # Only discard the partial output once the final file is in place
+            remove_checkpoint(ckpt_file)
+            os.remove(tmp_cipher)
+        else:
             try:
-                with open(tmp_output, 'wb') as fout, open(tmp_cipher, 'rb') as fsrc:
-                    fout.write(struct.pack('>I', len(encrypted_aes_key)))
-                    fout.write(encrypted_aes_key)
-                    fout.write(iv)
-                    fout.write(auth_tag)
-                    while True:
-                        chunk = fsrc.read(_CHUNK)
-                        if not chunk:
-                            break
-                        fout.write(chunk)
-                os.replace(tmp_output, output_file)  # atomic on both Windows and POSIX
-            except Exception:
-                if os.path.exists(tmp_output):
+                header, auth_tag = _encrypt_stream(input_file, tmp_cipher, aes_key, iv,
+                                                   header_recipients, compression)
+                _assemble_output(output_file, header, iv + auth_tag, tmp_cipher)
+            finally:
+                # Always remove the intermediate ciphertext temp file
+                if os.path.exists(tmp_cipher):
                     try:
-                        os.remove(tmp_output)
+                        os.remove(tmp_cipher)
                     except OSError:
                         pass
-                raise
-
-        finally:
-            # Always remove the intermediate ciphertext temp file
-            if os.path.exists(tmp_cipher):
-                try:
-                    os.remove(tmp_cipher)
-                except OSError:
-                    pass
 
         logger.info(f"Encrypted file written successfully: {output_file}")
         print(f"Encryption successful!")
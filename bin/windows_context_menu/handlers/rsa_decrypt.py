@@ -1,13 +1,14 @@
 """
 AEPGP RSA Decryption Module
 
-This module provides RSA+AES hybrid decryption using the AEPGP card's private key.
+This module provides RSA/ECDH+AES hybrid decryption using the AEPGP card's private key.
 Decrypts files encrypted with rsa_crypto.py
 """
 
 import os
-import sys
+import shutil
 import struct
+import tempfile
 
 # Import debug logger
 try:
@@ -21,16 +22,190 @@ except ImportError:
     logger = DummyLogger()
 
 
+_CHUNK = 65536  # 64 KiB streaming chunk size
+
+
+def _decrypt_stream(fin, fout, aes_key, iv, auth_tag, header):
+    """Decrypt a single GCM stream, returns the plaintext size"""
+    from compression import new_decompressor
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
+
+    cipher = Cipher(
+        algorithms.AES(aes_key),
+        modes.GCM(iv, auth_tag),
+        backend=default_backend()
+    )
+    decryptor = cipher.decryptor()
+    decompressor = new_decompressor(header.compression)
+    bytes_written = 0
+    while True:
+        chunk = fin.read(_CHUNK)
+        if not chunk:
+            break
+        data = decryptor.update(chunk)
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        fout.write(data)
+        bytes_written += len(data)
+    # finalize() verifies the GCM tag and raises InvalidTag on mismatch
+    data = decryptor.finalize()
+    if decompressor is not None:
+        data = decompressor.decompress(data) + decompressor.flush()
+    fout.write(data)
+    bytes_written += len(data)
+    return bytes_written
+
+
+def _read_full(f, size):
+    """Read up to size bytes, fewer only at end of stream (pipes return short reads)"""
+    data = f.read(size)
+    while data and len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _decrypt_segments(fin, fout, aes_key, iv, header):
+    """
+    Decrypt a segmented body, returns the plaintext size.
+
+    Every segment is authenticated before its plaintext is written.
+
+    Raises:
+        InvalidFormat: If segments are truncated, missing or reordered
+    """
+    from compression import new_decompressor
+    from enc_format import InvalidFormat, SEGMENT_LENGTH_SIZE, TAG_SIZE, segment_nonce
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    aesgcm = AESGCM(aes_key)
+    # Compressed segments may expand slightly beyond segment_size
+    max_length = header.segment_size + header.segment_size // 8 + 1024
+    bytes_written = 0
+    index = 0
+    length_data = _read_full(fin, SEGMENT_LENGTH_SIZE)
+    while True:
+        if not length_data:
+            raise InvalidFormat("Encrypted file is truncated (last segment missing)")
+        if len(length_data) < SEGMENT_LENGTH_SIZE:
+            raise InvalidFormat(f"Encrypted file is truncated (segment {index})")
+        length = struct.unpack('>I', length_data)[0]
+        if length > max_length:
+            raise InvalidFormat(f"Invalid encrypted file format (segment {index} too long)")
+        sealed = _read_full(fin, length + TAG_SIZE)
+        if len(sealed) < length + TAG_SIZE:
+            raise InvalidFormat(f"Encrypted file is truncated (segment {index})")
+
+        # The nonce marks the last segment, so a file truncated at a segment
+        # boundary fails authentication instead of decrypting as complete.
+        # Reading the next length prefix ahead also works on pipes.
+        length_data = _read_full(fin, SEGMENT_LENGTH_SIZE)
+        final = not length_data
+        try:
+            data = aesgcm.decrypt(segment_nonce(iv, index, final), sealed, None)
+        except InvalidTag:
+            raise InvalidFormat(f"Segment {index} failed authentication "
+                                "(file corrupted, truncated or tampered with)")
+        decompressor = new_decompressor(header.compression)
+        if decompressor is not None:
+            data = decompressor.decompress(data) + decompressor.flush()
+        fout.write(data)
+        bytes_written += len(data)
+        index += 1
+        if final:
+            if header.segment_count is not None and index != header.segment_count:
+                raise InvalidFormat("Invalid encrypted file format (segment count mismatch)")
+            return bytes_written
+
+
+def decrypt_stream_with_card(card, fin, fout, release_unverified=False):
+    """
+    Decrypt an encrypted stream (e.g. stdin) with the inserted card.
+
+    The caller selects the applet and verifies the user PIN. Segmented
+    streams (see encrypt_stream_with_card()) release each segment only
+    after it has been authenticated. Single-tag files are only
+    authenticated at the end: their plaintext is spooled to a temporary
+    file and copied to fout once the tag has been checked, unless the
+    caller discards fout on error itself and sets release_unverified.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        fin: Binary file object to read the encrypted data from
+        fout: Binary file object to write the plaintext to
+        release_unverified: Stream single-tag plaintext to fout before the
+                            tag is checked
+
+    Returns:
+        tuple: (success: bool, error_message: str or None)
+    """
+    try:
+        from enc_format import read_header, InvalidFormat, IV_SIZE, TAG_SIZE
+        from key_wrap import select_card_recipient, unwrap_data_key
+        from cryptography.exceptions import InvalidTag
+
+        try:
+            header = read_header(fin)
+        except InvalidFormat as e:
+            return False, str(e)
+        if header.archive:
+            return False, "This is an archive, use 'extract' to unpack it"
+
+        iv = _read_full(fin, IV_SIZE)
+        if len(iv) < IV_SIZE:
+            return False, "Invalid encrypted file format (missing IV)"
+        auth_tag = None
+        if header.segment_size is None:
+            auth_tag = _read_full(fin, TAG_SIZE)
+            if len(auth_tag) < TAG_SIZE:
+                return False, "Invalid encrypted file format (missing auth tag)"
+
+        recipient = select_card_recipient(card, header)
+        if recipient is None:
+            return False, "This file was not encrypted for the inserted card"
+        aes_key, error_msg = unwrap_data_key(card, recipient)
+        if error_msg:
+            return False, error_msg
+
+        try:
+            if header.segment_size is not None:
+                bytes_written = _decrypt_segments(fin, fout, aes_key, iv, header)
+            elif release_unverified:
+                bytes_written = _decrypt_stream(fin, fout, aes_key, iv, auth_tag, header)
+            else:
+                with tempfile.TemporaryFile() as spool:
+                    bytes_written = _decrypt_stream(fin, spool, aes_key, iv, auth_tag, header)
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, fout, _CHUNK)
+        except InvalidFormat as e:
+            return False, str(e)
+        except InvalidTag:
+            return False, "Authentication failed (data corrupted or tampered with)"
+        fout.flush()
+
+        logger.info(f"Stream decrypted: {bytes_written} bytes")
+        return True, None
+
+    except Exception as e:
+        logger.error(f"Stream decryption failed with exception: {e}", e)
+        return False, f"Decryption failed: {str(e)}"
+
+
 def decrypt_file_with_card(input_file, output_file, pin=None):
     """
     Decrypt a file using the AEPGP card's private key.
 
-    The encrypted file format is:
-    [4 bytes: encrypted AES key length]
-    [encrypted AES key (256 bytes for RSA-2048)]
+    The encrypted file format is (see enc_format.py):
+    [header: wrapped AES key, legacy RSA layout or versioned container]
     [12 bytes: IV]
     [16 bytes: GCM auth tag]
     [ciphertext]
+    or, for files written in resumable mode, the IV followed by
+    independently sealed segments.
 
     Args:
         input_file: Path to encrypted file (.enc)
@@ -41,10 +216,10 @@ def decrypt_file_with_card(input_file, output_file, pin=None):
         tuple: (success: bool, error_message: str or None)
     """
     try:
-        from card_utils import find_aepgp_card
-        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-        from cryptography.hazmat.backends import default_backend
-        from smartcard.util import toHexString
+        from card_utils import find_aepgp_card, verify_user_pin
+        from enc_format import read_header, InvalidFormat, WRAP_ALG_NAMES, IV_SIZE, TAG_SIZE
+        from enc_format import COMPRESS_NONE, COMPRESSION_NAMES
+        from key_wrap import select_card_recipient, unwrap_data_key
 
         logger.info(f"Starting file decryption: {input_file}")
         print(f"Decrypting: {input_file}")
@@ -57,42 +232,44 @@ def decrypt_file_with_card(input_file, output_file, pin=None):
 
         logger.debug(f"Reading encrypted file...")
         with open(input_file, 'rb') as f:
-            # Read encrypted AES key length
-            key_len_bytes = f.read(4)
-            if len(key_len_bytes) < 4:
-                error_msg = "Invalid encrypted file format (too short)"
+            # Read header (legacy RSA layout or versioned container)
+            try:
+                header = read_header(f)
+            except InvalidFormat as e:
+                logger.error(str(e))
+                return False, str(e)
+            if header.archive:
+                error_msg = "This is an archive, use 'smartpgp-cli extract' to unpack it"
                 logger.error(error_msg)
                 return False, error_msg
 
-            encrypted_key_len = struct.unpack('>I', key_len_bytes)[0]
-            logger.debug(f"Encrypted AES key length: {encrypted_key_len} bytes")
-
-            # Read encrypted AES key
-            encrypted_aes_key = f.read(encrypted_key_len)
-            if len(encrypted_aes_key) < encrypted_key_len:
-                error_msg = "Invalid encrypted file format (truncated key)"
-                logger.error(error_msg)
-                return False, error_msg
+            logger.debug(
+                f"Format version {header.version}, recipients: "
+                + ", ".join(WRAP_ALG_NAMES.get(r.wrap_alg, str(r.wrap_alg)) for r in header.recipients)
+            )
 
             # Read IV
-            iv = f.read(12)
-            if len(iv) < 12:
+            iv = f.read(IV_SIZE)
+            if len(iv) < IV_SIZE:
                 error_msg = "Invalid encrypted file format (missing IV)"
                 logger.error(error_msg)
                 return False, error_msg
 
-            # Read GCM auth tag
-            auth_tag = f.read(16)
-            if len(auth_tag) < 16:
-                error_msg = "Invalid encrypted file format (missing auth tag)"
-                logger.error(error_msg)
-                return False, error_msg
+            # Read GCM auth tag (segmented files carry one tag per segment)
+            auth_tag = None
+            if header.segment_size is None:
+                auth_tag = f.read(TAG_SIZE)
+                if len(auth_tag) < TAG_SIZE:
+                    error_msg = "Invalid encrypted file format (missing auth tag)"
+                    logger.error(error_msg)
+                    return False, error_msg
 
-            # Read ciphertext
-            ciphertext = f.read()
+            # The ciphertext is streamed from here once the key is known
+            ciphertext_offset = f.tell()
 
-        logger.info(f"Read encrypted file: {len(ciphertext)} bytes ciphertext")
-        print(f"Encrypted data size: {len(ciphertext)} bytes")
+        ciphertext_size = os.path.getsize(input_file) - ciphertext_offset
+        logger.info(f"Read encrypted file header: {ciphertext_size} bytes ciphertext")
+        print(f"Encrypted data size: {ciphertext_size} bytes")
 
         # Find and connect to card
         logger.info("Connecting to AEPGP card...")
@@ -110,6 +287,14 @@ def decrypt_file_with_card(input_file, output_file, pin=None):
             # Select OpenPGP applet
             card.select_applet()
 
+            # Pick the recipient entry matching the inserted card
+            recipient = select_card_recipient(card, header)
+            if recipient is None:
+                error_msg = "This file was not encrypted for the inserted card"
+                logger.error(error_msg)
+                return False, error_msg
+            logger.debug(f"Using recipient entry: {WRAP_ALG_NAMES.get(recipient.wrap_alg, recipient.wrap_alg)}")
+
             # Verify PIN (required for decryption)
             logger.info("Verifying PIN...")
             print("Verifying PIN...")
@@ -122,64 +307,22 @@ def decrypt_file_with_card(input_file, output_file, pin=None):
                 logger.error(error_msg)
                 return False, error_msg
 
-            # Verify PIN APDU: 00 20 00 82 [length] [PIN]
-            pin_bytes = [ord(c) for c in pin]
-            verify_pin_cmd = [0x00, 0x20, 0x00, 0x82, len(pin_bytes)] + pin_bytes
-
-            response, sw1, sw2 = card.connection.transmit(verify_pin_cmd)
-            card._log_apdu(verify_pin_cmd, response, sw1, sw2)
-
-            if sw1 == 0x90 and sw2 == 0x00:
-                logger.info("PIN verified successfully")
-                print("PIN verified")
-            elif sw1 == 0x63:
-                retries = sw2 & 0x0F
-                error_msg = f"Wrong PIN. {retries} retries remaining"
-                logger.error(error_msg)
-                return False, error_msg
-            else:
-                error_msg = f"PIN verification failed: SW={sw1:02X}{sw2:02X}"
+            success, error_msg = verify_user_pin(card, pin)
+            if not success:
                 logger.error(error_msg)
                 return False, error_msg
+            print("PIN verified")
 
-            # Decrypt the AES key using card's private key via DECIPHER APDU
-            # PSO:DECIPHER format: 00 2A 80 86 [Lc] [0x00 + encrypted_data] [Le]
-            # The 0x00 padding-indicator byte signals PKCS#1 v1.5 per OpenPGP
-            # card spec (0x00 = PKCS#1 v1.5, 0x02 = OAEP).  The AES key was
-            # encrypted with PKCS#1 v1.5 on the host side — these must match.
+            # Recover the AES key with the card's private key via PSO:DECIPHER
+            # (RSA PKCS#1 v1.5, ECDH shared secret or on-card AES, see key_wrap.py)
             logger.info("Decrypting AES key with card's private key...")
             print("Decrypting AES key with card...")
 
-            # Prepare data: 0x00 padding indicator + encrypted AES key
-            decipher_data = [0x00] + list(encrypted_aes_key)
-            data_len = len(decipher_data)
-
-            # Use extended APDU: CLA INS P1 P2 00 Lc_high Lc_low Data Le_high Le_low
-            decipher_cmd = [0x00, 0x2A, 0x80, 0x86, 0x00, (data_len >> 8) & 0xFF, data_len & 0xFF] + decipher_data + [0x00, 0x00]
-
-            logger.debug(f"Sending DECIPHER command: {len(decipher_cmd)} bytes (data: {data_len} bytes including padding)")
-            response, sw1, sw2 = card.connection.transmit(decipher_cmd)
-            card._log_apdu(decipher_cmd, response, sw1, sw2)
-
-            if sw1 != 0x90 or sw2 != 0x00:
-                error_msg = f"Decryption failed: SW={sw1:02X}{sw2:02X}"
+            aes_key, error_msg = unwrap_data_key(card, recipient)
+            if error_msg:
                 logger.error(error_msg)
                 return False, error_msg
 
-            # The response contains the decrypted AES key (should be exactly 32 bytes).
-            if len(response) < 32:
-                error_msg = f"Decrypted key too short: {len(response)} bytes (expected 32)"
-                logger.error(error_msg)
-                return False, error_msg
-
-            if len(response) > 32:
-                logger.warning(
-                    f"Card DECIPHER returned {len(response)} bytes (expected 32). "
-                    "Using first 32 bytes as the AES-256 key. "
-                    "This may indicate unexpected card output — check card firmware."
-                )
-
-            aes_key = bytes(response[:32])  # 256-bit AES key
             logger.info(f"AES key decrypted: {len(aes_key)} bytes")
             print("AES key decrypted successfully")
 
@@ -191,23 +334,22 @@ def decrypt_file_with_card(input_file, output_file, pin=None):
         logger.info("Decrypting file data with AES-256-GCM...")
         print("Decrypting file data...")
 
-        cipher = Cipher(
-            algorithms.AES(aes_key),
-            modes.GCM(iv, auth_tag),
-            backend=default_backend()
-        )
-        decryptor = cipher.decryptor()
-        plaintext = decryptor.update(ciphertext) + decryptor.finalize()
-
-        logger.info(f"File decrypted: {len(plaintext)} bytes")
+        if header.compression != COMPRESS_NONE:
+            logger.info(f"Decompressing with {COMPRESSION_NAMES.get(header.compression, header.compression)}")
 
-        # Write decrypted file atomically: write to .tmp then os.replace() so
-        # a crash or card removal never leaves a partial/corrupt output file.
+        # Stream ciphertext -> plaintext into a .tmp file, then os.replace()
+        # so a crash, card removal or authentication failure never leaves a
+        # partial/corrupt output file. Unauthenticated plaintext only ever
+        # lands in the .tmp file, which is deleted if finalize() fails.
         logger.debug(f"Writing decrypted data atomically to: {output_file}")
         tmp_output = output_file + ".tmp"
         try:
-            with open(tmp_output, 'wb') as f:
-                f.write(plaintext)
+            with open(input_file, 'rb') as fin, open(tmp_output, 'wb') as fout:
+                fin.seek(ciphertext_offset)
+                if header.segment_size is not None:
+                    bytes_written = _decrypt_segments(fin, fout, aes_key, iv, header)
+                else:
+                    bytes_written = _decrypt_stream(fin, fout, aes_key, iv, auth_tag, header)
             os.replace(tmp_output, output_file)  # atomic on Windows and POSIX
         except Exception:
             if os.path.exists(tmp_output):
@@ -217,6 +359,8 @@ def decrypt_file_with_card(input_file, output_file, pin=None):
                     pass
             raise
 
+        logger.info(f"File decrypted: {bytes_written} bytes")
+
         logger.info(f"Decrypted file written successfully: {output_file}")
         print(f"Decryption successful!")
         print(f"Decrypted file: {output_file}")
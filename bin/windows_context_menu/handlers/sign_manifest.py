@@ -0,0 +1,287 @@
+"""
+AEPGP Signed File Manifests
+
+Signs any number of files with a single card signature. The files are
+hashed in parallel, their digests become the leaves of a Merkle tree and
+the card signs the root once (see card_sign.py). The manifest is a JSON
+file:
+
+    {
+      "version": 1,
+      "hash": "sha256",
+      "root": <hex>,
+      "signature": <hex>,
+      "signer": {algorithm, fingerprint, public_key, attributes},
+      "files": [{"path", "size", "digest", "proof": [["L"|"R", <hex>], ...]}, ...]
+    }
+
+Leaves are sorted by path and bind the path, size and digest of a file.
+Each file carries its inclusion proof (the sibling hashes from its leaf up
+to the root), so any subset of files can be verified on its own, without
+the card and without hashing the other files.
+
+The card signs hash(MANIFEST_CONTEXT || root), never a bare tree node.
+"""
+
+import os
+import json
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from card_sign import HASH_ALGORITHMS, SigningKey, hash_file
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+    logger = DummyLogger()
+
+MANIFEST_VERSION = 1
+MANIFEST_CONTEXT = b"AEPGP manifest v1\x00"
+
+# Domain separation between leaves and inner nodes
+_LEAF_PREFIX = b"\x00"
+_NODE_PREFIX = b"\x01"
+
+# Verification results
+STATUS_OK = "ok"
+STATUS_MODIFIED = "modified"
+STATUS_MISSING = "missing"
+STATUS_UNLISTED = "not in manifest"
+
+
+def leaf_hash(path, size, digest, hash_name='sha256'):
+    name = path.encode('utf-8')
+    return hashlib.new(hash_name, _LEAF_PREFIX + struct.pack('>H', len(name)) + name
+                       + struct.pack('>Q', size) + digest).digest()
+
+
+def _node_hash(left, right, hash_name):
+    return hashlib.new(hash_name, _NODE_PREFIX + left + right).digest()
+
+
+def merkle_tree(leaves, hash_name='sha256'):
+    """
+    Build a Merkle tree over leaf hashes.
+
+    An odd node at the end of a level is promoted to the next level
+    unchanged.
+
+    Returns:
+        tuple: (root: bytes, proofs: list of [("L"|"R", sibling hash)] per leaf)
+    """
+    if not leaves:
+        return hashlib.new(hash_name, _NODE_PREFIX).digest(), []
+    proofs = [[] for _ in leaves]
+    # positions[i] = index of leaf i's ancestor in the current level
+    positions = list(range(len(leaves)))
+    level = list(leaves)
+    while len(level) > 1:
+        for leaf, pos in enumerate(positions):
+            sibling = pos ^ 1
+            if sibling < len(level):
+                proofs[leaf].append(("L" if sibling < pos else "R", level[sibling]))
+        level = [_node_hash(level[i], level[i + 1], hash_name) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        positions = [pos // 2 for pos in positions]
+    return level[0], proofs
+
+
+def root_from_proof(leaf, proof, hash_name='sha256'):
+    node = leaf
+    for side, sibling in proof:
+        node = _node_hash(sibling, node, hash_name) if side == "L" else _node_hash(node, sibling, hash_name)
+    return node
+
+
+def signed_digest(root, hash_name='sha256'):
+    """Digest signed by the card for a Merkle root"""
+    return hashlib.new(hash_name, MANIFEST_CONTEXT + root).digest()
+
+
+def _list_files(path, exclude=None):
+    """Yield (source path, manifest path) below a directory, or for a single file"""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                if exclude is not None and os.path.abspath(full) == exclude:
+                    continue
+                yield full, os.path.relpath(full, path).replace(os.sep, '/')
+    else:
+        yield path, os.path.basename(path)
+
+
+def _hash_entry(item, hash_name):
+    source, name = item
+    try:
+        size = os.path.getsize(source)
+        return name, size, hash_file(source, hash_name)
+    except OSError:
+        return name, None, None
+
+
+def hash_files(items, hash_name='sha256', workers=8):
+    """
+    Hash (source path, manifest path) pairs in parallel.
+
+    Returns:
+        list of (manifest path, size, digest); size and digest are None for
+        unreadable files
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(lambda item: _hash_entry(item, hash_name), items))
+
+
+def create_manifest(card, path, pin, hash_name='sha256', workers=8, exclude=None):
+    """
+    Hash the files of a directory (or a single file) and sign them with one
+    card signature.
+
+    The user PIN is verified (PW1 mode 81) only once all files are hashed.
+
+    Args:
+        card: AEPGPCard object with the OpenPGP applet selected
+        path: Directory or file to sign; manifest paths are relative to it
+        pin: User PIN
+        hash_name: 'sha256', 'sha384' or 'sha512'
+        workers: Number of parallel hashing threads
+        exclude: Absolute path to skip (e.g. the manifest itself)
+
+    Returns:
+        tuple: (manifest: dict or None, error_message: str or None)
+    """
+    from card_utils import verify_signature_pin
+    from card_sign import read_signing_key, card_sign_digest, remember_signing_key
+
+    if hash_name not in HASH_ALGORITHMS:
+        return None, f"Unsupported hash algorithm: {hash_name}"
+    if not os.path.exists(path):
+        return None, f"Input not found: {path}"
+
+    signing_key, error_msg = read_signing_key(card)
+    if error_msg:
+        return None, error_msg
+
+    entries = sorted(hash_files(_list_files(path, exclude), hash_name, workers))
+    unreadable = [name for name, size, _ in entries if size is None]
+    if unreadable:
+        return None, "Cannot read: " + ", ".join(unreadable)
+    logger.info(f"Hashed {len(entries)} files with {hash_name}")
+
+    leaves = [leaf_hash(name, size, digest, hash_name) for name, size, digest in entries]
+    root, proofs = merkle_tree(leaves, hash_name)
+
+    success, error_msg = verify_signature_pin(card, pin)
+    if not success:
+        return None, error_msg
+    signature, error_msg = card_sign_digest(card, signing_key, signed_digest(root, hash_name), hash_name)
+    if error_msg:
+        return None, error_msg
+    logger.info(f"Manifest root signed with {signing_key.describe()}")
+    # verify_manifest() only trusts cached keys unless given a signer
+    remember_signing_key(card, signing_key)
+
+    return {
+        'version': MANIFEST_VERSION,
+        'hash': hash_name,
+        'root': root.hex(),
+        'signature': signature.hex(),
+        'signer': signing_key.to_dict(),
+        'files': [{
+            'path': name,
+            'size': size,
+            'digest': digest.hex(),
+            'proof': [[side, sibling.hex()] for side, sibling in proof],
+        } for (name, size, digest), proof in zip(entries, proofs)],
+    }, None
+
+
+def load_manifest(path):
+    """
+    Read a manifest file.
+
+    Raises:
+        ValueError: If the file is not a supported manifest
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version: {manifest.get('version')}")
+    if manifest.get('hash') not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm: {manifest.get('hash')}")
+    return manifest
+
+
+def verify_manifest(manifest, base_dir, names=None, signer=None, workers=8):
+    """
+    Verify files against a signed manifest, without the card.
+
+    The root signature is checked once with the public key embedded in the
+    manifest; each selected file is then hashed (in parallel) and checked
+    against the root with its inclusion proof. The embedded key is only
+    trusted if it is the expected signer, or, without one, a signature key
+    in the key cache (cached when the card signs).
+
+    Args:
+        manifest: Manifest dict from load_manifest()
+        base_dir: Directory the manifest paths are relative to
+        names: Manifest paths (or directory prefixes) to verify, None for all
+        signer: Expected signer (fingerprint, serial or alias in the key
+                cache, or a hex fingerprint), or None to accept any cached
+                signature key
+        workers: Number of parallel hashing threads
+
+    Returns:
+        tuple: (results: list of {'path', 'status'} or None, error_message: str or None)
+    """
+    from key_cache import load_cached_keys, find_cached_key, USAGE_SIGNATURE
+
+    hash_name = manifest['hash']
+    signing_key = SigningKey.from_dict(manifest['signer'])
+    if signing_key is None:
+        return None, "Unusable signer key in manifest"
+    fingerprint = signing_key.fingerprint.hex().upper()
+    if signer is not None:
+        entry = find_cached_key(signer, usage=USAGE_SIGNATURE)
+        expected = entry.fingerprint.hex().upper() if entry is not None else signer.replace(' ', '').upper()
+        if fingerprint != expected:
+            return None, f"Manifest signed by another key: {fingerprint}"
+    elif not any(entry.fingerprint == signing_key.fingerprint
+                 for entry in load_cached_keys(USAGE_SIGNATURE)):
+        return None, (f"Manifest signer {fingerprint} is not a cached signature key "
+                      "(use --signer to trust it explicitly)")
+
+    root = bytes.fromhex(manifest['root'])
+    if not signing_key.verify(bytes.fromhex(manifest['signature']), signed_digest(root, hash_name), hash_name):
+        return None, "Invalid manifest signature"
+
+    files = {entry['path']: entry for entry in manifest['files']}
+    if names:
+        prefixes = [n.rstrip('/') for n in names]
+        selected = [p for p in files if any(p == n or p.startswith(n + '/') for n in prefixes)]
+        unlisted = [n for n in prefixes if not any(p == n or p.startswith(n + '/') for p in files)]
+    else:
+        selected = list(files)
+        unlisted = []
+
+    items = [(os.path.join(base_dir, *name.split('/')), name) for name in selected]
+    results = []
+    for name, size, digest in hash_files(items, hash_name, workers):
+        entry = files[name]
+        if size is None:
+            status = STATUS_MISSING
+        else:
+            proof = [(side, bytes.fromhex(sibling)) for side, sibling in entry['proof']]
+            leaf = leaf_hash(name, size, digest, hash_name)
+            status = STATUS_OK if root_from_proof(leaf, proof, hash_name) == root else STATUS_MODIFIED
+        results.append({'path': name, 'status': status})
+    results += [{'path': name, 'status': STATUS_UNLISTED} for name in unlisted]
+    return results, None
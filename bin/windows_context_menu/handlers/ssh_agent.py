@@ -0,0 +1,397 @@
+"""
+AEPGP SSH Agent
+
+Serves the card's authentication key to OpenSSH over the ssh-agent
+protocol (draft-miller-ssh-agent) on a Unix socket. Sign requests are
+answered with INTERNAL AUTHENTICATE, so the private key never leaves the
+card:
+
+    RSA     rsa-sha2-256, rsa-sha2-512 (ssh-rsa/SHA-1 if the client asks
+            for it): the host sends the DigestInfo, the card pads it
+    ECDSA   ecdsa-sha2-nistp256/384/521: the card signs the digest
+
+The agent keeps one card session open and PIN-verified (PW1 mode 82)
+between requests, so each SSH connection costs a single INTERNAL
+AUTHENTICATE instead of a reader scan, applet selection and PIN
+verification. The session is closed after an idle timeout and reopened on
+the next request. The public key is read once and answered from memory
+(and cached in key_cache.py with usage "authentication").
+
+Only the card's own key is served: adding or removing identities, locking
+and extensions are answered with SSH_AGENT_FAILURE.
+"""
+
+import os
+import time
+import base64
+import socket
+import struct
+import hashlib
+import threading
+import socketserver
+
+from cryptography.hazmat.primitives import serialization
+
+from card_key_reader import ALGO_ECDH, ALGO_ECDSA, ALGO_EDDSA, ALGO_RSA
+from card_sign import ERROR_EDDSA_UNSUPPORTED, ERROR_PIN_NOT_VERIFIED, card_authenticate
+
+# Import debug logger
+try:
+    from debug_logger import get_logger
+    logger = get_logger()
+except ImportError:
+    class DummyLogger:
+        def info(self, msg): pass
+        def error(self, msg, e=None): pass
+        def debug(self, msg): pass
+    logger = DummyLogger()
+
+# Message numbers (draft-miller-ssh-agent, 6.1)
+SSH_AGENT_FAILURE = 5
+SSH_AGENTC_REQUEST_IDENTITIES = 11
+SSH_AGENT_IDENTITIES_ANSWER = 12
+SSH_AGENTC_SIGN_REQUEST = 13
+SSH_AGENT_SIGN_RESPONSE = 14
+
+# Signature flags for RSA keys
+SSH_AGENT_RSA_SHA2_256 = 0x02
+SSH_AGENT_RSA_SHA2_512 = 0x04
+
+DEFAULT_IDLE_TIMEOUT = 300
+
+_MAX_MESSAGE_SIZE = 256 * 1024
+
+# OpenSSH curve names and digests (RFC 5656, 6.2.1)
+_ECDSA_CURVES = {
+    'secp256r1': (b'nistp256', 'sha256'),
+    'secp384r1': (b'nistp384', 'sha384'),
+    'secp521r1': (b'nistp521', 'sha512'),
+}
+
+# ASN.1 DigestInfo prefixes for the RSA signature algorithms
+_RSA_ALGORITHMS = {
+    SSH_AGENT_RSA_SHA2_512: (b'rsa-sha2-512', 'sha512',
+                             bytes.fromhex("3051300d060960864801650304020305000440")),
+    SSH_AGENT_RSA_SHA2_256: (b'rsa-sha2-256', 'sha256',
+                             bytes.fromhex("3031300d060960864801650304020105000420")),
+    0: (b'ssh-rsa', 'sha1', bytes.fromhex("3021300906052b0e03021a05000414")),
+}
+
+
+class AgentError(Exception):
+    pass
+
+
+def _string(data):
+    return struct.pack('>I', len(data)) + data
+
+
+def _mpint(value):
+    """SSH mpint of a non-negative integer (RFC 4251, 5)"""
+    return _string(value.to_bytes((value.bit_length() + 8) // 8, 'big') if value else b'')
+
+
+def _read_string(data, offset):
+    if offset + 4 > len(data):
+        raise AgentError("Truncated agent message")
+    length = struct.unpack('>I', data[offset:offset + 4])[0]
+    offset += 4
+    if offset + length > len(data):
+        raise AgentError("Truncated agent message")
+    return data[offset:offset + length], offset + length
+
+
+def key_blob(auth_key):
+    """
+    SSH public key blob of a card_sign.SigningKey.
+
+    Returns:
+        bytes, or None if OpenSSH has no matching key type
+    """
+    if auth_key.algorithm == ALGO_RSA:
+        numbers = auth_key.public_key.public_numbers()
+        return _string(b'ssh-rsa') + _mpint(numbers.e) + _mpint(numbers.n)
+    if auth_key.algorithm == ALGO_ECDSA:
+        curve = _ECDSA_CURVES.get(auth_key.public_key.curve.name)
+        if curve is None:
+            return None
+        point = auth_key.public_key.public_bytes(serialization.Encoding.X962,
+                                                 serialization.PublicFormat.UncompressedPoint)
+        return _string(b'ecdsa-sha2-' + curve[0]) + _string(curve[0]) + _string(point)
+    return None
+
+
+def authorized_key_line(blob, comment):
+    """authorized_keys / .pub line for a key blob"""
+    key_type, _ = _read_string(blob, 0)
+    return f"{key_type.decode()} {base64.b64encode(blob).decode()} {comment}"
+
+
+class CardSession:
+    """
+    A connected, PIN-verified card kept warm between requests.
+
+    The session is opened on first use and closed after idle_timeout
+    seconds without requests. A rejected PIN disables the session so a
+    retry loop cannot block the card.
+    """
+
+    def __init__(self, open_card, pin, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        # Callable returning an AEPGPCard with the OpenPGP applet selected
+        self._open_card = open_card
+        self._pin = pin
+        self.idle_timeout = idle_timeout
+        self._card = None
+        self._lock = threading.Lock()
+        self._last_used = 0.0
+        self._timer = None
+        self.sessions_opened = 0
+
+    @property
+    def is_open(self):
+        return self._card is not None
+
+    def verify_pin(self, card):
+        """Verify PW1 (mode 82); also used when the card lost its security state"""
+        from card_utils import verify_user_pin
+
+        if self._pin is None:
+            raise AgentError("User PIN was rejected; restart the agent")
+        success, error_msg = verify_user_pin(card, self._pin)
+        if not success:
+            self._pin = None
+            raise AgentError(error_msg)
+
+    def _open(self):
+        card = self._open_card()
+        try:
+            self.verify_pin(card)
+        except AgentError:
+            card.disconnect()
+            raise
+        self._card = card
+        self.sessions_opened += 1
+        logger.info(f"Card session opened on {card.reader}")
+
+    def _close(self):
+        if self._card is not None:
+            self._card.disconnect()
+            self._card = None
+            logger.info("Card session closed")
+
+    def run(self, operation):
+        """
+        Run operation(card) in the session, opening it if needed.
+
+        Returns:
+            tuple: (result of operation, session_reused: bool)
+        """
+        with self._lock:
+            reused = self._card is not None
+            try:
+                if not reused:
+                    self._open()
+                result = operation(self._card)
+            except AgentError:
+                raise
+            except Exception as e:
+                # Card removed or reader gone: reconnect on the next request
+                self._close()
+                raise AgentError(f"Card error: {e}")
+            self._last_used = time.monotonic()
+            self._schedule_expiry()
+            return result, reused
+
+    def _schedule_expiry(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.idle_timeout:
+            self._timer = threading.Timer(self.idle_timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self):
+        with self._lock:
+            if time.monotonic() - self._last_used >= self.idle_timeout * 0.99:
+                logger.info(f"Card session idle for {self.idle_timeout}s")
+                self._close()
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._close()
+
+
+def read_auth_key(card):
+    """
+    Read the authentication public key and remember it in the key cache.
+
+    Returns:
+        tuple: (SigningKey or None, error_message: str or None)
+    """
+    from card_key_reader import read_public_key_from_card, read_algorithm_attributes
+    from card_sign import load_signing_key
+    from card_utils import get_card_serial
+    from key_cache import CachedKey, cache_key, USAGE_AUTHENTICATION
+
+    key_data = read_public_key_from_card(card, 'authentication')
+    if not key_data:
+        return None, "Failed to read authentication public key from card"
+    attributes = read_algorithm_attributes(card, 'authentication')
+    if attributes and attributes[0] == ALGO_EDDSA:
+        return None, ERROR_EDDSA_UNSUPPORTED
+    if attributes and attributes[0] == ALGO_ECDH:
+        # smartpgp-cli switch-* gives the authentication slot the ECDH
+        # algorithm ID; the applet signs with any EC key
+        attributes = bytes([ALGO_ECDSA]) + bytes(attributes[1:])
+    auth_key = load_signing_key(key_data, attributes)
+    if auth_key is None:
+        return None, "Failed to parse authentication public key from card"
+    cache_key(CachedKey(auth_key.fingerprint, bytes(key_data), attributes,
+                        serial=get_card_serial(card), usage=USAGE_AUTHENTICATION))
+    return auth_key, None
+
+
+class SSHAgent:
+    """ssh-agent protocol handler for one card authentication key"""
+
+    def __init__(self, session, auth_key, comment):
+        self.session = session
+        self.auth_key = auth_key
+        self.blob = key_blob(auth_key)
+        if self.blob is None:
+            raise AgentError(f"{auth_key.describe()} keys are not supported by OpenSSH")
+        self.comment = comment
+        self.signatures = 0
+        self.total_latency = 0.0
+        # Optional callback(algorithm: str, latency: float, reused: bool)
+        self.on_sign = None
+
+    def handle(self, message):
+        """Return the response to one agent message (without length prefix)"""
+        try:
+            if message[0] == SSH_AGENTC_REQUEST_IDENTITIES:
+                return (bytes([SSH_AGENT_IDENTITIES_ANSWER]) + struct.pack('>I', 1)
+                        + _string(self.blob) + _string(self.comment.encode('utf-8')))
+            if message[0] == SSH_AGENTC_SIGN_REQUEST:
+                blob, offset = _read_string(message, 1)
+                data, offset = _read_string(message, offset)
+                flags = struct.unpack('>I', message[offset:offset + 4])[0] if offset + 4 <= len(message) else 0
+                if blob != self.blob:
+                    return bytes([SSH_AGENT_FAILURE])
+                return bytes([SSH_AGENT_SIGN_RESPONSE]) + _string(self.sign(data, flags))
+        except AgentError as e:
+            logger.error(f"Agent request failed: {e}")
+        return bytes([SSH_AGENT_FAILURE])
+
+    def sign(self, data, flags=0):
+        """
+        Sign data for SSH with INTERNAL AUTHENTICATE.
+
+        Returns:
+            bytes: SSH signature blob
+        """
+        if self.auth_key.algorithm == ALGO_RSA:
+            flag = next((f for f in (SSH_AGENT_RSA_SHA2_512, SSH_AGENT_RSA_SHA2_256) if flags & f), 0)
+            name, hash_name, prefix = _RSA_ALGORITHMS[flag]
+            card_input = prefix + hashlib.new(hash_name, data).digest()
+        else:
+            curve, hash_name = _ECDSA_CURVES[self.auth_key.public_key.curve.name]
+            name = b'ecdsa-sha2-' + curve
+            card_input = hashlib.new(hash_name, data).digest()
+
+        def authenticate(card):
+            signature, error_msg = card_authenticate(card, card_input)
+            if error_msg == ERROR_PIN_NOT_VERIFIED:
+                # The card was reset behind our back: verify PW1 again once
+                self.session.verify_pin(card)
+                signature, error_msg = card_authenticate(card, card_input)
+            if error_msg:
+                raise AgentError(error_msg)
+            return signature
+
+        start = time.perf_counter()
+        signature, reused = self.session.run(authenticate)
+        latency = time.perf_counter() - start
+        self.signatures += 1
+        self.total_latency += latency
+        logger.info(f"{name.decode()} signature in {latency * 1000:.1f} ms"
+                    f" ({'warm' if reused else 'new'} session)")
+        if self.on_sign is not None:
+            self.on_sign(name.decode(), latency, reused)
+
+        if self.auth_key.algorithm == ALGO_ECDSA:
+            half = len(signature) // 2
+            signature = (_mpint(int.from_bytes(signature[:half], 'big'))
+                         + _mpint(int.from_bytes(signature[half:], 'big')))
+        return _string(name) + _string(signature)
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class _AgentRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        agent = self.server.agent
+        while True:
+            header = _recv_exact(self.request, 4)
+            if header is None:
+                return
+            length = struct.unpack('>I', header)[0]
+            if length == 0 or length > _MAX_MESSAGE_SIZE:
+                return
+            message = _recv_exact(self.request, length)
+            if message is None:
+                return
+            response = agent.handle(message)
+            self.request.sendall(struct.pack('>I', len(response)) + response)
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise AgentError(f"An agent is already listening on {path}")
+
+
+def serve(agent, socket_path):
+    """
+    Serve agent on a Unix socket (readable by the current user only)
+    until interrupted; the card session is closed on exit.
+    """
+    _remove_stale_socket(socket_path)
+    old_umask = os.umask(0o177)
+    try:
+        server = _AgentServer(socket_path, _AgentRequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.agent = agent
+    logger.info(f"SSH agent listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        agent.session.close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
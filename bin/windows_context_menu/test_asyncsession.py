@@ -0,0 +1,229 @@
+"""
+AEPGP Async Card Session Test Script
+
+Card-free checks of smartpgp/asyncsession.py, with a connection whose
+APDUs take a set time:
+1. A timeout while an APDU is in flight stops the operation at its next APDU
+2. Cancelling a running or a queued operation, the session staying usable
+3. Two readers driven concurrently from one event loop
+4. close() disconnecting the card and stopping the worker thread
+
+Run this script with: python test_asyncsession.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+
+# Add smartpgp to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+APDU = [0x00, 0xCA, 0x00, 0x6E, 0x00]
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+class _SlowConnection:
+    """Card connection answering 90 00 after a delay, recording the APDUs
+    and the threads sending them"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.apdus = []
+        self.threads = set()
+        self.started = threading.Event()
+        # APDU counts of the operations stopped by OperationCancelled
+        self.stopped = []
+        self.disconnected = False
+
+    def transmit(self, apdu):
+        self.started.set()
+        self.threads.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        self.apdus.append(list(apdu))
+        return [], 0x90, 0x00
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def _session(reader_index=0, delay=0.2, timeout=None):
+    """AsyncCardSession on a connected _SlowConnection"""
+    from smartpgp.asyncsession import AsyncCardSession
+    from smartpgp.highlevel import CardConnectionContext
+
+    connection = _SlowConnection(delay)
+    ctx = CardConnectionContext()
+    ctx.connection = connection
+    ctx.connected = True
+    ctx.serial = bytes([0x12, 0x34, 0x56, reader_index])
+    return AsyncCardSession(reader_index, ctx=ctx, timeout=timeout), connection
+
+
+def _send(session, count):
+    """Blocking operation sending count APDUs through the session's connection"""
+    from smartpgp.asyncsession import OperationCancelled
+
+    for sent in range(count):
+        try:
+            session.ctx.connection.transmit(APDU)
+        except OperationCancelled:
+            session.ctx.connection.stopped.append(sent)
+            raise
+    return count
+
+
+async def _cancelled(awaitable, *exceptions):
+    try:
+        await awaitable
+    except exceptions:
+        return True
+    return False
+
+
+def test_timeout():
+    """Test 1: A timeout lets the APDU in flight finish and sends no other"""
+
+    async def scenario():
+        session, connection = _session(timeout=0.1)
+        start = time.perf_counter()
+        assert await _cancelled(session.run(_send, session, 5), asyncio.TimeoutError)
+        # The loop gets control back at the timeout, not when the APDU completes
+        assert time.perf_counter() - start < 0.2 and connection.started.is_set()
+        # Operations run in order: this one waits for the timed out one to stop
+        assert await session.run(len, connection.apdus, timeout=5) == 1, connection.apdus
+        assert connection.stopped == [1], connection.stopped
+
+        # The session is still usable, with a timeout per call
+        assert await session.run(_send, session, 2, timeout=5) == 2
+        data, sw1, sw2 = await session.transmit(APDU, timeout=5)
+        assert (sw1, sw2) == (0x90, 0x00) and len(connection.apdus) == 4
+        await session.close()
+
+    asyncio.run(scenario())
+    print("✓ Timed out operation stopped after its APDU in flight, session reusable")
+    return True
+
+
+def test_cancellation():
+    """Test 2: Cancelled operations stop before their next APDU"""
+
+    async def scenario():
+        session, connection = _session()
+        running = asyncio.ensure_future(session.run(_send, session, 5))
+        queued = asyncio.ensure_future(session.run(_send, session, 5))
+        while not connection.started.is_set():
+            await asyncio.sleep(0.01)
+        running.cancel()
+        queued.cancel()
+        assert await _cancelled(running, asyncio.CancelledError)
+        assert await _cancelled(queued, asyncio.CancelledError)
+        assert await session.run(len, connection.apdus) == 1, connection.apdus
+        # The queued operation never started
+        assert connection.stopped == [1], connection.stopped
+        assert await session.run(_send, session, 1) == 1
+        await session.close()
+        return len(connection.apdus)
+
+    assert asyncio.run(scenario()) == 2
+    print("✓ Running and queued operations cancelled, session reusable")
+    return True
+
+
+def test_concurrent_readers():
+    """Test 3: One loop drives two readers at once, each on its own thread"""
+
+    async def scenario():
+        sessions = [_session(i) for i in range(2)]
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.02)
+                ticks += 1
+
+        ticking = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        counts = await asyncio.gather(*(session.run(_send, session, 2)
+                                        for session, _ in sessions))
+        elapsed = time.perf_counter() - start
+        ticking.cancel()
+        for session, _ in sessions:
+            await session.close()
+        return counts, elapsed, ticks, [connection for _, connection in sessions]
+
+    counts, elapsed, ticks, connections = asyncio.run(scenario())
+    assert counts == [2, 2]
+    # One after the other, the four APDUs would take 0.8 s
+    assert elapsed < 0.7, f"readers not driven concurrently ({elapsed:.2f} s)"
+    assert ticks >= 5, f"event loop blocked ({ticks} ticks)"
+    assert [c.threads for c in connections] == [{"smartpgp-reader-0_0"}, {"smartpgp-reader-1_0"}], \
+        [c.threads for c in connections]
+    print(f"✓ Two readers in {elapsed:.2f} s, event loop responsive")
+    return True
+
+
+def test_close():
+    """Test 4: close() disconnects and stops the worker thread"""
+
+    async def scenario():
+        async with _session(delay=0)[0] as session:
+            connection = session.ctx.connection
+            await session.transmit(APDU)
+        assert connection.disconnected
+        assert session.ctx.connection is None and not session.ctx.connected
+        try:
+            await session.run(_send, session, 1)
+            raise AssertionError("operation accepted after close()")
+        except RuntimeError:
+            pass
+
+    asyncio.run(scenario())
+    print("✓ Card disconnected, no operation accepted after close()")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP ASYNC CARD SESSION TEST")
+
+    tests = {
+        "Timeout": test_timeout,
+        "Cancellation": test_cancellation,
+        "Concurrent Readers": test_concurrent_readers,
+        "Close": test_close,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
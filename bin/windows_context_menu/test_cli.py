@@ -0,0 +1,249 @@
+"""
+AEPGP Command Line Test Script
+
+Card-free checks of smartpgp-cli:
+1. --json results of commands reading files (inspect) and of host-only
+   commands (kdf-benchmark), and of a failing command
+2. 'run' scripts: parsing, stopping at the first failure or going on with
+   -k, one connection and PIN verification for all steps, the timing table
+3. The interactive shell: completion, raw APDUs and per-command timing
+
+Run this script with: python test_cli.py
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+import contextlib
+import subprocess
+import importlib.util
+import importlib.machinery
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CLI = os.path.join(BIN_DIR, "smartpgp-cli")
+
+# Add smartpgp and the handlers to path
+sys.path.insert(0, BIN_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "handlers"))
+
+TEST_DIR = tempfile.mkdtemp(prefix="aepgp-test-")
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _cli_json(*args):
+    """Run smartpgp-cli --json, returns its exit code and JSON result"""
+    result = subprocess.run([sys.executable, CLI, "--json"] + list(args), cwd=BIN_DIR,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+    return result.returncode, json.loads(result.stdout)
+
+
+def _load_cli():
+    """smartpgp-cli as a module (it has no .py extension)"""
+    loader = importlib.machinery.SourceFileLoader("smartpgp_cli", CLI)
+    spec = importlib.util.spec_from_loader("smartpgp_cli", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+class _RecordingConnection:
+    """Card connection answering 90 00 (6A 88 to GET DATA), or the response
+    set for an APDU header, recording the APDUs"""
+
+    def __init__(self):
+        self.apdus = []
+        self.responses = {}
+
+    def transmit(self, apdu):
+        self.apdus.append(list(apdu))
+        if tuple(apdu[:4]) in self.responses:
+            return self.responses[tuple(apdu[:4])]
+        if apdu[1] == 0xCA:
+            return [], 0x6A, 0x88
+        return [], 0x90, 0x00
+
+
+def _stub_context(cli, argv):
+    """CardConnectionContext with the options of argv, connecting to a
+    _RecordingConnection instead of a reader"""
+    from smartpgp.highlevel import CardConnectionContext
+
+    class StubContext(CardConnectionContext):
+        connects = 0
+
+        def connect(self):
+            if not self.connected:
+                StubContext.connects += 1
+                self.connection = _RecordingConnection()
+                self.connected = True
+
+    ctx = StubContext()
+    ctx.args = cli._build_parser().parse_args(argv)
+    cli._apply_args(ctx, ctx.args)
+    return ctx
+
+
+def _ins(ctx, ins):
+    """APDUs of an instruction sent in a stubbed session"""
+    return [apdu for apdu in ctx.connection.apdus if apdu[1] == ins]
+
+
+def test_json_results():
+    """Test 1: --json carries each command's decoded result"""
+    from enc_format import EncHeader, Recipient, encode_header, IV_SIZE, TAG_SIZE
+
+    enc = os.path.join(TEST_DIR, "file.enc")
+    with open(enc, "wb") as f:
+        f.write(encode_header(EncHeader(recipients=[Recipient(2, os.urandom(40),
+                                                               fingerprint=bytes(20))],
+                                        original_size=100)))
+        f.write(os.urandom(IV_SIZE + 100 + TAG_SIZE))
+    code, result = _cli_json("inspect", "-i", enc)
+    assert code == 0 and result["status"] == "ok", result
+    assert result["command"] == "inspect" and result["apdu_count"] == 0
+    info, = result["result"]
+    assert info["format"] == "v2" and info["original_size"] == 100, info
+    assert info["recipients"][0]["fingerprint"] == "00" * 20
+
+    code, result = _cli_json("kdf-benchmark", "--kdf-time", "0.01")
+    assert code == 0, result
+    hashes = result["result"]["hashes"]
+    assert sorted(hashes) == ["sha256", "sha512"] and hashes["sha256"]["iterations"] > 0, hashes
+
+    code, result = _cli_json("inspect")
+    assert code == 1 and result["status"] == "failed" and result["result"] is None, result
+    print("✓ inspect and kdf-benchmark results, failure reported")
+    return True
+
+
+def test_run_script():
+    """Test 2: 'run' stops at a failing step unless -k, one card session"""
+    cli = _load_cli()
+    script = os.path.join(TEST_DIR, "script.txt")
+    with open(script, "w") as f:
+        f.write("# provisioning\n"
+                "switch-p256  # all three keys\n"
+                "\n"
+                "put-sign-certificate -i '%s'\n"
+                "switch-rsa2048\n" % os.path.join(TEST_DIR, "no such file.der"))
+    assert [(n, argv[0]) for n, argv in cli._read_script(_stub_context(cli, ["run", "-i", script]))] \
+        == [(2, "switch-p256"), (4, "put-sign-certificate"), (5, "switch-rsa2048")]
+
+    for keep_going in (False, True):
+        ctx = _stub_context(cli, ["run", "-i", script] + (["-k"] if keep_going else []))
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr):
+            try:
+                cli.cmd_run(ctx)
+                raise AssertionError("failing script exited with status 0")
+            except SystemExit as e:
+                assert e.code == 1, e.code
+        steps = ctx.result["steps"]
+        expected = ["ok", "failed", "ok" if keep_going else "skipped"]
+        assert [step["status"] for step in steps] == expected, steps
+        assert [step["line"] for step in steps] == [2, 4, 5]
+        assert all(step["time"] >= 0 for step in steps if step["status"] != "skipped")
+        # One connection, the Admin PIN verified once, PUT DATA C1-C3 per switch
+        assert ctx.connects == 1 and len(_ins(ctx, 0x20)) == 1, ctx.connection.apdus
+        assert len(_ins(ctx, 0xDA)) == (6 if keep_going else 3), ctx.connection.apdus
+
+        table = stderr.getvalue().splitlines()[-5:]
+        assert table[0].split() == ["Line", "Command", "Status", "Time", "(s)"], table
+        assert table[2].split()[:3] == ["4", "put-sign-certificate", "-i"] and "FAILED" in table[2]
+        assert table[3].split()[-1] == ("%.3f" % steps[2]["time"] if keep_going else "skipped"), table
+        assert table[4].split()[0] == "total"
+        print(f"✓ {'-k: all steps run' if keep_going else 'Stopped at the failing step'}, "
+              "one connection, timing table")
+    return True
+
+
+def test_shell():
+    """Test 3: Shell completion, apdu parsing and command timing"""
+    cli = _load_cli()
+    ctx = _stub_context(cli, ["shell"])
+    shell = cli._Shell(ctx)
+
+    assert shell.completenames("switch-p") == ["switch-p256", "switch-p384", "switch-p521"]
+    names = shell.completenames("")
+    assert set(cli.VALID_COMMANDS) <= set(names) and "EOF" not in names
+    assert names[:len(shell.builtins)] == shell.builtins and "apdu" in shell.builtins
+    assert shell.complete_verify("a") == ["admin"]
+    assert shell.completedefault("--ke", "sign --ke", 5, 9) == ["--keep-going"]
+    assert shell.completedefault("f", "sign f", 5, 6) == []
+
+    ctx.connect()
+    # 61 02: two more bytes to collect with GET RESPONSE
+    ctx.connection.responses = {(0x00, 0xCA, 0x01, 0x01): ([0xCA], 0x61, 0x02),
+                                (0x00, 0xC0, 0x00, 0x00): ([0xFE, 0x01], 0x90, 0x00)}
+    stdout, stderr = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        assert not shell.onecmd("apdu 00 CA 01 01 00")
+        assert ctx.connection.apdus == [[0x00, 0xCA, 0x01, 0x01, 0x00], [0x00, 0xC0, 0x00, 0x00, 0x02]]
+        # Malformed APDUs are not sent
+        for line in ("apdu 00ca", "apdu zz"):
+            assert not shell.onecmd(line)
+        assert len(ctx.connection.apdus) == 2, ctx.connection.apdus
+        # The Admin PIN verified by switch-p256 is not verified again
+        for line in ("switch-p256", "verify admin", "frobnicate", ""):
+            assert not shell.onecmd(line), line
+        assert shell.onecmd("quit")
+    assert "CA FE 01" in stdout.getvalue().splitlines()
+    assert len(_ins(ctx, 0x20)) == 1 and len(_ins(ctx, 0xDA)) == 3, ctx.connection.apdus
+
+    history = shell.history
+    assert [(h["command"], h["status"]) for h in history] == [
+        ("apdu 00 CA 01 01 00", "ok"), ("apdu 00ca", "failed"), ("apdu zz", "failed"),
+        ("switch-p256", "ok"), ("verify admin", "ok"), ("frobnicate", "failed")], history
+    assert all(h["time"] >= 0 for h in history)
+    timings = [line for line in stderr.getvalue().splitlines() if line.startswith("[")]
+    assert len(timings) == len(history) and timings[0].startswith("[ok, ") and timings[0].endswith(" s]")
+    print("✓ Completion, apdu parsing with GET RESPONSE, status and time of each command")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP COMMAND LINE TEST")
+
+    tests = {
+        "JSON Results": test_json_results,
+        "Run Scripts": test_run_script,
+        "Shell": test_shell,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
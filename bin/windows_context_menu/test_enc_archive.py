@@ -0,0 +1,226 @@
+"""
+AEPGP Encrypted Archive Test Script
+
+Card-free checks of the archive layer (the data key is generated locally
+instead of being unwrapped by the card):
+1. Member walk order, archive paths and excluded output files
+2. Unsafe member paths rejected on extraction
+3. Encrypted index segment bound to its position and final flag
+4. Member extraction, partial extraction and tampered segments
+
+Run this script with: python test_enc_archive.py
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+
+# Add handlers to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "handlers"))
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+TEST_DIR = tempfile.mkdtemp(prefix="aepgp-test-")
+SEGMENT_SIZE = 4096
+
+FILES = {
+    "docs/a.txt": b"hello archive\n" * 1000,
+    "docs/empty": b"",
+    "docs/sub/b.bin": os.urandom(3 * SEGMENT_SIZE + 5),
+    "docs/sub/deep/c.txt": b"c" * 10,
+}
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _make_tree():
+    for name, content in FILES.items():
+        path = os.path.join(TEST_DIR, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        os.utime(path, ns=(1600000000123456789, 1600000000123456789))
+    return os.path.join(TEST_DIR, "docs")
+
+
+def _pack(source_dir, compression=None):
+    """Member segments laid out as create_archive writes them, returns (Archive, bytes)"""
+    from compression import choose_compression
+    from enc_archive import Archive, ArchiveMember, _walk_members
+    from enc_format import EncHeader, IV_SIZE
+    from rsa_crypto import seal_segment
+
+    aes_key = os.urandom(32)
+    iv = os.urandom(IV_SIZE)
+    aesgcm = AESGCM(aes_key)
+    out = io.BytesIO()
+    out.write(iv)
+    members = []
+    index = 0
+    for source, name in _walk_members([source_dir]):
+        with open(source, "rb") as f:
+            segment = f.read(SEGMENT_SIZE)
+            member = ArchiveMember(name, 0, os.stat(source).st_mtime_ns,
+                                   choose_compression(compression, segment), out.tell(), index)
+            while segment:
+                record = seal_segment(aesgcm, iv, index, False, segment, member.compression)
+                out.write(record)
+                member.size += len(segment)
+                member.segment_count += 1
+                member.stored_size += len(record)
+                index += 1
+                segment = f.read(SEGMENT_SIZE)
+        members.append(member)
+    header = EncHeader(segment_size=SEGMENT_SIZE, segment_count=None, archive=True)
+    return Archive(header, aes_key, iv, members), out.getvalue()
+
+
+def test_walk_members():
+    """Test 1: Directory trees are walked in order, excluding the output"""
+    from enc_archive import _walk_members
+
+    source_dir = _make_tree()
+    names = [name for _, name in _walk_members([source_dir])]
+    assert names == sorted(FILES), f"unexpected order: {names}"
+
+    output = os.path.join(source_dir, "docs.enc")
+    for path in (output, output + ".tmp"):
+        with open(path, "wb") as f:
+            f.write(b"partial archive")
+    exclude = {os.path.abspath(output), os.path.abspath(output) + ".tmp"}
+    names = [name for _, name in _walk_members([source_dir], exclude)]
+    assert names == sorted(FILES), f"output archived: {names}"
+    os.remove(output)
+    os.remove(output + ".tmp")
+
+    single = os.path.join(source_dir, "a.txt")
+    assert list(_walk_members([single])) == [(single, "a.txt")]
+    print(f"✓ {len(names)} members walked, output and .tmp excluded")
+    return True
+
+
+def test_unsafe_paths():
+    """Test 2: Member paths cannot escape the output directory"""
+    from enc_archive import _member_output_path
+    from enc_format import InvalidFormat
+
+    out = os.path.join(TEST_DIR, "out")
+    assert _member_output_path(out, "docs/sub/b.bin") == os.path.join(out, "docs", "sub", "b.bin")
+    unsafe = ["../x", "/etc/passwd", "a/../../b", "C:/x", "a\\b", "a//b", "./a", ""]
+    for name in unsafe:
+        try:
+            _member_output_path(out, name)
+        except InvalidFormat:
+            continue
+        raise AssertionError(f"unsafe path accepted: {name!r}")
+    print(f"✓ {len(unsafe)} unsafe paths rejected")
+    return True
+
+
+def test_index_segment():
+    """Test 3: The index only opens at its own position as the final segment"""
+    from enc_archive import _open_segment, _read_segment
+    from enc_format import COMPRESS_ZLIB, InvalidFormat
+    from rsa_crypto import seal_segment
+
+    aes_key, iv = os.urandom(32), os.urandom(12)
+    aesgcm = AESGCM(aes_key)
+    index = b'{"version": 1, "members": []}' * 50
+    record = seal_segment(aesgcm, iv, 7, True, index, COMPRESS_ZLIB)
+
+    sealed = _read_segment(io.BytesIO(record), 7, 1 << 20)
+    assert _open_segment(aesgcm, iv, 7, True, sealed, COMPRESS_ZLIB) == index
+
+    for position, final in ((6, True), (7, False)):
+        try:
+            _open_segment(aesgcm, iv, position, final, sealed, COMPRESS_ZLIB)
+        except InvalidFormat:
+            continue
+        raise AssertionError(f"index opened as segment {position} (final={final})")
+    for data, max_length in ((record[:-1], 1 << 20), (record, 16)):
+        try:
+            _read_segment(io.BytesIO(data), 7, max_length)
+        except InvalidFormat:
+            continue
+        raise AssertionError("truncated or oversized segment read")
+    print("✓ Index segment bound to position and final flag")
+    return True
+
+
+def test_extract():
+    """Test 4: Members extract with their contents and modification times"""
+    from enc_archive import extract_members
+
+    archive, data = _pack(os.path.join(TEST_DIR, "docs"), compression='zlib')
+    out = os.path.join(TEST_DIR, "out")
+    extracted, error = extract_members(archive, io.BytesIO(data), out)
+    assert error is None, error
+    assert extracted == sorted(FILES)
+    for name, content in FILES.items():
+        path = os.path.join(out, *name.split('/'))
+        with open(path, "rb") as f:
+            assert f.read() == content, f"content of {name}"
+        assert os.stat(path).st_mtime_ns == 1600000000123456789, f"mtime of {name}"
+
+    extracted, error = extract_members(archive, io.BytesIO(data), os.path.join(TEST_DIR, "one"),
+                                       ["docs/sub/"])
+    assert extracted == ["docs/sub/b.bin", "docs/sub/deep/c.txt"], extracted
+    extracted, error = extract_members(archive, io.BytesIO(data), out, ["nope"])
+    assert extracted is None and "nope" in error
+
+    member = next(m for m in archive.members if m.path == "docs/sub/b.bin")
+    tampered = bytearray(data)
+    tampered[member.offset + 100] ^= 1
+    bad_dir = os.path.join(TEST_DIR, "bad")
+    extracted, error = extract_members(archive, io.BytesIO(bytes(tampered)), bad_dir,
+                                       ["docs/sub/b.bin"])
+    assert extracted is None and "authentication" in error, error
+    assert not os.listdir(os.path.join(bad_dir, "docs", "sub")), "partial member left behind"
+    print("✓ Full, partial and tampered extraction")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP ENCRYPTED ARCHIVE TEST")
+
+    tests = {
+        "Walk Members": test_walk_members,
+        "Unsafe Paths": test_unsafe_paths,
+        "Index Segment": test_index_segment,
+        "Extract": test_extract,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
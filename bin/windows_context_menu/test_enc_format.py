@@ -0,0 +1,344 @@
+"""
+AEPGP Encrypted File Format Test Script
+
+Card-free checks of the .enc file layer:
+1. Header encode/read round trip (several recipients, all optional fields)
+2. Segment nonces and segmented bodies (truncation and reordering detected)
+3. Data key wrapping, unwrapped with software keys as the card would
+4. Header-only inspection, including non-.enc files
+5. Compression selection and streaming round trip
+6. Public key cache lookups
+7. Resumable encryption checkpoints
+
+Run this script with: python test_enc_format.py
+"""
+
+import io
+import os
+import sys
+import shutil
+import struct
+import tempfile
+
+# Add handlers to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "handlers"))
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.keywrap import aes_key_unwrap
+
+TEST_DIR = tempfile.mkdtemp(prefix="aepgp-test-")
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _seal_body(aes_key, iv, segments, compression_alg=0):
+    """Segmented body (without IV) as written by rsa_crypto"""
+    from rsa_crypto import seal_segment
+
+    aesgcm = AESGCM(aes_key)
+    return b"".join(seal_segment(aesgcm, iv, i, i == len(segments) - 1, s, compression_alg)
+                    for i, s in enumerate(segments))
+
+
+def _split_records(body):
+    """Split a segmented body into its length-prefixed records"""
+    from enc_format import SEGMENT_LENGTH_SIZE, TAG_SIZE
+
+    records = []
+    offset = 0
+    while offset < len(body):
+        length = struct.unpack('>I', body[offset:offset + SEGMENT_LENGTH_SIZE])[0]
+        end = offset + SEGMENT_LENGTH_SIZE + length + TAG_SIZE
+        records.append(body[offset:end])
+        offset = end
+    return records
+
+
+def test_header_round_trip():
+    """Test 1: Headers survive encode_header/read_header"""
+    from enc_format import (EncHeader, Recipient, encode_header, read_header, select_recipient,
+                            COMPRESS_ZLIB, WRAP_ECDH, WRAP_CARD_AES, WRAP_RSA_PKCS1)
+
+    recipients = [
+        Recipient(WRAP_ECDH, os.urandom(40), ephemeral_point=b"\x04" + os.urandom(64),
+                  curve_oid=bytes.fromhex("2A8648CE3D030107"), fingerprint=os.urandom(20)),
+        Recipient(WRAP_CARD_AES, os.urandom(48), serial=bytes.fromhex("0005000012345678")),
+        Recipient(WRAP_RSA_PKCS1, os.urandom(256), fingerprint=os.urandom(20)),
+    ]
+    header = EncHeader(recipients=recipients, compression=COMPRESS_ZLIB,
+                       original_size=5 * 2**30, segment_size=1 << 20, segment_count=5121,
+                       archive=True)
+    encoded = encode_header(header)
+    f = io.BytesIO(encoded + b"IV-follows")
+    parsed = read_header(f)
+
+    assert parsed.body_offset == len(encoded) == f.tell(), "body offset"
+    assert (parsed.compression, parsed.original_size, parsed.segment_size,
+            parsed.segment_count, parsed.archive) == (COMPRESS_ZLIB, 5 * 2**30, 1 << 20, 5121, True)
+    assert len(parsed.recipients) == 3, "recipient count"
+    for a, b in zip(recipients, parsed.recipients):
+        assert vars(a) == vars(b), f"recipient mismatch: {vars(b)}"
+
+    assert select_recipient(parsed, fingerprint=recipients[2].fingerprint) is parsed.recipients[2]
+    assert select_recipient(parsed, serial=recipients[1].serial) is parsed.recipients[1]
+    assert select_recipient(parsed, fingerprint=os.urandom(20)) is None
+    print("✓ Header round trip with ECDH, card AES and RSA recipients")
+    return True
+
+
+def test_malformed_headers():
+    """Test 2: Truncated or unknown headers are rejected with InvalidFormat"""
+    from enc_format import EncHeader, Recipient, InvalidFormat, encode_header, read_header
+
+    encoded = encode_header(EncHeader(recipients=[Recipient(1, os.urandom(256))]))
+    cases = {
+        "truncated header": encoded[:-10],
+        "unknown version": encoded[:8] + b"\x09" + encoded[9:],
+        "no recipient": encode_header(EncHeader(recipients=[])),
+        "too short": b"\x00\x01",
+        "legacy truncated key": struct.pack('>I', 256) + os.urandom(100),
+    }
+    for name, data in cases.items():
+        try:
+            read_header(io.BytesIO(data))
+        except InvalidFormat:
+            continue
+        raise AssertionError(f"{name} accepted")
+    print(f"✓ {len(cases)} malformed headers rejected")
+    return True
+
+
+def test_segments():
+    """Test 3: Segment nonces bind index and final flag"""
+    from enc_format import EncHeader, InvalidFormat, segment_nonce
+    from rsa_decrypt import _decrypt_segments
+
+    iv = bytes(range(12))
+    assert segment_nonce(iv, 1, False) == iv[:7] + b"\x00\x00\x00\x01\x00"
+    assert segment_nonce(iv, 0x01020304, True) == iv[:7] + b"\x01\x02\x03\x04\x01"
+
+    aes_key = os.urandom(32)
+    segments = [os.urandom(1000), os.urandom(1000), os.urandom(10)]
+    body = _seal_body(aes_key, iv, segments)
+    header = EncHeader(segment_size=1000, segment_count=3)
+    out = io.BytesIO()
+    assert _decrypt_segments(io.BytesIO(body), out, aes_key, iv, header) == 2010
+    assert out.getvalue() == b"".join(segments), "plaintext mismatch"
+
+    records = _split_records(body)
+    tampered = {
+        "dropped last segment": b"".join(records[:2]),
+        "swapped segments": records[1] + records[0] + records[2],
+        "flipped bit": body[:20] + bytes([body[20] ^ 1]) + body[21:],
+    }
+    for name, data in tampered.items():
+        try:
+            _decrypt_segments(io.BytesIO(data), io.BytesIO(), aes_key, iv, header)
+        except InvalidFormat:
+            continue
+        raise AssertionError(f"{name} not detected")
+    print("✓ Segmented body round trip; truncation, reordering and tampering detected")
+    return True
+
+
+def test_key_wrapping():
+    """Test 4: Wrapped data keys open with the matching private key"""
+    from key_wrap import CardPublicKey, wrap_data_key, _ecdh_kek
+    from enc_format import WRAP_ECDH, WRAP_RSA_PKCS1
+
+    data_key = os.urandom(32)
+
+    rsa_key = rsa.generate_private_key(65537, 2048, default_backend())
+    recipient = wrap_data_key(data_key, CardPublicKey(WRAP_RSA_PKCS1, rsa_key.public_key()))
+    assert recipient.wrap_alg == WRAP_RSA_PKCS1
+    # PSO:DECIPHER expects PKCS#1 v1.5
+    assert rsa_key.decrypt(recipient.wrapped_key, padding.PKCS1v15()) == data_key
+
+    ec_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    oid = bytes.fromhex("2A8648CE3D030107")
+    recipient = wrap_data_key(data_key, CardPublicKey(WRAP_ECDH, ec_key.public_key(), oid))
+    assert recipient.curve_oid == oid
+    # The card computes the same shared X coordinate from the ephemeral point
+    ephemeral = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(),
+                                                             recipient.ephemeral_point)
+    shared = ec_key.exchange(ec.ECDH(), ephemeral)
+    kek = _ecdh_kek(shared, recipient.ephemeral_point)
+    assert aes_key_unwrap(kek, recipient.wrapped_key, default_backend()) == data_key
+    print("✓ RSA PKCS#1 v1.5 and ECDH P-256 data key wrapping")
+    return True
+
+
+def test_inspect_file():
+    """Test 5: inspect_file reads headers only and rejects other files"""
+    from enc_format import EncHeader, Recipient, encode_header, inspect_file, IV_SIZE, TAG_SIZE
+
+    plain = os.path.join(TEST_DIR, "plain.txt")
+    with open(plain, "wb") as f:
+        f.write(b"just some text, not encrypted\n" * 100)
+    info = inspect_file(plain)
+    assert info['format'] is None and info.get('error'), info
+
+    header = encode_header(EncHeader(recipients=[Recipient(2, os.urandom(40),
+                                                           fingerprint=bytes(20))],
+                                     original_size=1234))
+    enc = os.path.join(TEST_DIR, "file.enc")
+    with open(enc, "wb") as f:
+        f.write(header + os.urandom(IV_SIZE + 1234 + TAG_SIZE))
+    info = inspect_file(enc)
+    assert info['format'] == "v2", info
+    assert info['original_size'] == 1234 and info['header_size'] == len(header)
+    assert info['recipients'][0]['fingerprint'] == "00" * 20
+
+    legacy = os.path.join(TEST_DIR, "legacy.enc")
+    with open(legacy, "wb") as f:
+        f.write(struct.pack('>I', 256) + os.urandom(256 + IV_SIZE + 77 + TAG_SIZE))
+    info = inspect_file(legacy)
+    assert info['format'] == "legacy" and info['original_size'] == 77, info
+    print("✓ v2, legacy and non-encrypted files inspected")
+    return True
+
+
+def test_compression():
+    """Test 6: Compression choice and streaming round trip"""
+    from compression import (choose_compression, new_compressor, new_decompressor,
+                             zstd_available, CompressionUnavailable)
+    from enc_format import COMPRESS_NONE, COMPRESS_ZLIB, COMPRESS_ZSTD
+
+    text = b"The quick brown fox jumps over the lazy dog. " * 2000
+    assert choose_compression(None, text) == COMPRESS_NONE
+    assert choose_compression('zlib', text) == COMPRESS_ZLIB
+    assert choose_compression('zlib', os.urandom(65536)) == COMPRESS_NONE, "random data compressed"
+    assert choose_compression('zlib', b"") == COMPRESS_NONE
+    try:
+        choose_compression('lzma', text)
+        raise AssertionError("unknown mode accepted")
+    except ValueError:
+        pass
+
+    algorithms = [COMPRESS_ZLIB] + ([COMPRESS_ZSTD] if zstd_available() else [])
+    for alg in algorithms:
+        compressor = new_compressor(alg)
+        packed = b"".join(compressor.compress(text[i:i + 4096]) for i in range(0, len(text), 4096))
+        packed += compressor.flush()
+        decompressor = new_decompressor(alg)
+        assert decompressor.decompress(packed) + decompressor.flush() == text, f"algorithm {alg}"
+    if not zstd_available():
+        try:
+            new_decompressor(COMPRESS_ZSTD)
+            raise AssertionError("zstd decompressor without zstandard")
+        except CompressionUnavailable:
+            pass
+    assert new_compressor(COMPRESS_NONE) is None
+    print(f"✓ Compression round trip ({len(algorithms)} algorithm(s))")
+    return True
+
+
+def test_key_cache():
+    """Test 7: Cached keys are found by fingerprint prefix, serial and alias"""
+    os.environ['AEPGP_KEY_CACHE'] = os.path.join(TEST_DIR, "keys")
+    from key_cache import (CachedKey, cache_key, load_cached_keys, find_cached_key,
+                           USAGE_ENCRYPTION, USAGE_SIGNATURE)
+
+    first = CachedKey(bytes.fromhex("AB" * 20), b"\x7f\x49\x00", serial=bytes.fromhex("00050001"),
+                      alias="office")
+    second = CachedKey(bytes.fromhex("AC" + "00" * 19), b"\x7f\x49\x00",
+                       serial=bytes.fromhex("00050002"))
+    signer = CachedKey(bytes.fromhex("AB" + "11" * 19), b"\x7f\x49\x00", usage=USAGE_SIGNATURE)
+    for entry in (first, second, signer):
+        assert cache_key(entry), "cache_key failed"
+    with open(os.path.join(os.environ['AEPGP_KEY_CACHE'], "broken.json"), "w") as f:
+        f.write("{not json")
+
+    keys = load_cached_keys(USAGE_ENCRYPTION)
+    assert sorted(k.fingerprint for k in keys) == [first.fingerprint, second.fingerprint]
+    assert find_cached_key("abab", keys).fingerprint == first.fingerprint
+    assert find_cached_key("A", keys) is None, "ambiguous prefix matched"
+    assert find_cached_key("office").fingerprint == first.fingerprint
+    assert find_cached_key("00050002").fingerprint == second.fingerprint
+    assert find_cached_key("AB11", usage=USAGE_SIGNATURE).fingerprint == signer.fingerprint
+    assert find_cached_key("AB11") is None, "signature key returned for encryption"
+    print("✓ Key cache lookups by usage, prefix, serial and alias")
+    return True
+
+
+def test_checkpoint():
+    """Test 8: Checkpoints persist and only match the unchanged input"""
+    from enc_checkpoint import (EncCheckpoint, checkpoint_path, save_checkpoint, load_checkpoint,
+                                remove_checkpoint)
+    from enc_format import Recipient
+
+    source = os.path.join(TEST_DIR, "big.bin")
+    with open(source, "wb") as f:
+        f.write(os.urandom(300000))
+    st = os.stat(source)
+    checkpoint = EncCheckpoint(os.path.abspath(source), st.st_size, st.st_mtime_ns, 65536, 0,
+                               os.urandom(12), [Recipient(2, os.urandom(40), fingerprint=bytes(20))],
+                               segment_index=3, input_offset=196608, output_offset=197000)
+    path = checkpoint_path(os.path.join(TEST_DIR, "big.bin.enc"))
+    save_checkpoint(path, checkpoint)
+    loaded = load_checkpoint(path)
+    assert loaded is not None and loaded.to_dict() == checkpoint.to_dict(), "checkpoint changed"
+    assert loaded.matches_input(source, 65536)
+    assert not loaded.matches_input(source, 1 << 20), "segment size ignored"
+
+    with open(source, "ab") as f:
+        f.write(b"appended")
+    assert not loaded.matches_input(source, 65536), "modified input matched"
+
+    with open(path, "w") as f:
+        f.write("{}")
+    assert load_checkpoint(path) is None, "unreadable checkpoint loaded"
+    remove_checkpoint(path)
+    assert not os.path.exists(path)
+    print("✓ Checkpoint save/load/match/remove")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP ENCRYPTED FILE FORMAT TEST")
+
+    tests = {
+        "Header Round Trip": test_header_round_trip,
+        "Malformed Headers": test_malformed_headers,
+        "Segments": test_segments,
+        "Key Wrapping": test_key_wrapping,
+        "Inspect File": test_inspect_file,
+        "Compression": test_compression,
+        "Key Cache": test_key_cache,
+        "Checkpoint": test_checkpoint,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
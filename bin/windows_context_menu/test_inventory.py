@@ -0,0 +1,151 @@
+"""
+AEPGP Inventory Test Script
+
+Card-free checks of the card inventory in smartpgp/inventory.py:
+1. Decoding of the application related data (6E) and cardholder data (65)
+2. A full inventory read from a scripted card, protected DOs included
+
+Run this script with: python test_inventory.py
+"""
+
+import os
+import sys
+import json
+
+# Add smartpgp to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+AID = [0xD2, 0x76, 0x00, 0x01, 0x24, 0x01, 0x03, 0x04, 0xAF, 0xAF, 0x00, 0x00, 0x12, 0x34, 0x00, 0x00]
+P256 = [0x2A, 0x86, 0x48, 0xCE, 0x3D, 0x03, 0x01, 0x07]
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _tlv(tag, value):
+    tag = [tag >> 8, tag & 0xFF] if tag > 0xFF else [tag]
+    length = [len(value)] if len(value) < 0x80 else [0x81, len(value)]
+    return tag + length + list(value)
+
+
+def _application_data():
+    inner = (_tlv(0xC1, [0x01, 0x08, 0x00, 0x00, 0x11, 0x03])
+             + _tlv(0xC2, [0x12] + P256)
+             + _tlv(0xC3, [0x13] + P256 + [0xFF])
+             + _tlv(0xC4, [0x01, 0x7F, 0x7F, 0x7F, 0x03, 0x00, 0x02])
+             + _tlv(0xC5, [0x11] * 20 + [0x00] * 40)
+             + _tlv(0xC6, [0x00] * 60)
+             + _tlv(0xCD, [0x5F, 0x5E, 0x10, 0x00] + [0x00] * 8))
+    return _tlv(0x6E, _tlv(0x4F, AID) + _tlv(0x73, inner))
+
+
+class _ScriptedConnection:
+    """Card connection answering GET DATA from a dict of data objects"""
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def transmit(self, apdu):
+        if apdu[1] == 0xCA:
+            tag = (apdu[2] << 8) | apdu[3]
+            if tag in self.objects:
+                return list(self.objects[tag]), 0x90, 0x00
+            # Private DOs 0103 and 0104 need a PIN
+            return [], 0x69, 0x82
+        return [], 0x90, 0x00
+
+
+def test_decode():
+    """Test 1: DO 6E and DO 65 decoded"""
+    from smartpgp.commands import parse_tlv
+    from smartpgp.inventory import decode_application_data, decode_cardholder_data
+
+    inventory = decode_application_data(parse_tlv(_application_data()))
+    assert (inventory["version"], inventory["manufacturer"], inventory["serial"]) == ("3.4", "AFAF", "00001234")
+    keys = inventory["keys"]
+    assert keys["sig"]["algorithm"] == "rsa2048", keys["sig"]
+    assert keys["dec"]["algorithm"] == "ecdh ansix9p256r1", keys["dec"]
+    assert keys["auth"]["algorithm"] == "ecdsa ansix9p256r1", keys["auth"]
+    assert keys["sig"]["fingerprint"] == "11" * 20 and keys["dec"]["fingerprint"] is None
+    assert keys["sig"]["generated"] == 0x5F5E1000 and keys["dec"]["generated"] is None
+    assert inventory["ca_fingerprints"] == [None, None, None]
+    assert inventory["pin_status"]["retries"] == {"user": 3, "resetting_code": 0, "admin": 2}
+    assert inventory["pin_status"]["user_pin_valid_for_several_signatures"]
+
+    cardholder = decode_cardholder_data(parse_tlv(
+        _tlv(0x65, _tlv(0x5B, b"Doe<<John<Paul") + _tlv(0x5F2D, b"enfr") + _tlv(0x5F35, b"9"))))
+    assert cardholder == {"name": "Doe, John Paul", "language": "enfr", "sex": "not applicable"}, cardholder
+    print("✓ AID, algorithms, fingerprints, dates, PIN status and cardholder decoded")
+    return True
+
+
+def test_read_inventory():
+    """Test 2: One session reads every DO, protected ones as None"""
+    from smartpgp.inventory import read_inventory
+    from smartpgp.highlevel import CardConnectionContext
+
+    cert = [0x30, 0x03, 0x02, 0x01, 0x05]
+    ctx = CardConnectionContext()
+    ctx.connection = _ScriptedConnection({
+        0x6E: _application_data(),
+        0x65: _tlv(0x65, _tlv(0x5B, b"")),
+        0x7A: _tlv(0x7A, _tlv(0x93, [0x00, 0x01, 0x02])),
+        0x5F50: b"https://example.org/key",
+        0x7F21: cert,
+        0x0101: [0xCA, 0xFE],
+        0x0102: b"token-1234",
+        0x00F9: [],
+    })
+    ctx.connected = True
+    inventory = read_inventory(ctx)
+    assert inventory["signature_counter"] == 0x0102, inventory["signature_counter"]
+    assert inventory["url"] == "https://example.org/key"
+    assert inventory["cardholder"]["name"] is None and inventory["kdf"] is None
+    assert inventory["certificates"]["sig"]["length"] == len(cert)
+    assert inventory["private_dos"] == {"0101": "CAFE", "0102": b"token-1234".hex().upper(),
+                                        "0103": None, "0104": None}, inventory["private_dos"]
+    assert inventory["alias"] == "token-1234"
+    # Stable output: the same card gives the same JSON
+    assert json.dumps(inventory, sort_keys=True) == json.dumps(read_inventory(ctx), sort_keys=True)
+    print(f"✓ {len(inventory)} entries read in one session")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP INVENTORY TEST")
+
+    tests = {
+        "Decode": test_decode,
+        "Read Inventory": test_read_inventory,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
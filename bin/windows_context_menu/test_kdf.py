@@ -0,0 +1,175 @@
+"""
+AEPGP PIN KDF Test Script
+
+Card-free checks of the KDF-DO support in smartpgp/commands.py:
+1. kdf_itersalted_s2k against GnuPG's iterated and salted S2K
+2. kdf_itersalted_s2k against a byte-by-byte reference (buffer edges)
+3. KDF-DO parsing and rejection of malformed KDF-DOs
+4. Benchmarked iteration counts stay within the card's limits
+
+The GnuPG vectors were taken from `gpg --symmetric --s2k-mode 3
+--cipher-algo AES256` (salt and count from --list-packets, derived key
+from --show-session-key); AES-256 keys are the first 32 bytes of the hash.
+
+Run this script with: python test_kdf.py
+"""
+
+import os
+import sys
+import hashlib
+
+# Add smartpgp to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# (hash algorithm ID, salt, passphrase, count, derived AES-256 key)
+GNUPG_VECTORS = [
+    (0x08, "4102C47CEF6B2B1C", b"123456", 65011712,
+     "5E8B3849F0821AC1511D546EE516CBBEA874F9825C2B1A371D385D98FE9F1606"),
+    (0x0A, "6BE0D9316501FFA4", b"12345678", 65011712,
+     "E58F0F435A71CD3DA5FF216F9B8DE0C4D75A3052721DB57A64C39C9C111B64C7"),
+    (0x0A, "3AC442CC5A5E06C7", b"12345678", 65536,
+     "7FAEDA81C9B285531AD1DA2FD401E8F12F2242701E03210DED6EDAAC5A988E2F"),
+    (0x08, "55ABCD00FE8E572A", b"a-longer-passphrase-0123456789", 3145728,
+     "2EB281BF22563DAB2AF66B20E5167B07B64A66422B5C7919A071B559E89C0A9B"),
+]
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _s2k_reference(salt, value, hash_name, count):
+    """RFC 4880, 3.7.1.3, one update per repetition"""
+    h = hashlib.new(hash_name)
+    data = salt + value
+    while count > len(data):
+        h.update(data)
+        count -= len(data)
+    h.update(data[:count])
+    return h.digest()
+
+
+def test_gnupg_vectors():
+    """Test 1: Derived keys match GnuPG"""
+    from smartpgp.commands import kdf_itersalted_s2k
+
+    for algo, salt, passphrase, count, expected in GNUPG_VECTORS:
+        derived = kdf_itersalted_s2k(bytes.fromhex(salt), passphrase, algo, count)
+        assert derived[:32].hex().upper() == expected, f"salt {salt}, count {count}"
+    print(f"✓ {len(GNUPG_VECTORS)} GnuPG S2K vectors")
+    return True
+
+
+def test_reference():
+    """Test 2: Counts around block and buffer boundaries match the reference"""
+    from smartpgp.commands import kdf_itersalted_s2k, KDF_HASHES, KDF_BUFFER_SIZE
+
+    salt = bytes.fromhex("0102030405060708")
+    counts = [1, 13, 14, 15, 28, 65536, 65537, KDF_BUFFER_SIZE - 1, KDF_BUFFER_SIZE,
+              KDF_BUFFER_SIZE + 1, 3 * KDF_BUFFER_SIZE + 7]
+    for algo, hash_name in KDF_HASHES.items():
+        for pin in (b"123456", b"12345678", b"x" * 127):
+            for count in counts:
+                assert (kdf_itersalted_s2k(salt, pin, algo, count)
+                        == _s2k_reference(salt, pin, hash_name, count)), \
+                    f"{hash_name}, {len(pin)}-byte PIN, count {count}"
+    try:
+        kdf_itersalted_s2k(salt, b"123456", 0x09, 65536)
+        raise AssertionError("unknown hash algorithm accepted")
+    except ValueError:
+        pass
+    print(f"✓ {len(counts) * 3 * len(KDF_HASHES)} derivations match the reference")
+    return True
+
+
+def test_parse_kdf_do():
+    """Test 3: KDF-DOs parse, malformed ones raise CardOperationFailed"""
+    from smartpgp.commands import (parse_kdf_do, CardOperationFailed, KDF_ITERSALTED_S2K,
+                                   KDF_SHA256, KDF_DEFAULT_ITERATIONS, PW1, PW3, RESETTING_CODE)
+
+    salt1, salt3 = bytes(range(8)), bytes(range(8, 16))
+    body = (bytes([0x81, 1, KDF_ITERSALTED_S2K, 0x82, 1, KDF_SHA256, 0x83, 4])
+            + KDF_DEFAULT_ITERATIONS.to_bytes(4, 'big')
+            + bytes([0x84, 8]) + salt1 + bytes([0x86, 8]) + salt3)
+    for data in (body, bytes([0xF9, len(body)]) + body):
+        kdf = parse_kdf_do(data)
+        assert kdf['algo'] == KDF_SHA256 and kdf['iterations'] == KDF_DEFAULT_ITERATIONS, kdf
+        assert kdf['salts'][PW1] == salt1 and kdf['salts'][PW3] == salt3, kdf
+        # Resetting code salt defaults to the PW1 salt
+        assert kdf['salts'][RESETTING_CODE] == salt1, kdf
+
+    assert parse_kdf_do(bytes([0x81, 1, 0x00])) is None, "KDF_NONE parsed"
+    assert parse_kdf_do(b"") is None, "empty KDF-DO parsed"
+
+    malformed = {
+        "missing hash algorithm": bytes([0x81, 1, KDF_ITERSALTED_S2K, 0x83, 4, 0, 1, 0, 0,
+                                         0x84, 8]) + salt1,
+        "missing iteration count": bytes([0x81, 1, KDF_ITERSALTED_S2K, 0x82, 1, KDF_SHA256,
+                                          0x84, 8]) + salt1,
+        "missing salt": bytes([0x81, 1, KDF_ITERSALTED_S2K, 0x82, 1, KDF_SHA256,
+                               0x83, 4, 0, 1, 0, 0]),
+        "truncated salt": body[:-3],
+    }
+    for name, data in malformed.items():
+        try:
+            parse_kdf_do(data)
+        except CardOperationFailed as e:
+            assert "KDF-DO" in str(e), str(e)
+            continue
+        raise AssertionError(f"{name} accepted")
+    print(f"✓ KDF-DO parsed; {len(malformed)} malformed KDF-DOs rejected")
+    return True
+
+
+def test_benchmark():
+    """Test 4: Benchmarked counts are clamped to the card's range"""
+    from smartpgp.commands import kdf_benchmark, KDF_SHA256, KDF_MIN_ITERATIONS
+
+    iterations, rate = kdf_benchmark(KDF_SHA256, target=0.0, sample=1 << 16)
+    assert iterations == KDF_MIN_ITERATIONS and rate > 0, (iterations, rate)
+    iterations, _ = kdf_benchmark(KDF_SHA256, target=1e9, sample=1 << 16)
+    assert iterations == 0xFFFFFFFF, iterations
+    iterations, rate = kdf_benchmark(KDF_SHA256, target=0.1, sample=1 << 20)
+    print(f"✓ {rate / 1e6:.0f} MB/s, {iterations} iterations for 100 ms")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP PIN KDF TEST")
+
+    tests = {
+        "GnuPG Vectors": test_gnupg_vectors,
+        "Reference S2K": test_reference,
+        "Parse KDF-DO": test_parse_kdf_do,
+        "Benchmark": test_benchmark,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
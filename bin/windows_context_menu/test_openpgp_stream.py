@@ -0,0 +1,327 @@
+"""
+AEPGP OpenPGP Stream Test Script
+
+Card-free checks of the streaming OpenPGP layer (the card's key operations
+are replaced by the matching software private keys):
+1. CRC24 against the OpenPGP check value and a bitwise reference
+2. New-format packet lengths and partial body lengths
+3. ASCII armor round trip and checksum verification
+4. Encrypted messages to RSA and ECDH recipients, and MDC checks
+5. Shared public key records and their PGPy-free OpenPGP packets, read from
+   a card with the DO CD creation time
+
+Run this script with: python test_openpgp_stream.py
+"""
+
+import io
+import os
+import sys
+import struct
+
+# Add handlers to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "handlers"))
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.keywrap import aes_key_unwrap
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _crc24_bitwise(data):
+    """RFC 4880, 6.1 reference implementation"""
+    crc = 0xB704CE
+    for b in data:
+        crc ^= b << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def _tlv(tag, value):
+    if len(value) < 0x80:
+        length = bytes([len(value)])
+    elif len(value) <= 0xFF:
+        length = bytes([0x81, len(value)])
+    else:
+        length = bytes([0x82]) + struct.pack('>H', len(value))
+    return tag + length + value
+
+
+def _key_data(public_key):
+    """GET PUBLIC KEY response (7F49 template) for a public key"""
+    if isinstance(public_key, rsa.RSAPublicKey):
+        numbers = public_key.public_numbers()
+        content = (_tlv(b"\x81", numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, 'big'))
+                   + _tlv(b"\x82", numbers.e.to_bytes(3, 'big')))
+    else:
+        content = _tlv(b"\x86", public_key.public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint))
+    return _tlv(b"\x7f\x49", content)
+
+
+def _software_session_key(pkesk, recipient, private_key):
+    """What _decrypt_session_key gets from the card, computed with the private key"""
+    from openpgp_stream import _ecdh_kek, _pkcs5_unpad
+
+    if recipient.is_ecdh:
+        point = ec.EllipticCurvePublicKey.from_encoded_point(private_key.curve, bytes(pkesk.point))
+        kek = _ecdh_kek(private_key.exchange(ec.ECDH(), point), recipient.fingerprint,
+                        recipient.card_key.curve_oid)
+        return _pkcs5_unpad(aes_key_unwrap(kek, pkesk.wrapped, default_backend()))
+    return private_key.decrypt(bytes(pkesk.ciphertext), padding.PKCS1v15())
+
+
+def _decrypt(message, recipient, private_key):
+    """decrypt_stream with the session key recovered in software"""
+    from openpgp_stream import (OpenPGPError, _open_input, _read_packet_header, _PacketBodyReader,
+                                _parse_pkesk, _checksum, _SEIPDReader, _copy_literal,
+                                TAG_PKESK, TAG_SEIPD)
+
+    reader = _open_input(io.BytesIO(message))
+    session_key = None
+    while True:
+        tag, length, partial = _read_packet_header(reader)
+        body = _PacketBodyReader(reader, length, partial)
+        if tag == TAG_PKESK:
+            pkesk = _parse_pkesk(body.read())
+            assert pkesk.key_id == recipient.key_id, "PKESK key ID"
+            m = _software_session_key(pkesk, recipient, private_key)
+            assert _checksum(m[1:-2]) == m[-2:], "session key checksum"
+            session_key = m[1:-2]
+        elif tag == TAG_SEIPD:
+            break
+        else:
+            raise OpenPGPError(f"Unexpected packet {tag}")
+    assert body.read_exact(1) == b"\x01", "SEIPD version"
+    out = io.BytesIO()
+    plaintext = _SEIPDReader(body, session_key)
+    _, filename = _copy_literal(plaintext, out)
+    plaintext.drain()
+    return out.getvalue(), filename
+
+
+def test_crc24():
+    """Test 1: CRC24 matches the check value and the bitwise algorithm"""
+    from openpgp_stream import _crc24, _CRC24_INIT
+
+    # CRC-24/OPENPGP check value
+    assert _crc24(_CRC24_INIT, b"123456789") == 0x21CF02
+    for length in list(range(0, 17)) + [1000, 4097]:
+        data = os.urandom(length)
+        assert _crc24(_CRC24_INIT, data) == _crc24_bitwise(data), f"length {length}"
+        # Incremental updates across unaligned chunk boundaries
+        crc = _CRC24_INIT
+        for i in range(0, length, 7):
+            crc = _crc24(crc, memoryview(data)[i:i + 7])
+        assert crc == _crc24_bitwise(data), f"incremental length {length}"
+    print("✓ CRC24 check value, bitwise reference and incremental updates")
+    return True
+
+
+def test_packet_lengths():
+    """Test 2: Packet lengths and partial bodies read back"""
+    from openpgp_stream import (_encode_length, _read_new_length, _read_packet_header,
+                                _FileReader, _PacketBodyReader, _PartialBodyWriter)
+
+    for length in (0, 191, 192, 8383, 8384, 2**32 - 1):
+        encoded = _encode_length(length)
+        assert len(encoded) == (1 if length < 192 else 2 if length < 8384 else 5)
+        assert _read_new_length(_FileReader(io.BytesIO(encoded))) == (length, False)
+
+    for size in (0, 1, 511, 512, 513, 5000):
+        data = os.urandom(size)
+        out = io.BytesIO()
+        writer = _PartialBodyWriter(out, 11, chunk_size=512)
+        for i in range(0, size, 100):
+            writer.write(data[i:i + 100])
+        writer.close()
+        reader = _FileReader(io.BytesIO(out.getvalue() + b"trailing"))
+        tag, length, partial = _read_packet_header(reader)
+        assert tag == 11 and partial == (size > 512), f"header for {size}"
+        body = _PacketBodyReader(reader, length, partial)
+        assert body.read() == data, f"body of {size} bytes"
+        assert reader.read() == b"trailing", "read past the packet"
+    print("✓ Length encodings and partial body packets")
+    return True
+
+
+def test_armor():
+    """Test 3: Armored data decodes and a bad checksum is rejected"""
+    from openpgp_stream import _ArmorWriter, _open_input, OpenPGPError
+
+    data = b"\x85" + os.urandom(1000)
+    out = io.BytesIO()
+    writer = _ArmorWriter(out)
+    writer.write(data[:333])
+    writer.write(data[333:])
+    writer.close()
+    armored = out.getvalue()
+    lines = armored.splitlines()
+    assert lines[0] == b"-----BEGIN PGP MESSAGE-----" and lines[-1] == b"-----END PGP MESSAGE-----"
+    assert all(len(line) <= 64 for line in lines), "line too long"
+    assert _open_input(io.BytesIO(armored)).read() == data
+
+    checksum = next(line for line in lines if line.startswith(b"="))
+    bad = armored.replace(checksum, b"=AAAA")
+    try:
+        _open_input(io.BytesIO(bad)).read()
+        raise AssertionError("bad armor checksum accepted")
+    except OpenPGPError:
+        pass
+    print("✓ Armor round trip and checksum")
+    return True
+
+
+def test_messages():
+    """Test 4: Messages decrypt for RSA and ECDH recipients, tampering detected"""
+    from key_wrap import load_card_public_key
+    from openpgp_stream import OpenPGPError, OpenPGPRecipient, encrypt_stream, v4_fingerprint
+
+    rsa_key = rsa.generate_private_key(65537, 2048, default_backend())
+    ec_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    keys = [
+        (load_card_public_key(_key_data(rsa_key.public_key()), None), rsa_key),
+        (load_card_public_key(_key_data(ec_key.public_key()), bytes.fromhex("122A8648CE3D030107")),
+         ec_key),
+    ]
+    plaintext = os.urandom(200000)
+    for card_key, private_key in keys:
+        recipient = OpenPGPRecipient(card_key, v4_fingerprint(card_key, 1700000000))
+        for armor in (False, True):
+            out = io.BytesIO()
+            assert encrypt_stream(io.BytesIO(plaintext), out, [recipient], b"data.bin",
+                                  armor) == len(plaintext)
+            decrypted, filename = _decrypt(out.getvalue(), recipient, private_key)
+            assert decrypted == plaintext and filename == b"data.bin", card_key.describe()
+
+        out = io.BytesIO()
+        encrypt_stream(io.BytesIO(plaintext), out, [recipient])
+        message = bytearray(out.getvalue())
+        message[-5] ^= 1
+        try:
+            _decrypt(bytes(message), recipient, private_key)
+            raise AssertionError(f"altered message accepted ({card_key.describe()})")
+        except OpenPGPError:
+            pass
+        print(f"✓ {card_key.describe()}: binary and armored messages, MDC check")
+    return True
+
+
+class _KeyCard:
+    """AEPGPCard stand-in answering GET PUBLIC KEY and GET DATA C2/C5/CD"""
+
+    def __init__(self, key_data, attributes, created):
+        self.key_records = {}
+        self.objects = {0x47: key_data, 0xC2: attributes, 0xC5: bytes(60),
+                        0xCD: bytes(4) + struct.pack(">I", created) + bytes(4)}
+        self.sent = []
+        self.connection = self
+
+    def transmit(self, apdu):
+        self.sent.append(apdu[1] if apdu[1] == 0x47 else apdu[3])
+        return list(self.objects[self.sent[-1]]), 0x90, 0x00
+
+    def _log_apdu(self, apdu, response, sw1, sw2):
+        pass
+
+
+def test_key_records():
+    """Test 5: One shared record per key, packets match the CardPublicKey ones"""
+    from card_key_reader import public_key_record, public_key_fingerprint, read_public_key_record
+    from key_wrap import load_card_public_key
+    from openpgp_stream import (load_card_recipient, public_key_body, v4_fingerprint, PUBKEY_ECDH,
+                                PUBKEY_RSA)
+
+    rsa_key = rsa.generate_private_key(65537, 2048, default_backend()).public_key()
+    ec_key = ec.generate_private_key(ec.SECP256R1(), default_backend()).public_key()
+    p256 = bytes.fromhex("122A8648CE3D030107")
+    for public_key, attributes in ((rsa_key, None), (ec_key, p256)):
+        key_data = _key_data(public_key)
+        record = public_key_record(key_data, attributes, 1700000000)
+        assert record is public_key_record(bytearray(key_data), attributes, 1700000000)
+        assert record.fingerprint == public_key_fingerprint(key_data)
+        assert record.public_key() is record.public_key(), "key object rebuilt"
+        assert record.public_key().public_numbers() == public_key.public_numbers()
+        packet = record.openpgp_packet()
+        assert packet is record.openpgp_packet(), "packet rebuilt"
+        assert packet[:3] == b"\x99" + struct.pack(">H", len(packet) - 3), packet[:3]
+        if attributes is None:
+            numbers = public_key.public_numbers()
+            body = public_key_body(PUBKEY_RSA, 1700000000, [numbers.n.to_bytes(256, 'big'),
+                                                            numbers.e.to_bytes(3, 'big')])
+        else:
+            body = public_key_body(PUBKEY_ECDH, 1700000000, [public_key.public_bytes(
+                serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)],
+                attributes[1:])
+        assert packet[3:] == body
+
+        card_key = load_card_public_key(key_data, attributes)
+        assert card_key.public_key is load_card_public_key(key_data, attributes).public_key
+        assert record.openpgp_fingerprint() == v4_fingerprint(card_key, 1700000000)
+        try:
+            record.created = 0
+            raise AssertionError("record modified")
+        except AttributeError:
+            pass
+
+        # Read from a card: the creation time comes from DO CD, read once
+        card = _KeyCard(key_data, attributes or bytes([0x01, 0x08, 0x00, 0x00, 0x11, 0x00]),
+                        1700000000)
+        card_record = read_public_key_record(card, 'encryption')
+        assert card_record.created == 1700000000, card_record.created
+        recipient = load_card_recipient(card)
+        assert recipient.fingerprint == record.openpgp_fingerprint()
+        assert card.sent.count(0x47) == 1 and card.sent.count(0xCD) == 1, card.sent
+        print(f"✓ {card_key.describe()}: shared record, key object and packet")
+
+    assert public_key_record(_tlv(b"\x7f\x49", b""), None) is None
+    assert public_key_record(_key_data(rsa_key), p256) is None, "RSA data read as an EC key"
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP OPENPGP STREAM TEST")
+
+    tests = {
+        "CRC24": test_crc24,
+        "Packet Lengths": test_packet_lengths,
+        "Armor": test_armor,
+        "Messages": test_messages,
+        "Key Records": test_key_records,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
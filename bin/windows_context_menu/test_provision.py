@@ -0,0 +1,342 @@
+"""
+AEPGP Provisioning Test Script
+
+Card-free checks of the provisioning profiles in smartpgp/provision.py:
+1. Profile loading (certificates, PINs from the environment, KDF count)
+2. Malformed profiles rejected before any card is touched
+3. Steps issued in order, PIN changes and KDF last
+4. Card data parsing and the diff between a card and a profile
+5. Provisioning again a card whose PINs an earlier run changed
+
+Run this script with: python test_provision.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+
+# Add smartpgp to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+TEST_DIR = tempfile.mkdtemp(prefix="aepgp-test-")
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _write_profile(profile, name="profile.json"):
+    path = os.path.join(TEST_DIR, name)
+    with open(path, "w") as f:
+        json.dump(profile, f)
+    return path
+
+
+class _RecordingConnection:
+    """Card connection answering 90 00 to everything, recording the APDUs"""
+
+    def __init__(self):
+        self.apdus = []
+
+    def transmit(self, apdu):
+        self.apdus.append(list(apdu))
+        if apdu[1] == 0xCA and apdu[3] == 0x4F:
+            return [0xD2, 0x76, 0, 1, 0x24, 1, 3, 4, 0xAF, 0xAF, 0, 0, 0x12, 0x34, 0, 0], 0x90, 0x00
+        return [], 0x90, 0x00
+
+
+class _PinCard:
+    """Card connection keeping PINs, retry counters, private DOs and the
+    KDF-DO like a card would"""
+
+    def __init__(self):
+        self.pins = {0x81: b"123456", 0x83: b"12345678", 0xD3: None}
+        self.retries = {0x81: 3, 0x83: 3}
+        self.dos = {0xF9: [0x81, 0x01, 0x00]}
+        self.wrong = 0
+
+    def disconnect(self):
+        pass
+
+    def _check_pin(self, reference, value):
+        reference = 0x83 if reference == 0x83 else 0x81
+        if value == self.pins[reference]:
+            self.retries[reference] = 3
+            return True
+        self.retries[reference] -= 1
+        self.wrong += 1
+        return False
+
+    def transmit(self, apdu):
+        ins, p1, p2 = apdu[1:4]
+        data = bytes(apdu[5:5 + apdu[4]]) if len(apdu) > 5 else b""
+        tag = (p1 << 8) | p2
+        if ins == 0xA4:
+            return [], 0x90, 0x00
+        if ins == 0x20:
+            return ([], 0x90, 0x00) if self._check_pin(p2, data) else ([], 0x63, 0xC0)
+        if ins == 0x24:
+            reference = 0x83 if p2 == 0x83 else 0x81
+            old = self.pins[reference]
+            if not self._check_pin(reference, data[:len(old)]):
+                return [], 0x63, 0xC0
+            self.pins[reference] = data[len(old):]
+            return [], 0x90, 0x00
+        if ins == 0xDA:
+            if tag == 0xD3:
+                self.pins[0xD3] = data
+            else:
+                self.dos[tag] = list(data)
+            return [], 0x90, 0x00
+        if ins == 0xCA:
+            if tag == 0x4F:
+                return [0xD2, 0x76, 0, 1, 0x24, 1, 3, 4, 0xAF, 0xAF, 0, 0, 0x12, 0x34, 0, 0], 0x90, 0x00
+            if tag == 0x6E:
+                status = [0x00, 0x7F, 0x7F, 0x7F, self.retries[0x81],
+                          3 if self.pins[0xD3] else 0, self.retries[0x83]]
+                inner = [0xC4, len(status)] + status
+                return [0x6E, len(inner) + 2, 0x73, len(inner)] + inner, 0x90, 0x00
+            if tag in self.dos:
+                return list(self.dos[tag]), 0x90, 0x00
+            return [], 0x6A, 0x88
+        return [], 0x6D, 0x00
+
+
+def test_load_profile():
+    """Test 1: A complete profile loads with its certificates and PINs"""
+    from smartpgp.provision import load_profile
+    from smartpgp.commands import KDF_SHA512, KDF_MIN_ITERATIONS
+
+    cert = os.urandom(600)
+    with open(os.path.join(TEST_DIR, "sig.der"), "wb") as f:
+        f.write(cert)
+    os.environ["AEPGP_TEST_PIN"] = "24681357"
+    profile = load_profile(_write_profile({
+        "algorithms": {"auth": "P-256", "sig": "RSA2048"},
+        "generate": ["auth", "sig"],
+        "certificates": {"sig": "sig.der"},
+        "alias": "rack-{reader}-{serial}",
+        "pins": {"admin": "ENV:AEPGP_TEST_PIN", "user": "654321"},
+        "kdf": {"hash": "sha512", "time": 0.0},
+    }))
+    assert profile["algorithms"] == {"sig": "rsa2048", "auth": "P-256"}, profile["algorithms"]
+    assert profile["generate"] == ["sig", "auth"], "roles not in slot order"
+    assert profile["certificates"] == {"sig": list(cert)}
+    assert profile["pins"] == {"admin": "24681357", "user": "654321"}
+    assert profile["kdf"] == {"algo": KDF_SHA512, "iterations": KDF_MIN_ITERATIONS}, profile["kdf"]
+
+    empty = load_profile(_write_profile({}))
+    assert empty["kdf"] is None and empty["alias"] is None and not empty["generate"]
+    print("✓ Profile loaded, KDF time resolved to an iteration count")
+    return True
+
+
+def test_invalid_profiles():
+    """Test 2: Malformed profiles raise InvalidProfile"""
+    from smartpgp.provision import load_profile, InvalidProfile
+
+    invalid = {
+        "unknown entry": {"algorithm": {}},
+        "unknown role": {"generate": ["sm"]},
+        "unknown algorithm": {"algorithms": {"sig": "rsa1024"}},
+        "missing certificate": {"certificates": {"sig": "nope.der"}},
+        "certificates list": {"certificates": ["sig.der"]},
+        "dec certificate": {"certificates": {"dec": "sig.der"}},
+        "alias placeholder": {"alias": "{name}"},
+        "alias too long": {"alias": "x" * 256},
+        "missing environment PIN": {"pins": {"user": "ENV:AEPGP_TEST_UNSET"}},
+        "unknown PIN": {"pins": {"puk": "12345678"}},
+        "PINs list": {"pins": ["12345678"]},
+        "KDF string": {"kdf": "sha256"},
+        "KDF time": {"kdf": {"time": "long"}},
+        "KDF iterations": {"kdf": {"iterations": [65536]}},
+        "unknown KDF hash": {"kdf": {"hash": "md5"}},
+        "KDF count": {"kdf": {"iterations": 0}},
+    }
+    for name, profile in invalid.items():
+        try:
+            load_profile(_write_profile(profile, "invalid.json"))
+        except InvalidProfile:
+            continue
+        raise AssertionError(f"{name} accepted")
+    try:
+        load_profile(os.path.join(TEST_DIR, "missing.json"))
+        raise AssertionError("missing profile accepted")
+    except InvalidProfile:
+        pass
+    print(f"✓ {len(invalid)} malformed profiles rejected")
+    return True
+
+
+def test_step_order():
+    """Test 3: Card steps follow the slot order, PINs change last"""
+    from smartpgp.provision import load_profile, _card_steps
+    from smartpgp.highlevel import CardConnectionContext
+
+    profile = load_profile(_write_profile({
+        "algorithms": {"sig": "P-256"},
+        "generate": ["dec"],
+        "alias": "token-{serial}",
+        "pins": {"user": "654321", "resetting_code": "11223344"},
+    }))
+    ctx = CardConnectionContext()
+    ctx.connection = _RecordingConnection()
+    ctx.connected = True
+    ctx._kdf_by_serial[bytes.fromhex("00001234")] = None
+    names = []
+    for name, run in _card_steps(ctx, profile, 3):
+        names.append(name)
+        run()
+    assert names == ["algorithm sig P-256", "generate dec", "alias", "resetting code",
+                     "user PIN"], names
+    headers = [tuple(apdu[:4]) for apdu in ctx.connection.apdus]
+    assert (0x00, 0xDA, 0x00, 0xC1) in headers, "algorithm attributes not written"
+    assert (0x00, 0x47, 0x80, 0x00) in headers, "key not generated"
+    alias = next(apdu for apdu in ctx.connection.apdus if apdu[:4] == [0x00, 0xDA, 0x01, 0x02])
+    assert bytes(alias[5:]) == b"token-00001234", bytes(alias[5:])
+    assert headers[-1] == (0x00, 0x24, 0x00, 0x81), "user PIN not changed last"
+    assert ctx.user_pin == "654321"
+    print(f"✓ {len(names)} steps, {len(headers)} APDUs in order")
+    return True
+
+
+def test_diff():
+    """Test 4: Only what differs from the card is planned"""
+    from smartpgp.provision import load_profile, diff_profile
+    from smartpgp.commands import parse_tlv, CardOperationFailed
+
+    objects = parse_tlv([0x6E, 0x0A, 0x73, 0x08, 0xC1, 0x06, 0x01, 0x08, 0x00, 0x00, 0x11, 0x03,
+                         0x5F, 0x50, 0x00])
+    assert objects[0xC1] == [0x01, 0x08, 0x00, 0x00, 0x11, 0x03] and objects[0x5F50] == []
+    cert = [0x30, 0x81, 0x7D, 0x04, 0x7B] + [0xAA] * 0x7B
+    assert parse_tlv([0x7F, 0x21, 0x81, 0x80] + cert)[0x7F21] == cert
+    for data in ([0x73, 0x05, 0xC1], [0x5F], [0x73, 0x82, 0x01]):
+        try:
+            parse_tlv(data)
+            raise AssertionError(f"truncated TLV accepted: {data}")
+        except CardOperationFailed:
+            pass
+
+    with open(os.path.join(TEST_DIR, "auth.der"), "wb") as f:
+        f.write(b"certificate")
+    profile = load_profile(_write_profile({
+        "algorithms": {"sig": "rsa2048", "dec": "P-256"},
+        "generate": ["sig", "dec", "auth"],
+        "certificates": {"auth": "auth.der"},
+        "alias": "token-{serial}",
+        "pins": {"user": "654321", "admin": "87654321", "resetting_code": "11223344"},
+        "kdf": {"iterations": 65536},
+    }))
+    snapshot = {
+        "reader": 0, "serial": "00001234",
+        # RSA with another format byte, and P-256 for ECDH without the trailing FF
+        "algorithms": {"sig": "010800001102", "dec": "122A8648CE3D030107", "auth": "010800001103"},
+        "keys": {"sig": "00", "dec": "00", "auth": "00"},
+        "certificates": {"auth": hashlib.sha256(b"certificate").hexdigest()},
+        "alias": "token-00001234",
+        "pin_retries": {"user": 3, "resetting_code": 3, "admin": 3},
+        "user_pin_set": True,
+        "kdf": {"hash": "sha256", "iterations": 65536},
+    }
+    diff = diff_profile(snapshot, profile, "87654321")
+    assert diff == {"algorithms": {}, "generate": [], "certificates": {}, "alias": None,
+                    "pins": {}, "kdf": None}, diff
+
+    snapshot.update(algorithms={"sig": "010C00001103", "dec": "122A8648CE3D030107FF",
+                                "auth": "010800001103"},
+                    keys={"sig": "00", "dec": "00", "auth": None},
+                    certificates={}, alias=None, user_pin_set=False, kdf=None,
+                    pin_retries={"user": 3, "resetting_code": 0, "admin": 3})
+    diff = diff_profile(snapshot, profile, "12345678")
+    assert diff["algorithms"] == {"sig": "rsa2048"}, diff["algorithms"]
+    assert diff["generate"] == ["sig", "auth"], "regeneration after an algorithm change"
+    assert list(diff["certificates"]) == ["auth"] and diff["alias"] == "token-{serial}"
+    assert diff["pins"] == profile["pins"] and diff["kdf"] == profile["kdf"], diff
+    print("✓ TLV parsing, empty diff for a provisioned card, full diff for a new one")
+    return True
+
+
+def test_rerun():
+    """Test 5: A rerun uses the PINs the card has, without costing tries"""
+    import smartpgp.highlevel as highlevel
+    from smartpgp.highlevel import CardConnectionContext
+    from smartpgp.commands import PW1, RESETTING_CODE, KDF_MIN_ITERATIONS
+    from smartpgp.provision import load_profile, provision_card
+
+    pins = {"user": "654321", "admin": "87654321"}
+    card = _PinCard()
+    select_reader = highlevel.select_reader
+    highlevel.select_reader = lambda reader_index: card
+    try:
+        report = provision_card(0, load_profile(_write_profile({"pins": pins})), "12345678")
+        assert report["status"] == "ok", report["error"]
+        assert [s["step"] for s in report["steps"]] == ["user PIN", "admin PIN"], report["steps"]
+        assert card.wrong == 0, "probing a fresh card cost a try"
+
+        # Same PINs, a KDF and a resetting code added, and the old Admin PIN given
+        profile = load_profile(_write_profile({
+            "pins": dict(pins, resetting_code="11223344"),
+            "kdf": {"iterations": KDF_MIN_ITERATIONS},
+        }))
+        report = provision_card(0, profile, "12345678")
+        assert report["status"] == "ok", report["error"]
+        assert [s["step"] for s in report["steps"]] == ["KDF"], report["steps"]
+        assert report["snapshot"]["user_pin_set"] is True
+        assert card.retries == {0x81: 3, 0x83: 3}, card.retries
+    finally:
+        highlevel.select_reader = select_reader
+
+    ctx = CardConnectionContext()
+    ctx.connection = card
+    ctx.connected = True
+    assert ctx.kdf() is not None, "no KDF-DO"
+    assert card.pins[0x81] == bytes(ctx.encode_pin("654321", PW1)), "user PIN not derived"
+    assert card.pins[0xD3] == bytes(ctx.encode_pin("11223344", RESETTING_CODE))
+    print("✓ Rerun with the PINs set by the first run, no try lost")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP PROVISIONING TEST")
+
+    tests = {
+        "Load Profile": test_load_profile,
+        "Invalid Profiles": test_invalid_profiles,
+        "Step Order": test_step_order,
+        "Diff": test_diff,
+        "Rerun": test_rerun,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,255 @@
+"""
+AEPGP Signing Test Script
+
+Card-free checks of the signature layer (card signatures are produced
+with the matching software private keys):
+1. Signature key parsing from GET PUBLIC KEY data and signature checks
+2. Detached raw and OpenPGP signatures verified against the key cache
+3. Manifest Merkle trees and inclusion proofs
+4. ssh-agent key blobs and identity answers
+
+Run this script with: python test_signing.py
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import struct
+import hashlib
+import tempfile
+
+# Add handlers to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "handlers"))
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+
+TEST_DIR = tempfile.mkdtemp(prefix="aepgp-test-")
+os.environ['AEPGP_KEY_CACHE'] = os.path.join(TEST_DIR, "keys")
+
+P256_ATTRIBUTES = bytes([0x13]) + bytes.fromhex("2A8648CE3D030107")
+P384_ATTRIBUTES = bytes([0x13]) + bytes.fromhex("2B81040022")
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _tlv(tag, value):
+    if len(value) < 0x80:
+        length = bytes([len(value)])
+    elif len(value) <= 0xFF:
+        length = bytes([0x81, len(value)])
+    else:
+        length = bytes([0x82]) + struct.pack('>H', len(value))
+    return tag + length + value
+
+
+def _key_data(public_key):
+    """GET PUBLIC KEY response (7F49 template) for a public key"""
+    if isinstance(public_key, rsa.RSAPublicKey):
+        numbers = public_key.public_numbers()
+        content = (_tlv(b"\x81", numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, 'big'))
+                   + _tlv(b"\x82", numbers.e.to_bytes(3, 'big')))
+    else:
+        content = _tlv(b"\x86", public_key.public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint))
+    return _tlv(b"\x7f\x49", content)
+
+
+def _card_sign(private_key, digest, hash_name):
+    """Signature in the card's format: RSA PKCS#1 v1.5, or ECDSA r || s"""
+    from card_sign import HASH_ALGORITHMS
+
+    algorithm = utils.Prehashed(HASH_ALGORITHMS[hash_name]())
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return private_key.sign(digest, padding.PKCS1v15(), algorithm)
+    r, s = utils.decode_dss_signature(private_key.sign(digest, ec.ECDSA(algorithm)))
+    size = (private_key.curve.key_size + 7) // 8
+    return r.to_bytes(size, 'big') + s.to_bytes(size, 'big')
+
+
+def _test_keys():
+    from card_sign import load_signing_key
+
+    keys = []
+    for private_key, attributes in (
+            (rsa.generate_private_key(65537, 2048, default_backend()), None),
+            (ec.generate_private_key(ec.SECP256R1(), default_backend()), P256_ATTRIBUTES),
+            (ec.generate_private_key(ec.SECP384R1(), default_backend()), P384_ATTRIBUTES)):
+        signing_key = load_signing_key(_key_data(private_key.public_key()), attributes)
+        assert signing_key is not None, f"key with attributes {attributes} not parsed"
+        keys.append((signing_key, private_key))
+    return keys
+
+
+KEYS = []
+
+
+def test_signing_keys():
+    """Test 1: Card public keys parse and verify card-format signatures"""
+    from card_sign import load_signing_key
+
+    KEYS.extend(_test_keys())
+    for signing_key, private_key in KEYS:
+        assert signing_key.public_key.public_numbers() == private_key.public_key().public_numbers()
+        for hash_name in ('sha256', 'sha512'):
+            digest = hashlib.new(hash_name, b"signed data").digest()
+            signature = _card_sign(private_key, digest, hash_name)
+            assert signing_key.verify(signature, digest, hash_name), signing_key.describe()
+            assert not signing_key.verify(signature, hashlib.new(hash_name, b"x").digest(),
+                                          hash_name), "wrong digest accepted"
+            assert not signing_key.verify(signature[:-1] + bytes([signature[-1] ^ 1]), digest,
+                                          hash_name), "altered signature accepted"
+
+    eddsa = bytes([0x16]) + bytes.fromhex("2B06010401DA470F01")
+    assert load_signing_key(_tlv(b"\x7f\x49", _tlv(b"\x86", os.urandom(32))), eddsa) is None
+    print(f"✓ {', '.join(k.describe() for k, _ in KEYS)} signatures verified; EdDSA rejected")
+    return True
+
+
+def test_verify_stream():
+    """Test 2: Detached signatures verify with the cached signer only"""
+    from card_key_reader import ALGO_ECDSA
+    from card_sign import verify_stream
+    from key_cache import CachedKey, cache_key, USAGE_SIGNATURE
+    from openpgp_stream import (new_signature, finish_signature, write_signature,
+                                signing_key_v4_fingerprint)
+
+    data = os.urandom(100000)
+    created = int(time.time())
+    for signing_key, private_key in KEYS:
+        fingerprint = signing_key_v4_fingerprint(signing_key, created)
+        cache_key(CachedKey(signing_key.fingerprint, signing_key.key_data, signing_key.attributes,
+                            usage=USAGE_SIGNATURE, openpgp_fingerprint=fingerprint))
+
+        raw = _card_sign(private_key, hashlib.sha256(data).digest(), 'sha256')
+        if signing_key.algorithm == ALGO_ECDSA:
+            # Raw ECDSA signature files are DER encoded
+            half = len(raw) // 2
+            raw = utils.encode_dss_signature(int.from_bytes(raw[:half], 'big'),
+                                             int.from_bytes(raw[half:], 'big'))
+        entry, error = verify_stream(io.BytesIO(data), raw)
+        assert error is None and entry.fingerprint == signing_key.fingerprint, error
+
+        for armor in (False, True):
+            sig = new_signature(signing_key, 'sha512', fingerprint, created)
+            digest = hashlib.sha512(data + sig.trailer()).digest()
+            finish_signature(sig, digest, _card_sign(private_key, digest, 'sha512'))
+            out = io.BytesIO()
+            write_signature(out, sig, armor)
+            entry, error = verify_stream(io.BytesIO(data), out.getvalue())
+            assert error is None and entry.fingerprint == signing_key.fingerprint, error
+            entry, error = verify_stream(io.BytesIO(data + b"!"), out.getvalue())
+            assert entry is None and error == "Bad signature", "altered data accepted"
+
+        entry, error = verify_stream(io.BytesIO(data), raw,
+                                     signer=signing_key.fingerprint.hex()[:12])
+        assert error is None, error
+
+    # Signed by a key that is not in the cache
+    stranger = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    der = stranger.sign(data, ec.ECDSA(hashes.SHA256()))
+    entry, error = verify_stream(io.BytesIO(data), der)
+    assert entry is None and error == "Bad signature", error
+    print("✓ Raw and OpenPGP (binary/armored) detached signatures")
+    return True
+
+
+def test_merkle_proofs():
+    """Test 3: Every leaf proves inclusion in the manifest root"""
+    from sign_manifest import leaf_hash, merkle_tree, root_from_proof, signed_digest
+
+    for count in range(1, 18):
+        leaves = [leaf_hash(f"dir/file{i}", i * 100, hashlib.sha256(bytes([i])).digest())
+                  for i in range(count)]
+        root, proofs = merkle_tree(leaves)
+        assert len(proofs) == count
+        for leaf, proof in zip(leaves, proofs):
+            assert root_from_proof(leaf, proof) == root, f"proof in a tree of {count}"
+        if count > 1:
+            other = leaf_hash("dir/file0", 1, leaves[0])
+            assert root_from_proof(other, proofs[0]) != root, "forged leaf proved"
+            assert merkle_tree(leaves[::-1])[0] != root, "order not bound"
+
+    # Leaves bind path and size, not only the content digest
+    digest = hashlib.sha256(b"x").digest()
+    assert leaf_hash("a", 1, digest) != leaf_hash("b", 1, digest) != leaf_hash("b", 2, digest)
+    assert merkle_tree([])[0] == merkle_tree([], 'sha256')[0]
+    assert signed_digest(root) != root and len(signed_digest(root, 'sha512')) == 64
+    print("✓ Inclusion proofs for trees of 1 to 17 leaves")
+    return True
+
+
+def test_ssh_key_blobs():
+    """Test 4: Agent key blobs match OpenSSH encodings"""
+    from ssh_agent import (SSHAgent, key_blob, authorized_key_line, _mpint,
+                           SSH_AGENTC_REQUEST_IDENTITIES, SSH_AGENT_IDENTITIES_ANSWER,
+                           SSH_AGENTC_SIGN_REQUEST, SSH_AGENT_FAILURE, _string)
+
+    assert _mpint(0) == b"\x00\x00\x00\x00"
+    assert _mpint(0x7F) == b"\x00\x00\x00\x01\x7f"
+    assert _mpint(0x80) == b"\x00\x00\x00\x02\x00\x80"
+
+    for signing_key, private_key in KEYS:
+        line = authorized_key_line(key_blob(signing_key), "card@test")
+        expected = private_key.public_key().public_bytes(serialization.Encoding.OpenSSH,
+                                                         serialization.PublicFormat.OpenSSH)
+        assert line == expected.decode() + " card@test", signing_key.describe()
+
+        agent = SSHAgent(None, signing_key, "card@test")
+        answer = agent.handle(bytes([SSH_AGENTC_REQUEST_IDENTITIES]))
+        assert answer == (bytes([SSH_AGENT_IDENTITIES_ANSWER]) + struct.pack('>I', 1)
+                          + _string(agent.blob) + _string(b"card@test"))
+        # Requests for other keys fail without touching the card
+        request = (bytes([SSH_AGENTC_SIGN_REQUEST]) + _string(b"other key") + _string(b"data")
+                   + struct.pack('>I', 0))
+        assert agent.handle(request) == bytes([SSH_AGENT_FAILURE])
+        assert agent.handle(bytes([SSH_AGENTC_SIGN_REQUEST]) + b"\x00\x00") == bytes([SSH_AGENT_FAILURE])
+    print("✓ ssh-rsa and ecdsa-sha2 blobs match OpenSSH, identity answers")
+    return True
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP SIGNING TEST")
+
+    tests = {
+        "Signing Keys": test_signing_keys,
+        "Verify Stream": test_verify_stream,
+        "Merkle Proofs": test_merkle_proofs,
+        "SSH Key Blobs": test_ssh_key_blobs,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,143 @@
+"""
+AEPGP Start-up Time Test Script
+
+Measures the imports of each entry point with python -X importtime and
+checks them against start-up budgets:
+1. smartpgp-cli list-readers (pyscard, the command's own work, not counted)
+2. The encrypt context menu handler, until it starts working
+3. The decrypt context menu handler, until it starts working
+
+Heavy modules (pyscard, cryptography, PGPy, tkinter, pyasn1) must only be
+imported on the code paths that use them. Times are the best of a few runs
+with the bytecode cache written, interpreter start-up (site) excluded.
+Set AEPGP_STARTUP_BUDGET_FACTOR to scale the budgets on a slow machine.
+
+Run this script with: python test_startup.py
+"""
+
+import os
+import sys
+import subprocess
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HANDLERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "handlers")
+
+# Import time budgets in milliseconds
+BUDGETS_MS = {
+    "smartpgp-cli list-readers": 50,
+    "encrypt handler": 40,
+    "decrypt handler": 40,
+}
+BUDGET_FACTOR = float(os.environ.get("AEPGP_STARTUP_BUDGET_FACTOR", "1"))
+RUNS = 3
+
+
+def print_separator(title=""):
+    """Print a visual separator"""
+    if title:
+        print("\n" + "=" * 70)
+        print(f"  {title}")
+        print("=" * 70)
+    else:
+        print("=" * 70)
+
+
+def _import_times(args, cwd):
+    """Run python -X importtime with args, returns the top-level imports as
+    {module: cumulative microseconds}"""
+    env = dict(os.environ)
+    # The bytecode cache is part of a normal start
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=cwd, env=env,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            # Imports made at run time by a function are top-level too
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def _start_up(args, cwd, excluded=()):
+    """Best import time in ms of an entry point, and the modules it imports"""
+    baseline = set(_import_times(["-c", "pass"], cwd))
+    _import_times(args, cwd)  # write the bytecode cache
+    best, modules = None, set()
+    for _ in range(RUNS):
+        imports = _import_times(args, cwd)
+        counted = {name: t for name, t in imports.items()
+                   if name not in baseline and not name.startswith(excluded)}
+        total = sum(counted.values()) / 1000.0
+        if best is None or total < best:
+            best, slowest = total, sorted(counted.items(), key=lambda item: -item[1])[:3]
+        modules.update(imports)
+    print("  slowest: " + ", ".join(f"{name} {t / 1000.0:.1f} ms" for name, t in slowest))
+    return best, modules
+
+
+def _check(name, elapsed, modules, forbidden):
+    loaded = sorted(m for m in modules if m.split(".")[0] in forbidden)
+    assert not loaded, f"{name} imports {', '.join(loaded)} at start-up"
+    budget = BUDGETS_MS[name] * BUDGET_FACTOR
+    assert elapsed <= budget, f"{name}: {elapsed:.1f} ms of imports, budget {budget:.0f} ms"
+    print(f"✓ {name}: {elapsed:.1f} ms of imports (budget {budget:.0f} ms)")
+    return True
+
+
+def test_cli_list_readers():
+    """Test 1: smartpgp-cli list-readers"""
+    name = "smartpgp-cli list-readers"
+    elapsed, modules = _start_up(["smartpgp-cli", "list-readers"], BIN_DIR, excluded=("smartcard",))
+    return _check(name, elapsed, modules, ("cryptography", "pgpy", "tkinter", "pyasn1"))
+
+
+def test_encrypt_handler():
+    """Test 2: Encrypt context menu handler"""
+    name = "encrypt handler"
+    elapsed, modules = _start_up(["-c", "import encrypt_handler"], HANDLERS_DIR)
+    return _check(name, elapsed, modules, ("smartcard", "cryptography", "pgpy", "tkinter"))
+
+
+def test_decrypt_handler():
+    """Test 3: Decrypt context menu handler"""
+    name = "decrypt handler"
+    elapsed, modules = _start_up(["-c", "import decrypt_handler"], HANDLERS_DIR)
+    return _check(name, elapsed, modules, ("smartcard", "cryptography", "pgpy", "tkinter"))
+
+
+def main():
+    """Main test execution"""
+    print_separator("AEPGP START-UP TIME TEST")
+
+    tests = {
+        "CLI list-readers": test_cli_list_readers,
+        "Encrypt Handler": test_encrypt_handler,
+        "Decrypt Handler": test_decrypt_handler,
+    }
+    results = {}
+    for name, test in tests.items():
+        print(f"\n[{name}]")
+        try:
+            results[name] = test()
+        except Exception as e:
+            print(f"❌ FAILED: {type(e).__name__}: {e}")
+            results[name] = False
+
+    print_separator("TEST SUMMARY")
+    for name, result in results.items():
+        status = "✓ PASSED" if result else "❌ FAILED"
+        print(f"{name:.<50} {status}")
+    failed = sum(1 for result in results.values() if not result)
+    print_separator()
+    print(f"Total Tests: {len(results)}")
+    print(f"Passed: {len(results) - failed}")
+    print(f"Failed: {failed}")
+    return failed == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)